@@ -0,0 +1,325 @@
+'''Benchmarks for the client side of the explorer pipeline, driven by synthetic or recorded query results
+so they run without a cloak.
+
+Stages measured:
+    process     NumericColumnExplorer._process_query_result: decoding a bucketed query result and
+                building its bucket levels
+    interpolate Building a bucket level below a parent level, filling in suppressed buckets
+    extract     Building a pandas DataFrame from NumericColumnExplorer.extract_to_dataframe over all levels
+    estimate    bucket_util.estimate_bucket_size, called once per result row (at most ESTIMATE_CALLS times)
+
+Each stage is timed (best of `--repeat` runs) and then run once more under tracemalloc to record its peak
+and retained memory, and the number of memory blocks it allocated that are still held when it returns
+(including those of its result). Results can be saved as a baseline and compared against later runs:
+
+    python -m benchmarks.run --save-baseline benchmarks/baseline.json
+    python -m benchmarks.run --compare benchmarks/baseline.json
+
+Recorded results can be replayed from a `QueryCache` with `--cache PATH`.
+'''
+import argparse
+import gc
+import json
+import logging
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from explorer import bucket_util
+from explorer import bucket_tree as bt
+from explorer.cache import QueryCache
+from explorer.numeric_explorer import NumericColumnExplorer
+
+SIZES = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]
+DISTRIBUTIONS = ['uniform', 'normal', 'lognormal']
+SUPPRESSION = [0.0, 0.1, 0.5]
+ESTIMATE_CALLS = 100_000
+
+'''A stage counts as a regression if it is TOLERANCE slower, or uses TOLERANCE more peak memory, than
+its baseline. Allocated blocks are compared too, but not counted: stages that allocate few blocks vary by
+more than TOLERANCE between runs (eg. as caches fill).
+'''
+TOLERANCE = 0.2
+
+FINE_SIZE = 1
+COARSE_SIZE = 10
+LABELS = [f'bucket_{COARSE_SIZE}', f'bucket_{FINE_SIZE}', *bt.DATA_COLUMNS]
+
+
+def synthetic_result(rows, distribution, suppression, seed=0):
+    '''Generate the result of a two level bucketed query with about `rows` rows
+
+    :param distribution: The shape of the bucket counts, one of DISTRIBUTIONS
+    :param suppression: The share of fine buckets, those with the smallest counts, that are suppressed
+        into the star row. Coarse buckets no larger than the largest suppressed fine bucket are suppressed too.
+    :returns: A dict of 'labels' and 'rows', as returned by `AircloakConnection.fetch`
+    '''
+    rng = np.random.default_rng(seed)
+    num_fine = max(rows * COARSE_SIZE // (COARSE_SIZE + 1), COARSE_SIZE)
+    num_fine -= num_fine % COARSE_SIZE
+    x = (np.arange(num_fine) + 0.5) / num_fine
+    if distribution == 'uniform':
+        shape = np.ones(num_fine)
+    elif distribution == 'normal':
+        shape = np.exp(-0.5 * ((x - 0.5) / 0.15) ** 2)
+    elif distribution == 'lognormal':
+        shape = np.exp(-0.5 * (np.log(x * 10) / 0.8) ** 2) / x
+    else:
+        raise ValueError(f'Unknown distribution {distribution}')
+
+    fine_counts = rng.poisson(shape / shape.max() * 100) + 1
+    coarse_counts = fine_counts.reshape(-1, COARSE_SIZE).sum(axis=1)
+
+    threshold = 0
+    fine_visible = np.ones(num_fine, dtype=bool)
+    if suppression > 0:
+        order = np.argsort(fine_counts + rng.random(num_fine))
+        suppressed = order[:int(num_fine * suppression)]
+        fine_visible[suppressed] = False
+        threshold = fine_counts[suppressed].max() if len(suppressed) > 0 else 0
+    coarse_visible = coarse_counts > threshold
+
+    columns = [[], [], [], [], [], [], []]
+    for (index, size, counts, visible) in [(0, COARSE_SIZE, coarse_counts, coarse_visible),
+                                           (1, FINE_SIZE, fine_counts, fine_visible)]:
+        lower_bounds = (np.flatnonzero(visible) * size).astype(np.float64)
+        n = len(lower_bounds)
+        for i in range(2):
+            columns[i] += lower_bounds.tolist() if i == index else [None] * n
+        columns[2] += counts[visible].tolist()
+        columns[3] += [1.0] * n
+        columns[4] += lower_bounds.tolist()
+        columns[5] += (lower_bounds + size - 1).tolist()
+        columns[6] += (lower_bounds + (size - 1) / 2).tolist()
+
+    result_rows = list(zip(*columns))
+    for (counts, visible) in [(coarse_counts, coarse_visible), (fine_counts, fine_visible)]:
+        if not visible.all():
+            result_rows.append(
+                (None, None, int(counts[~visible].sum()), 1.0, None, None, None))
+
+    return {'labels': list(LABELS), 'rows': result_rows}
+
+
+def recorded_results(path):
+    '''The bucketed query results of a `QueryCache`, as (bucket sizes, result)
+    '''
+    cache = QueryCache(path)
+    try:
+        for (labels, rows) in cache.results():
+            sizes = [float(label[len('bucket_'):])
+                     for label in labels if label.startswith('bucket_')]
+            if len(sizes) > 0 and len(rows) > 0:
+                yield sizes, {'labels': labels, 'rows': rows}
+    finally:
+        cache.close()
+
+
+def empty_explorer(bucket_sizes, query_result):
+    '''An explorer without a connection, whose tree expects the levels of query_result
+    '''
+    count_column = len(bucket_sizes)
+    total_count = sum(row[count_column] for row in query_result['rows']
+                      if row[count_column] is not None)
+    lower_bounds = [row[i] for row in query_result['rows']
+                    for i in range(len(bucket_sizes)) if row[i] is not None]
+    value_range = max(lower_bounds) - min(lower_bounds) if len(lower_bounds) > 0 else 0
+
+    explorer = NumericColumnExplorer.__new__(NumericColumnExplorer)
+    explorer._bucket_tree = bt.BucketTree.from_state({
+        'range': value_range,
+        'suppressed_count': 0,
+        'total_count': total_count,
+        'to_explore': sorted(bucket_sizes),
+        'sizes': sorted(bucket_sizes),
+    }, [])
+    explorer._column_labels = []
+    explorer.max_synthetic_share = None
+    return explorer
+
+
+def stages(bucket_sizes, query_result):
+    '''The benchmarked stages for one result set, as (name, number of items, setup, run)
+
+    setup() returns the argument passed to run(), so that only run() is measured.
+    '''
+    import pandas as pd
+
+    rows = len(query_result['rows'])
+
+    def processed():
+        explorer = empty_explorer(bucket_sizes, query_result)
+        explorer._process_query_result(bucket_sizes, query_result)
+        return explorer
+
+    def interpolate_input():
+        explorer = processed()
+        sizes = sorted(bucket_sizes, reverse=True)
+        parent = explorer._bucket_tree.level(sizes[0])
+        child = explorer._bucket_tree.level(sizes[-1])
+        measured = ~child.column('synthetic')
+        data = np.column_stack([child.column(name)[measured]
+                                for name in bt.DATA_COLUMNS])
+        return (sizes[-1], child.column('lower_bound')[measured], data, parent)
+
+    def interpolate(args):
+        bucket_size, lower_bounds, data, parent = args
+        bt.BucketLevel(bucket_size=bucket_size, lower_bounds=lower_bounds,
+                       data=data, parent_level=parent)
+
+    rng = np.random.default_rng(0)
+    calls = min(rows, ESTIMATE_CALLS)
+    estimate_args = list(zip((10 ** rng.uniform(-2, 6, calls)).tolist(),
+                             rng.integers(10, 10 ** 7, calls).tolist()))
+
+    def estimate(args):
+        for (value_range, value_count) in args:
+            bucket_util.estimate_bucket_size(value_range, value_count)
+
+    return [
+        ('process', rows, lambda: empty_explorer(bucket_sizes, query_result),
+         lambda explorer: explorer._process_query_result(bucket_sizes, query_result)),
+        ('interpolate', rows, interpolate_input, interpolate),
+        ('extract', rows, processed, lambda explorer: pd.DataFrame(**explorer.extract_to_dataframe())),
+        ('estimate', calls, lambda: estimate_args, estimate),
+    ]
+
+
+def measure(items, setup, run, repeat):
+    '''Time run(setup()) and measure its memory use
+
+    :returns: A dict of seconds (best of `repeat` runs), items_per_second, peak_bytes, retained_bytes and
+        allocated_blocks
+    '''
+    best = float('inf')
+    for _ in range(repeat):
+        args = setup()
+        gc.collect()
+        start = time.perf_counter()
+        run(args)
+        best = min(best, time.perf_counter() - start)
+        del args
+
+    args = setup()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before_snapshot = traced_snapshot()
+        before, _ = tracemalloc.get_traced_memory()
+        result = run(args)
+        after, peak = tracemalloc.get_traced_memory()
+        blocks = sum(stat.count_diff for stat in traced_snapshot().compare_to(before_snapshot, 'filename'))
+    finally:
+        tracemalloc.stop()
+    del result
+
+    return {
+        'seconds': best,
+        'items_per_second': items / best if best > 0 else float('inf'),
+        'peak_bytes': peak - before,
+        'retained_bytes': after - before,
+        'allocated_blocks': blocks,
+    }
+
+
+def traced_snapshot():
+    '''A tracemalloc snapshot without the memory of tracemalloc's own snapshots
+    '''
+    return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+
+def run_benchmarks(result_sets, repeat, stage_names=None):
+    '''Run all stages over all result sets
+
+    :param result_sets: An iterable of (name, bucket sizes, query result)
+    :returns: A dict of '<stage>/<result set name>' -> measurements
+    '''
+    results = {}
+    for (name, bucket_sizes, query_result) in result_sets:
+        for (stage, items, setup, run) in stages(bucket_sizes, query_result):
+            if stage_names is not None and stage not in stage_names:
+                continue
+            key = f'{stage}/{name}'
+            results[key] = dict(measure(items, setup, run, repeat), items=items)
+            print(format_result(key, results[key]), flush=True)
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    '''Print the change of every measurement against its baseline
+
+    :returns: The keys of the measurements that regressed
+    '''
+    regressions = []
+    for (key, result) in results.items():
+        if key not in baseline:
+            continue
+        time_ratio = result['seconds'] / baseline[key]['seconds']
+        memory_ratio = result['peak_bytes'] / max(baseline[key]['peak_bytes'], 1)
+        # Baselines saved before allocations were counted don't have them
+        blocks_ratio = result['allocated_blocks'] / max(baseline[key]['allocated_blocks'], 1) \
+            if 'allocated_blocks' in baseline[key] else 1.0
+        regressed = time_ratio > 1 + tolerance or memory_ratio > 1 + tolerance
+        if regressed:
+            regressions.append(key)
+        print(f'{key:<45} time x{time_ratio:5.2f}  peak memory x{memory_ratio:5.2f}  '
+              f'allocations x{blocks_ratio:5.2f}{"  REGRESSION" if regressed else ""}')
+    return regressions
+
+
+def format_result(key, result):
+    return (f'{key:<45} {result["seconds"] * 1000:10.2f} ms {result["items_per_second"]:14,.0f} items/s '
+            f'{result["peak_bytes"] / 2 ** 20:9.1f} MiB peak {result["retained_bytes"] / 2 ** 20:9.1f} MiB retained '
+            f'{result["allocated_blocks"]:10,} blocks')
+
+
+def synthetic_result_sets(sizes, distributions, suppression):
+    for rows in sizes:
+        for distribution in distributions:
+            for share in suppression:
+                yield (f'{distribution}/{rows}/{share}', [COARSE_SIZE, FINE_SIZE],
+                       synthetic_result(rows, distribution, share))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                        help='Numbers of result rows, up to 10000000')
+    parser.add_argument('--distributions', nargs='+', default=DISTRIBUTIONS, choices=DISTRIBUTIONS)
+    parser.add_argument('--suppression', type=float, nargs='+', default=SUPPRESSION,
+                        help='Shares of suppressed buckets')
+    parser.add_argument('--stages', nargs='+', choices=['process', 'interpolate', 'extract', 'estimate'])
+    parser.add_argument('--cache', help='Replay the bucketed results recorded in this query cache instead')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save-baseline', help='Write the measurements as a baseline to this JSON file')
+    parser.add_argument('--compare', help='Compare against the baseline in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.DEBUG)
+
+    if args.cache is not None:
+        result_sets = ((f'recorded/{i}/{len(result["rows"])}', sizes, result)
+                       for (i, (sizes, result)) in enumerate(recorded_results(args.cache)))
+    else:
+        result_sets = synthetic_result_sets(
+            args.sizes, args.distributions, args.suppression)
+
+    results = run_benchmarks(result_sets, args.repeat, args.stages)
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if len(compare(results, baseline, args.tolerance)) > 0:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,124 @@
+import psycopg2
+from psycopg2.extras import LoggingConnection
+import logging
+import threading
+from contextlib import contextmanager
+
+from . import instrumentation
+
+'''A backend executes the query text produced by `AircloakConnection` and must provide:
+
+    execute(query_text) -> (labels, rows)
+        Run a query and return its column labels and a list of row tuples.
+    stream(query_text, chunk_size) -> generator of lists of row tuples
+        Run a query and return its rows `chunk_size` at a time.
+    close()
+        Release any resources held by the backend.
+
+Backends are called from several threads at once.
+'''
+
+'''KEEPALIVE are the TCP keepalive settings of connections to the cloak, so idle pooled connections
+are kept open (or detected as dead) instead of silently timing out.
+'''
+KEEPALIVE = {
+    'keepalives': 1,
+    'keepalives_idle': 30,
+    'keepalives_interval': 10,
+    'keepalives_count': 3,
+}
+
+
+class PostgresBackend:
+    '''Sends queries to a cloak over the PostgreSQL protocol, using a pool of psycopg2 connections
+    '''
+
+    def __init__(self, *, user, host, port, dbname, pool_size):
+        self.user = user
+        self.host = host
+        self.port = port
+        self.dbname = dbname
+
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    def execute(self, query_text):
+        '''Run a query. If the connection turns out to be broken (eg. closed by the server after being
+        idle), the idle connections are dropped and the query is retried once on a new connection.
+        '''
+        try:
+            return self._execute(query_text)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            logging.debug('Query failed with %s, reconnecting and retrying', e)
+            self.close()
+            return self._execute(query_text)
+
+    def _execute(self, query_text):
+        with self._connection() as conn:
+            with conn.cursor() as cur:
+                with instrumentation.timed('query.execute'):
+                    cur.execute(query_text)
+                with instrumentation.timed('query.fetch'):
+                    return [col.name for col in cur.description], cur.fetchall()
+
+    def stream(self, query_text, chunk_size):
+        '''Stream the rows through a server-side cursor. The connection stays borrowed from the pool
+        until the generator is exhausted or closed.
+        '''
+        with self._connection() as conn:
+            with conn.cursor(name=f'chunks_{threading.get_ident()}') as cur:
+                cur.itersize = chunk_size
+                cur.execute(query_text)
+                while True:
+                    rows = cur.fetchmany(chunk_size)
+                    if len(rows) == 0:
+                        break
+                    yield rows
+
+    def close(self):
+        with self._lock:
+            for conn in self._idle:
+                conn.close()
+            self._idle = []
+
+    @contextmanager
+    def _connection(self):
+        '''Borrow a connection from the pool, opening a new one if none are idle.
+        Blocks while all `pool_size` connections are in use.
+        '''
+        with self._slots:
+            with self._lock:
+                conn = self._idle.pop() if len(self._idle) > 0 else None
+
+            if conn is None or conn.closed:
+                conn = self._connect()
+
+            try:
+                yield conn
+            finally:
+                # End the transaction psycopg2 opens implicitly, so that a connection left in an aborted
+                # transaction by a failed query doesn't fail the next query sent on it
+                if not conn.closed:
+                    try:
+                        conn.rollback()
+                    except psycopg2.Error as e:
+                        logging.debug('Rolling back failed with %s, closing the connection', e)
+                        conn.close()
+
+                # Broken connections are not returned to the pool
+                if not conn.closed:
+                    with self._lock:
+                        self._idle.append(conn)
+
+    def _connect(self):
+        logging.debug('Connecting to Aircloak: user=%s, host=%s, port=%s, dbname=%s',
+                      self.user, self.host, self.port, self.dbname)
+
+        conn = psycopg2.connect(
+            user=self.user, host=self.host, port=self.port, dbname=self.dbname,
+            connection_factory=LoggingConnection, **KEEPALIVE)
+
+        conn.initialize(logging.getLogger('AircloakConnection'))
+
+        return conn
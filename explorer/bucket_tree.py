@@ -1,7 +1,13 @@
 from typing import List, Generator, Iterable
 from collections import namedtuple
+import datetime
+import math
+import threading
+import weakref
+import numpy as np
 from . import bucket_util as bu
-from itertools import takewhile, dropwhile
+from . import instrumentation
+from . import level_store
 
 
 '''TREE_BASES determines the bucket sizes that are used to build the tree. 
@@ -9,23 +15,216 @@ from itertools import takewhile, dropwhile
 '''
 TREE_BASES = [1, 5]
 
+'''DATA_COLUMNS are the values stored for each bucket, in the order returned by `multi_bucket_stats`.
+Synthetic (interpolated) buckets only have a count, their other values are NaN.
+'''
+DATA_COLUMNS = ['count', 'count_noise', 'min', 'max', 'avg']
+
+EXPORT_COLUMNS = ['bucket_size', 'lower_bound', *DATA_COLUMNS, 'synthetic']
+
+'''Estimate is the answer to a distribution query over the explored buckets
+value: The estimated value, assuming values are spread evenly within each bucket
+error: A bound on the error caused by the bucket resolution and by suppressed values. The counts of synthetic
+    buckets are interpolated from the suppressed values of their parent bucket, which may lie anywhere in the
+    parent, and the suppressed values of the coarsest level may lie anywhere at all. Noise added by the cloak
+    is not included.
+synthetic_share: The share of the counts behind the estimate that come from synthetic buckets
+'''
+Estimate = namedtuple('Estimate', 'value error synthetic_share')
+
 
 class BucketTree:
-    def __init__(self, unbucketed_range, unbucketed_data, total_count, suppressed_count):
+    def __init__(self, unbucketed_range, unbucketed_data, total_count, suppressed_count, calendar=False,
+                 finest_unit='second'):
+        '''
+        :param calendar: Bucket date/time values, as seconds since the Unix epoch, by the units of
+            `bucket_util.CALENDAR_UNITS` instead of by TREE_BASES. The bucket size of each level is the
+            length of its unit, and buckets of years, quarters and months start at calendar boundaries.
+        :param finest_unit: The smallest calendar unit to explore, eg. 'day' for dates. Units with more
+            buckets over the range than there are values are not explored either, see
+            `bucket_util.finest_granularity`.
+        '''
         self._unbucketed = {
             'range': unbucketed_range,
             'data': unbucketed_data,
-            'suppressed': suppressed_count
+            'suppressed': suppressed_count,
+            'count': total_count
         }
-        first_bucket = bu.estimate_bucket_size(unbucketed_range, total_count)
-        self._to_explore = [b for b in bu.buckets_with_base(
-            TREE_BASES) if b < first_bucket]
+        self._calendar = calendar
+        if calendar:
+            finest = bu.CALENDAR_UNITS[bu.finest_granularity(unbucketed_range, total_count, finest_unit)]
+            self._to_explore = sorted(size for size in bu.CALENDAR_UNITS.values() if size >= finest)
+        else:
+            first_bucket = bu.estimate_bucket_size(unbucketed_range, total_count)
+            self._to_explore = [b for b in bu.buckets_with_base(
+                TREE_BASES) if b < first_bucket]
 
-        self._to_explore.append(first_bucket)
+            self._to_explore.append(first_bucket)
+        # All bucket sizes of the tree, including the ones explored only over some ranges
+        self._sizes = list(self._to_explore)
         self._explored_buckets = {}
+        # LevelBuilders of the levels whose query results are being streamed in
+        self._streaming = {}
+
+    @classmethod
+    def from_state(cls, state, levels, unbucketed_data=None):
+        '''Restore a tree from the output of `state` and its explored levels
+
+        :param levels: A list of `BucketLevel`s
+        :param unbucketed_data: The unbucketed data passed to the original tree, if available
+        '''
+        tree = cls.__new__(cls)
+        tree._unbucketed = {
+            'range': state['range'],
+            'data': unbucketed_data,
+            'suppressed': state['suppressed_count'],
+            'count': state['total_count']
+        }
+        tree._calendar = state.get('calendar', False)
+        tree._to_explore = list(state['to_explore'])
+        tree._sizes = list(state['sizes'])
+        tree._explored_buckets = {level.bucket_size: level for level in levels}
+        tree._streaming = {}
+        return tree
+
+    def state(self):
+        '''The exploration state of the tree apart from its levels, as a dict of JSON-serialisable values
+        '''
+        return {
+            'range': to_json(self._unbucketed['range']),
+            'suppressed_count': to_json(self._unbucketed['suppressed']),
+            'total_count': to_json(self._unbucketed['count']),
+            'to_explore': [to_json(size) for size in self._to_explore],
+            'sizes': [to_json(size) for size in self._sizes],
+            'calendar': self._calendar,
+        }
+
+    @property
+    def calendar(self):
+        '''Whether the tree buckets date/time values by calendar units
+        '''
+        return self._calendar
 
     def next_levels(self, depth):
-        return self._to_explore[-depth:]
+        '''The bucket sizes to explore next, the `depth` largest ones left. Calendar units larger than the
+        one picked by `bucket_util.estimate_granularity` have few buckets and don't count against depth,
+        so eg. years, quarters and months arrive along with the first days and hours.
+        '''
+        if not self._calendar:
+            return self._to_explore[-depth:]
+
+        first = bu.CALENDAR_UNITS[bu.estimate_granularity(self._unbucketed['range'], self._unbucketed['count'])]
+        coarse = [size for size in self._to_explore if size > first]
+        fine = [size for size in self._to_explore if size <= first]
+        return fine[-depth:] + coarse
+
+    def estimate_rows(self, bucket_size):
+        '''Estimate the number of rows a query for bucket_size returns, see `bucket_util.estimate_level_rows`
+
+        The counts of the smallest explored level that divides into bucket_size are used, if there is one.
+        '''
+        parent = self._parent_level(bucket_size)
+        if parent is None:
+            return bu.estimate_level_rows(bucket_size, self._unbucketed['range'], self._unbucketed['count'])
+        return bu.estimate_level_rows(bucket_size, self._unbucketed['range'], self._unbucketed['count'],
+                                      coarse_size=parent.bucket_size, coarse_counts=parent.column('count'))
+
+    def expected_synthetic_share(self, bucket_size, coarse_size=None):
+        '''Estimate the share of values that will be suppressed at bucket_size, assuming values are spread
+        evenly within the buckets of the smallest explored level that divides into it
+
+        :param coarse_size: Only count the values that would not be suppressed at coarse_size either, that
+            is the share of a level of coarse_size rolled up from bucket_size that a query would measure
+            but that is interpolated instead, see `derive_levels`
+        '''
+        parent = self._parent_level(bucket_size)
+        if parent is None:
+            # Without measured counts, nothing is known about how skewed the values are
+            return 1.0
+
+        counts = np.nan_to_num(parent.column('count'))
+        children_per_bucket = parent.bucket_size / bucket_size
+        sparse = (counts > 0) & (counts / children_per_bucket < bu.MIN_EXACT_COUNT)
+        if coarse_size is not None:
+            sparse &= counts * coarse_size / parent.bucket_size >= bu.MIN_EXACT_COUNT
+        total = counts.sum()
+        return float(counts[sparse].sum() / total) if total > 0 else 0.0
+
+    def plan_queries(self, depth, budget=bu.DEFAULT_BUDGET, max_synthetic_share=None, value_range=None):
+        '''Group the next `depth` levels into queries that fit the budget, see `bucket_util.plan_queries`
+
+        :param value_range: The (min, max) of the column's values. Levels too large for the budget are split
+            into range-restricted queries over an aligned range containing it, they are not split without it.
+        :param max_synthetic_share: If given, levels are left out of the plan if they can be derived from a
+            finer level of the plan that is expected to leave at most this share of their count interpolated,
+            see `derive_levels`. If the finer level turns out to leave more, they are planned again next time.
+        '''
+        sizes = self.next_levels(depth)
+        if max_synthetic_share is not None:
+            sizes = [size for size in sizes
+                     if not any(finer < size and self._divides(finer, size) and
+                                self.expected_synthetic_share(finer, size) <= max_synthetic_share
+                                for finer in sizes)]
+
+        estimates = [(size, self.estimate_rows(size)) for size in reversed(sizes)]
+        return bu.plan_queries(estimates, budget, self._value_span(value_range))
+
+    def derive_levels(self, max_synthetic_share=0.0):
+        '''Roll up finer explored levels into the unexplored levels they determine, instead of querying them.
+
+        A level is derived from the largest completely explored level that divides into it, if at most
+        `max_synthetic_share` of the derived level's count is interpolated where a query would have measured
+        it. Synthetic counts in derived buckets with fewer than `bucket_util.MIN_EXACT_COUNT` values are not
+        held against the level: a query would most likely find them suppressed and they would be
+        interpolated as well. So with the default of 0, the derived level is as good as a queried one,
+        though low count buckets are interpolated from the finer level's parent rather than from the
+        coarser one's. A larger share derives more levels and saves more queries, at the cost of
+        interpolated counts in buckets that a query would have measured. Derived levels record the size they
+        were derived from in their metadata as 'derived_from'.
+
+        :returns: The derived bucket sizes
+        '''
+        derived = []
+        for bucket_size in list(self._to_explore):
+            finer = [size for (size, level) in self._explored_buckets.items()
+                     if size < bucket_size and self._divides(size, bucket_size) and level.is_complete()]
+            if len(finer) == 0:
+                continue
+            source = self._explored_buckets[max(finer)]
+            level = roll_up(source, bucket_size)
+            if self._interpolated_share(source, level) > max_synthetic_share:
+                continue
+
+            self._to_explore.remove(bucket_size)
+            self._explored_buckets[bucket_size] = self._aligned(level)
+            derived.append(bucket_size)
+
+        return derived
+
+    def _interpolated_share(self, source, level):
+        '''The share of the count of `level`, rolled up from `source`, that is interpolated but would have
+        been measured by a query, see `derive_levels`
+        '''
+        counts = np.nan_to_num(level.column('count'))
+        total = counts.sum()
+        if len(source) > 0:
+            source_counts = np.nan_to_num(source.column('count'))
+            synthetic_counts = np.where(source.column('synthetic'), source_counts, 0.0)
+            # The derived bucket of each source bucket, searching half a bucket late against floating point noise
+            index = np.searchsorted(level.column('lower_bound'), source.column('lower_bound') + source.bucket_size / 2,
+                                    side='right') - 1
+            synthetic_counts = np.bincount(index, weights=synthetic_counts, minlength=len(level))
+            interpolated = synthetic_counts[counts >= bu.MIN_EXACT_COUNT].sum()
+        else:
+            interpolated = 0.0
+
+        # Suppressed values are only part of the synthetic buckets if the source had a parent to
+        # interpolate them into, otherwise they are missing from the derived level
+        if self._parent_level(source.bucket_size) is None:
+            suppressed = source.metadata.get('suppressed', 0)
+            interpolated += suppressed
+            total += suppressed
+        return float(interpolated / total) if total > 0 else 0.0
 
     def buckets_at_level(self, level):
         return self._explored_buckets.get(level).as_flat_list()
@@ -33,85 +232,909 @@ class BucketTree:
     def bucket_levels(self):
         return list(self._explored_buckets.keys())
 
-    def insert_query_result(self, bucket_size, buckets, **kwargs):
+    def level(self, bucket_size):
+        '''The `BucketLevel` for a bucket size, or None if it hasn't been explored
+        '''
+        return self._explored_buckets.get(bucket_size)
+
+    def insert_query_result(self, bucket_size, buckets=None, *, lower_bounds=None, data=None, **kwargs):
         '''Insert the result of a bucketed query
 
         :param bucket_size: The bucket size at this level
         :metadata: A dict containing extra data about this level of buckets (eg. column labels, suppressed values)
-        :param buckets: Should be a list of `Bucket`s
+        :param buckets: Should be a list of `Bucket`s. Alternatively, pass `lower_bounds` and `data`
+            arrays, see `BucketLevel`.
         '''
-        next_level = self._to_explore.pop()
-        assert bucket_size == next_level, f'Wrong bucket size, expected {next_level}, got {bucket_size}'
+        # Levels are normally explored largest first, but levels expected to be derivable may be skipped
+        assert bucket_size in self._to_explore, f'Bucket size {bucket_size} is not left to explore'
+        self._to_explore.remove(bucket_size)
 
         metadata = dict(kwargs)
-        bl = BucketLevel(bucket_size=bucket_size,
-                         metadata=metadata, buckets=buckets)
+        bl = BucketLevel(bucket_size=bucket_size, metadata=metadata, buckets=buckets,
+                         lower_bounds=lower_bounds, data=data, parent_level=self._parent_level(bucket_size))
+
+        self._explored_buckets.update({bucket_size: self._aligned(bl)})
+
+    def stream_levels(self, bucket_sizes):
+        '''Start collecting the buckets of levels whose query results are streamed in chunks
+
+        :returns: A dict of bucket size -> `LevelBuilder`, to add the chunks to
+        '''
+        # Levels left over from a stream that was never finished are incomplete
+        self.cancel_streaming()
+        for bucket_size in bucket_sizes:
+            assert bucket_size in self._to_explore, f'Bucket size {bucket_size} is not left to explore'
+            self._streaming[bucket_size] = LevelBuilder(bucket_size)
+        return dict(self._streaming)
+
+    def partial_level(self, bucket_size):
+        '''The buckets received so far of a level that is being streamed, see `LevelBuilder.partial_level`
+
+        :returns: A `BucketLevel`, or None if the level is not being streamed
+        '''
+        builder = self._streaming.get(bucket_size)
+        return None if builder is None else builder.partial_level()
+
+    def finish_streaming(self, suppressed):
+        '''Insert the streamed levels, largest first, once all their chunks have arrived
+
+        :param suppressed: A dict of bucket size -> the count of its star row
+        '''
+        for bucket_size in sorted(self._streaming.keys(), reverse=True):
+            lower_bounds, data = self._streaming[bucket_size].arrays()
+            self.insert_query_result(bucket_size, lower_bounds=lower_bounds, data=data,
+                                     suppressed=suppressed.get(bucket_size, 0))
+        self._streaming = {}
+
+    def cancel_streaming(self):
+        '''Drop the levels being streamed without inserting them, eg. when their query failed
+        '''
+        self._streaming = {}
+
+    def insert_range_result(self, bucket_size, buckets, value_range, suppressed=0, *, lower_bounds=None, data=None,
+                            **kwargs):
+        '''Insert the result of a bucketed query restricted to a range of values
+
+        The buckets are merged into the level if it has already been explored over other ranges. The
+        level remains in the levels to explore until it has been queried over the whole column.
+
+        :param value_range: The (lo, hi) range the query was restricted to
+        :param suppressed: The count of the star row, interpolated into the gaps within the range
+        :param buckets: A list of `Bucket`s, or None if `lower_bounds` and `data` are passed instead
+        '''
+        lo, hi = value_range
+        if buckets is not None:
+            range_count = sum(bucket.data.count for bucket in buckets) + suppressed
+        else:
+            range_count = np.nansum(np.asarray(data, dtype=np.float64).reshape(
+                -1, len(DATA_COLUMNS))[:, 0]) + suppressed
+        parent_level = FakeLevel(hi - lo, np.array([lo]), np.array([range_count]))
+
+        metadata = dict(kwargs, suppressed=suppressed)
+        bl = BucketLevel(bucket_size=bucket_size, metadata=metadata, buckets=buckets,
+                         lower_bounds=lower_bounds, data=data, parent_level=parent_level, value_range=value_range)
+        bl = self._aligned(bl)
+
+        existing = self.level(bucket_size)
+        if existing is not None:
+            bl = existing.merge(bl)
 
         self._explored_buckets.update({bucket_size: bl})
 
+    def levels_to_zoom(self, value_range, depth):
+        '''The `depth` largest bucket sizes that haven't been explored over value_range yet
+        '''
+        lo, hi = value_range
+        sizes = [size for size in sorted(self._sizes, reverse=True)
+                 if size < hi - lo and (self.level(size) is None or not self.level(size).covers(lo, hi))]
+        return sizes[:depth]
+
+    def select_regions(self, by='count', top=3):
+        '''Pick the buckets that are most worth exploring in more detail.
+
+        :param by: With 'count', pick the buckets with the highest count at the finest completely explored
+            level. With 'synthetic', pick the buckets one level up whose counts at the finest level are
+            mostly interpolated from suppressed data.
+        :param top: The number of buckets to pick.
+        :returns: A list of (lo, hi) ranges, with adjacent buckets merged
+        '''
+        complete = sorted((size for (size, level) in self._explored_buckets.items() if level.is_complete()),
+                          reverse=True)
+        if by == 'count':
+            if len(complete) == 0:
+                raise ValueError('No bucket level has been completely explored yet')
+            level = self._explored_buckets[complete[-1]]
+            scores = level.column('count')
+        elif by == 'synthetic':
+            if len(complete) < 2:
+                raise ValueError(
+                    'Ranking by synthetic share needs two completely explored bucket levels')
+            level = self._explored_buckets[complete[-2]]
+            scores = level.synthetic_share(
+                self._explored_buckets[complete[-1]])
+        else:
+            raise ValueError(f'Unknown region selection {by}')
+
+        picked = np.argsort(-scores, kind='stable')[:top]
+        lower_bounds = level.column('lower_bound')[picked]
+        return bu.merge_ranges((float(lo), float(lo + level.bucket_size)) for lo in lower_bounds)
+
+    def range_count(self, lo, hi):
+        '''Estimate the number of values in lo -> hi from the finest level covering the range
+
+        lo and hi may also be arrays, to answer many queries at once.
+        '''
+        level = self._finest_level(np.min(lo), np.max(hi))
+        count_hi, error_hi, synthetic_hi = level.count_below(hi)
+        count_lo, error_lo, synthetic_lo = level.count_below(lo)
+        suppressed_hi, unplaced = self._suppressed_error(level, hi)
+        suppressed_lo, _ = self._suppressed_error(level, lo)
+        count = count_hi - count_lo
+        # The unplaced values are either in the range or not, they are only counted once
+        error = error_hi + error_lo + suppressed_hi + suppressed_lo - unplaced
+        return Estimate(_scalar(count), _scalar(error), _scalar(_share(synthetic_hi - synthetic_lo, count)))
+
+    def cdf(self, x):
+        '''Estimate the share of values below x from the finest completely explored level
+        '''
+        level = self._finest_level()
+        total = level.total_count()
+        count, error, synthetic = level.count_below(x)
+        error = error + self._suppressed_error(level, x)[0]
+        return Estimate(_scalar(_share(count, total)), _scalar(_share(error, total)),
+                        _scalar(_share(synthetic, count)))
+
+    def quantile(self, q):
+        '''Estimate the q-quantile (0 <= q <= 1) from the finest completely explored level
+        '''
+        level = self._finest_level()
+        total = level.total_count()
+        rank = np.asarray(q, dtype=np.float64) * total
+        value, error, synthetic = level.value_at(rank)
+        # The count below the value is uncertain, so the value may be anywhere between the values at the
+        # lowest and highest possible rank, give or take a bucket
+        count_error, unplaced = self._suppressed_error(level, value)
+        lowest, _, _ = level.value_at(np.maximum(rank - count_error, 0))
+        highest, _, _ = level.value_at(np.minimum(rank + count_error, total))
+        error = np.where(count_error > 0,
+                         np.maximum(error, np.maximum(value - lowest, highest - value) + level.bucket_size), error)
+        # Values that are in no bucket may lie anywhere beyond the explored buckets
+        beyond = (rank - count_error < 0) | (rank + count_error > total)
+        error = np.where((unplaced > 0) & beyond, np.inf, error)
+        return Estimate(_scalar(value), _scalar(error), _scalar(_share(synthetic, rank)))
+
+    def _suppressed_error(self, level, x):
+        '''Bound the error in the count of values below x caused by suppressed values, from the synthetic
+        buckets of the level and of its parent levels, see `Estimate`
+
+        :returns: A tuple of (error bound, count of the suppressed values that are in no bucket at all)
+        '''
+        x = np.asarray(x, dtype=np.float64)
+        error = np.zeros(x.shape)
+        parent = self._parent_level(level.bucket_size)
+        while parent is not None and len(parent) > 0:
+            lower_bounds = parent.column('lower_bound')
+            i = np.clip(np.searchsorted(lower_bounds, x, side='right') - 1, 0, len(parent) - 1)
+            parent_lo = lower_bounds[i]
+            parent_hi = parent_lo + parent.bucket_size
+            if self._calendar:
+                parent_hi = calendar_align(parent.bucket_size, parent_hi)
+
+            # The synthetic counts in the parent bucket containing x may all lie on either side of x
+            synthetic_lo, synthetic_x, synthetic_hi = (level.count_below(bound)[2]
+                                                       for bound in [parent_lo, x, parent_hi])
+            below = synthetic_x - synthetic_lo
+            above = synthetic_hi - synthetic_x
+            error += np.where((parent_lo < x) & (x < parent_hi), np.maximum(below, above), 0.0)
+
+            level, parent = parent, self._parent_level(parent.bucket_size)
+
+        # The star row of the coarsest level has no parent to be interpolated into
+        unplaced = level.metadata.get('suppressed', 0)
+        return error + unplaced, unplaced
+
     def get_bucket(self, bucket):
         result = None
-        level = self.buckets_at_level(bucket.size)
+        level = self.level(bucket.size)
         if level is not None:
-            result = level.get_bucket(bucket)
+            result = level.get_bucket(bucket.size, bucket.lower_bound)
 
         return result
 
+    def buckets_in_range(self, bucket_size, range_lo, range_hi):
+        '''The buckets of a level whose lower bounds lie in range_lo -> range_hi, found by binary search
+        '''
+        level = self.level(bucket_size)
+        if level is None:
+            return iter([])
+        return level.buckets_in_range(range_lo, range_hi)
+
+    def parent(self, bucket, parent_size=None):
+        '''The bucket containing `bucket` at a larger bucket size
+
+        :param parent_size: By default, the next larger explored bucket size that divides into `bucket.size`
+        :returns: A `BucketView`, or None if the parent level hasn't been explored at that bucket
+        '''
+        if parent_size is None:
+            parent_sizes = [size for size in self._explored_buckets
+                            if size > bucket.size and self._nests(bucket.size, size)]
+            if len(parent_sizes) == 0:
+                return None
+            parent_size = min(parent_sizes)
+
+        if self._calendar:
+            # Calendar buckets are not multiples of their size, take the last one starting at or before
+            # the bucket instead
+            level = self.level(parent_size)
+            if level is None:
+                return None
+            i = int(np.searchsorted(level.column('lower_bound'), bucket.lower_bound, side='right')) - 1
+            return BucketView(level, i) if i >= 0 else None
+
+        return self.get_bucket(Bucket(*bucket.parent_index(parent_size), None))
+
+    def children(self, bucket, child_size=None):
+        '''The buckets contained in `bucket` at a smaller bucket size
+
+        :param child_size: By default, the next smaller explored bucket size that divides `bucket.size`
+        :returns: An iterator of `BucketView`s
+        '''
+        if child_size is None:
+            child_sizes = [size for size in self._explored_buckets
+                           if size < bucket.size and self._nests(size, bucket.size)]
+            if len(child_sizes) == 0:
+                return iter([])
+            child_size = max(child_sizes)
+
+        upper_bound = bucket.upper_bound()
+        if self._calendar:
+            # The bucket ends where the next one starts on the calendar
+            upper_bound = float(calendar_align(bucket.size, upper_bound))
+
+        # Search half a child bucket early, so lower bounds off by floating point noise are included
+        # at the start of the range and excluded at the end
+        return self.buckets_in_range(child_size, bucket.lower_bound - child_size / 2,
+                                     upper_bound - child_size / 2)
+
     def get_buckets(self, levels):
         if len(levels) == 0:
             levels = self.bucket_levels()
         return [bucket for level in levels for bucket in self.buckets_at_level(level)]
 
+    def get_columns(self, levels):
+        '''Export the buckets of several levels as one array per column.
+
+        The arrays of a single level are returned without copying, several levels are concatenated once
+        per column.
+
+        :param levels: A list of bucket sizes, or a slice over the explored bucket sizes ordered from
+            largest to smallest (eg. `slice(-2, None)` for the two finest levels). An empty list selects
+            all levels.
+        :returns: A dict of arrays keyed by 'bucket_size', 'lower_bound', 'synthetic' and DATA_COLUMNS
+        '''
+        if isinstance(levels, slice):
+            levels = sorted(self.bucket_levels(), reverse=True)[levels]
+        elif len(levels) == 0:
+            levels = self.bucket_levels()
+
+        with instrumentation.timed('tree.export') as timer:
+            level_columns = [self._explored_buckets[level].columns()
+                             for level in levels]
+            if len(level_columns) == 1:
+                result = level_columns[0]
+            else:
+                result = {name: np.concatenate([columns[name] for columns in level_columns])
+                          for name in EXPORT_COLUMNS}
+            timer.add(buckets=len(result['lower_bound']))
+
+        return result
+
+    def _finest_level(self, lo=None, hi=None):
+        '''The level with the smallest bucket size that covers lo -> hi, or the whole column if no range is given
+        '''
+        for bucket_size in sorted(self._explored_buckets.keys()):
+            level = self._explored_buckets[bucket_size]
+            if level.is_complete() or (lo is not None and level.covers(lo, hi)):
+                return level
+        raise ValueError('No explored bucket level covers ' +
+                         ('the whole column' if lo is None else f'the range {lo} -> {hi}'))
+
+    def _value_span(self, value_range):
+        '''The aligned range that split queries cover, containing all values from min to max. Explored levels
+        can't be used instead, values in suppressed buckets outside their buckets would be left out.
+        '''
+        if self._calendar or value_range is None:
+            # Levels of calendar units are not split, ranges of dates can't be aligned like numeric ones
+            return None
+        lo, hi = value_range
+        if lo is None or hi is None:
+            return None
+        # Range conditions exclude their upper bound, the span must end above the largest value
+        return bu.aligned_range(float(lo), float(np.nextafter(hi, np.inf)))
+
+    def _parent_level(self, bucket_size):
+        '''The smallest completely explored level whose buckets divide exactly into buckets of `bucket_size`
+        '''
+        parent_sizes = [size for (size, level) in self._explored_buckets.items()
+                        if size > bucket_size and self._nests(bucket_size, size) and level.is_complete()]
+        if len(parent_sizes) == 0:
+            return None
+        return self._explored_buckets[min(parent_sizes)]
+
+    def _divides(self, small_size, large_size):
+        '''Whether buckets of large_size can be rolled up from buckets of small_size
+        '''
+        if self._calendar:
+            return bu.calendar_divides(small_size, large_size)
+        return bu.divides(small_size, large_size)
+
+    def _nests(self, small_size, large_size):
+        '''Whether every bucket of large_size is made of whole buckets of small_size. Smaller calendar units
+        always nest in larger ones, though eg. days can't be rolled up into months on a grid.
+        '''
+        if self._calendar:
+            return small_size < large_size
+        return bu.divides(small_size, large_size)
+
+    def _aligned(self, level):
+        '''The level with its lower bounds moved to calendar boundaries, if it's a calendar unit of varying
+        length, see `calendar_align`
+        '''
+        if not self._calendar or bu.calendar_unit(level.bucket_size) not in bu.MONTHS_PER_UNIT:
+            return level
+
+        columns = level.columns()
+        lower_bounds = calendar_align(level.bucket_size, columns['lower_bound'])
+        if np.array_equal(lower_bounds, columns['lower_bound']):
+            return level
+        columns['lower_bound'] = lower_bounds
+        return BucketLevel.from_columns(bucket_size=level.bucket_size, columns=columns,
+                                        metadata=level.metadata, covered=level.covered)
+
 
 class BucketLevel:
     '''Container class for buckets of the same size
+
+    Buckets are stored column-wise, sorted by lower bound: one array for the lower bounds, one per
+    `DATA_COLUMNS` entry, and a flag marking synthetic buckets. Iterating or looking up buckets
+    returns `BucketView`s onto these arrays.
+
+    A level may only cover some ranges of the column's values, if it was explored by zooming in.
     '''
 
-    def __init__(self, *, bucket_size, buckets, metadata=None, parent_level=None):
+    def __init__(self, *, bucket_size, buckets=None, metadata=None, parent_level=None, lower_bounds=None, data=None,
+                 value_range=None):
         '''
         :param bucket_size: The bucket size at this level
         :param metadata: Metadata associated with this bucket level
-        :param buckets: Should be a list of `Bucket`s
-        :param parent: If the parent is not provided, fill in gaps between buckets
-            with empty buckets (count = 0), otherwise interpolate missing buckets.
+        :param buckets: Should be a list of `Bucket`s. Alternatively, pass `lower_bounds` and `data`.
+        :param lower_bounds: An array of bucket lower bounds.
+        :param data: An array of shape (len(lower_bounds), len(DATA_COLUMNS)) holding the bucket values.
+        :param parent: A `BucketLevel` of a larger bucket size. If the parent is not provided, fill in
+            gaps between buckets with empty buckets (count = 0), otherwise interpolate missing buckets.
+        :param value_range: The (lo, hi) range covered by the buckets, or None if they cover the whole column.
         '''
         self._bucket_size = bucket_size
-        self._metadata = metadata
+        self._metadata = metadata if metadata is not None else {}
+        self._covered = None if value_range is None else [tuple(value_range)]
+
+        if buckets is not None:
+            lower_bounds = [bucket.lower_bound for bucket in buckets]
+            data = [tuple(bucket.data) for bucket in buckets]
+
+        lower_bounds = np.asarray(lower_bounds, dtype=np.float64)
+        data = np.asarray(data, dtype=np.float64).reshape(
+            len(lower_bounds), len(DATA_COLUMNS))
+
+        order = np.argsort(lower_bounds, kind='stable')
+        lower_bounds, data = lower_bounds[order], data[order]
+
         if parent_level is None:
-            fake_lo = min(bucket.lower_bound for bucket in buckets)
-            fake_hi = max(bucket.upper_bound() for bucket in buckets)
-            fake_count = sum(bucket.data.count for bucket in buckets)
-            parent_level = [
-                Bucket(fake_hi - fake_lo, fake_lo, [fake_count, fake_lo, fake_hi], FakeData)]
-
-        interpolated = []
-        bucket_iter = iter(buckets)
-        for parent_bucket in parent_level:
-            children = list(
-                takewhile(lambda small: parent_bucket.contains(small), bucket_iter))
-            interpolated += parent_bucket.interpolate_children(children)
-
-        self._buckets = dict([(bucket.lower_bound, bucket)
-                              for bucket in interpolated])
+            parent_level = fake_parent(bucket_size, lower_bounds, data)
+
+        with instrumentation.timed('level.interpolate') as timer:
+            self._set_columns(interpolate(
+                bucket_size, lower_bounds, data, parent_level))
+            timer.add(buckets=len(self))
+
+    @classmethod
+    def from_columns(cls, *, bucket_size, columns, metadata=None, covered=None):
+        '''Create a level from already interpolated columns, as returned by `columns`
+
+        :param columns: A dict with arrays for 'lower_bound', 'synthetic' and DATA_COLUMNS, sorted by lower bound
+        :param covered: The list of (lo, hi) ranges covered by the level, or None if it is complete
+        '''
+        level = cls.__new__(cls)
+        level._bucket_size = bucket_size
+        level._metadata = dict(metadata) if metadata is not None else {}
+        level._covered = None if covered is None else [tuple(r) for r in covered]
+        level._set_columns({name: columns[name]
+                            for name in ['lower_bound', *DATA_COLUMNS, 'synthetic']})
+        return level
+
+    @property
+    def bucket_size(self):
+        return self._bucket_size
+
+    @property
+    def metadata(self):
+        return self._metadata
+
+    @property
+    def covered(self):
+        '''The list of (lo, hi) ranges covered by the level, or None if it is complete
+        '''
+        return None if self._covered is None else list(self._covered)
+
+    def column(self, name):
+        '''The array holding `name` (one of 'lower_bound', 'synthetic' or DATA_COLUMNS) for all buckets
+        '''
+        return self._columns[name]
+
+    def columns(self):
+        '''All columns of this level keyed by EXPORT_COLUMNS, without copying the underlying arrays
+        '''
+        bucket_sizes = np.broadcast_to(np.float64(self._bucket_size), len(self))
+        return {name: bucket_sizes if name == 'bucket_size' else self._columns[name]
+                for name in EXPORT_COLUMNS}
 
     def get_bucket(self, bucket_size, lower_bound):
         if bucket_size != self._bucket_size:
             return None
 
-        return self._buckets.get(lower_bound)
+        i = self._find(lower_bound)
+        return None if i is None else BucketView(self, i)
 
     def buckets_in_range(self, range_lo, range_hi):
-        return (bucket for (lower_bound, bucket) in self._buckets
-                if lower_bound >= range_lo and lower_bound < range_hi)
+        '''The buckets with range_lo <= lower bound < range_hi
+        '''
+        lower_bounds = self._columns['lower_bound']
+        start, stop = np.searchsorted(lower_bounds, [range_lo, range_hi])
+        return (BucketView(self, i) for i in range(start, stop))
 
     def add_metadata(self, metadata):
         self._metadata.update(metadata)
 
+    def is_complete(self):
+        '''Whether the level covers all values of the column
+        '''
+        return self._covered is None
+
+    def covers(self, range_lo, range_hi):
+        if self._covered is None:
+            return True
+        return any(lo <= range_lo and range_hi <= hi for (lo, hi) in self._covered)
+
+    def merge(self, other):
+        '''A new level with the buckets of `other` replacing this level's buckets within the ranges
+        covered by `other`
+        '''
+        assert self._bucket_size == other.bucket_size, \
+            f'Can not merge buckets of size {other.bucket_size} into a level of size {self._bucket_size}'
+        if other.is_complete():
+            return other
+
+        lower_bounds = self._columns['lower_bound']
+        keep = np.ones(len(self), dtype=bool)
+        for (lo, hi) in other._covered:
+            start, stop = np.searchsorted(lower_bounds, [lo, hi])
+            keep[start:stop] = False
+
+        merged_columns = {name: np.concatenate([column[keep], other.column(name)])
+                          for (name, column) in self._columns.items()}
+        order = np.argsort(merged_columns['lower_bound'], kind='stable')
+
+        return BucketLevel.from_columns(
+            bucket_size=self._bucket_size,
+            columns={name: column[order]
+                     for (name, column) in merged_columns.items()},
+            metadata=self._metadata,
+            covered=None if self._covered is None else bu.merge_ranges(self._covered + other._covered))
+
+    def synthetic_share(self, child_level):
+        '''For each bucket, the share of its count that is carried by synthetic buckets of child_level
+        '''
+        lower_bounds = self._columns['lower_bound']
+        parent_index = np.searchsorted(lower_bounds, child_level.column(
+            'lower_bound') + child_level.bucket_size / 2, side='right') - 1
+        valid = parent_index >= 0
+        child_counts = np.nan_to_num(child_level.column('count'))[valid]
+        synthetic = child_level.column('synthetic')[valid]
+        total = np.bincount(parent_index[valid], weights=child_counts, minlength=len(self))
+        synthetic_total = np.bincount(
+            parent_index[valid], weights=child_counts * synthetic, minlength=len(self))
+        return np.divide(synthetic_total, total, out=np.zeros(len(self)), where=total > 0)
+
     def as_flat_list(self):
-        return [bucket.flatten() for bucket in self._buckets.values()]
+        columns = [self._columns[name] for name in ['lower_bound', *DATA_COLUMNS]]
+        sizes = np.full(len(self), self._bucket_size)
+        return np.column_stack([sizes, *columns]).tolist()
+
+    def __len__(self):
+        return len(self._columns['lower_bound'])
 
     def __iter__(self):
-        return self._buckets.values()
+        return (BucketView(self, i) for i in range(len(self)))
+
+    def total_count(self):
+        return self._prefix_sums()[0][-1]
+
+    def synthetic_fraction(self):
+        '''The share of the level's total count that is carried by synthetic buckets
+        '''
+        prefix, synthetic_prefix = self._prefix_sums()
+        return float(synthetic_prefix[-1] / prefix[-1]) if prefix[-1] > 0 else 0.0
+
+    def count_below(self, x):
+        '''Estimate the count of values below x, assuming values are spread evenly within each bucket.
+        Answered in O(log n) from prefix sums of the counts, and vectorised over arrays of x.
+
+        :returns: A tuple of (count, error bound, count of synthetic buckets below x)
+        '''
+        x = np.asarray(x, dtype=np.float64)
+        if len(self) == 0:
+            return np.zeros_like(x), np.zeros_like(x), np.zeros_like(x)
+
+        prefix, synthetic_prefix = self._prefix_sums()
+        lower_bounds = self._columns['lower_bound']
+        i = np.clip(np.searchsorted(lower_bounds, x, side='right') - 1, 0, len(self) - 1)
+        fraction = np.clip((x - lower_bounds[i]) / self._bucket_size, 0, 1)
+
+        bucket_count = prefix[i + 1] - prefix[i]
+        count = prefix[i] + fraction * bucket_count
+        synthetic = synthetic_prefix[i] + fraction * \
+            (synthetic_prefix[i + 1] - synthetic_prefix[i])
+        # The values of the bucket containing x may all lie on either side of it
+        error = np.where((fraction > 0) & (fraction < 1),
+                         np.maximum(fraction, 1 - fraction) * bucket_count, 0.0)
+        return count, error, synthetic
+
+    def value_at(self, rank):
+        '''Estimate the value with `rank` values below it, the inverse of `count_below`
+
+        :returns: A tuple of (value, error bound, count of synthetic buckets below the value)
+        '''
+        rank = np.asarray(rank, dtype=np.float64)
+        if len(self) == 0:
+            raise ValueError(f'Bucket level {self._bucket_size} has no buckets')
+
+        prefix, synthetic_prefix = self._prefix_sums()
+        lower_bounds = self._columns['lower_bound']
+        # Skip buckets without values: pick the first bucket whose cumulative count reaches the rank,
+        # or for rank 0 the first bucket with any values
+        i = np.where(rank > 0, np.searchsorted(prefix, rank, side='left'),
+                     np.searchsorted(prefix, rank, side='right')) - 1
+        i = np.clip(i, 0, len(self) - 1)
+        bucket_count = prefix[i + 1] - prefix[i]
+        fraction = np.clip(_share(rank - prefix[i], bucket_count), 0, 1)
+
+        value = lower_bounds[i] + fraction * self._bucket_size
+        error = np.maximum(fraction, 1 - fraction) * self._bucket_size
+        synthetic = synthetic_prefix[i] + fraction * \
+            (synthetic_prefix[i + 1] - synthetic_prefix[i])
+        return value, error, synthetic
+
+    def _prefix_sums(self):
+        '''Cumulative counts of all buckets and of synthetic buckets, each starting with 0.
+        Computed on first use, the columns of a level never change.
+        '''
+        # The level store may drop the cached sums from another thread at any time, so only read them once
+        prefix = self._prefix
+        if prefix is None:
+            columns = self._columns
+            counts = np.nan_to_num(columns['count'])
+            synthetic_counts = np.where(columns['synthetic'], counts, 0.0)
+            prefix = (np.concatenate([[0.0], np.cumsum(counts)]),
+                      np.concatenate([[0.0], np.cumsum(synthetic_counts)]))
+            self._prefix = prefix
+        return prefix
+
+    @property
+    def _columns(self):
+        '''The column arrays, reloaded from the spill file if the level store has spilled them
+        '''
+        columns = self._resident_columns
+        if self._store is None:
+            return columns
+        if columns is None:
+            return self._reload()
+        self._store.touch(self)
+        return columns
+
+    def _set_columns(self, columns):
+        self._prefix = None
+        self._spill_file = None
+        self._resident_columns = columns
+        # The arrays are shared with exported columns, so they must not be modified in place
+        for column in columns.values():
+            column.flags.writeable = False
+
+        # Memory-mapped columns (eg. of a snapshot) are paged in and out by the OS already, spilling them
+        # would only copy them to disk again
+        self._store = None if any(_is_mapped(column) for column in columns.values()) else level_store.get_store()
+        if self._store is not None:
+            self._store.add(self, _nbytes(columns))
+
+    def _spill(self, store):
+        '''Drop the columns from memory. They are written to a spill file the first time.
+        '''
+        if self._spill_file is None:
+            path = store.spill_path()
+            np.savez(path, **self._resident_columns)
+            self._spill_file = path
+            weakref.finalize(self, level_store.remove_file, path)
+        self._resident_columns = None
+        self._prefix = None
+
+    def _reload(self):
+        with np.load(self._spill_file) as spilled:
+            columns = {name: spilled[name] for name in spilled.files}
+        for column in columns.values():
+            column.flags.writeable = False
+        self._resident_columns = columns
+        self._store.add(self, _nbytes(columns), reloaded=True)
+        return columns
+
+    def _find(self, lower_bound):
+        '''Index of the bucket with the given lower bound, or None
+        '''
+        lower_bounds = self._columns['lower_bound']
+        # Lower bounds are multiples of the bucket size, anything closer than half a bucket is a match
+        i = int(lower_bounds.searchsorted(lower_bound - self._bucket_size / 2))
+        if i < len(lower_bounds) and abs(lower_bounds[i] - lower_bound) < self._bucket_size / 2:
+            return i
+        return None
+
+
+class LevelBuilder:
+    '''Collects the buckets of a level as its query result is streamed in chunks.
+
+    Chunks are kept as arrays, so memory grows with the number of buckets rather than with the size of
+    the raw rows. Chunks may be added from one thread while `partial_level` is read from another.
+    '''
+
+    def __init__(self, bucket_size):
+        self.bucket_size = bucket_size
+        self._lock = threading.Lock()
+        self._lower_bounds = []
+        self._data = []
+        self._partial = None
+
+    def add(self, lower_bounds, data):
+        '''
+        :param lower_bounds: An array of bucket lower bounds
+        :param data: An array of shape (len(lower_bounds), len(DATA_COLUMNS))
+        '''
+        with self._lock:
+            self._lower_bounds.append(lower_bounds)
+            self._data.append(data)
+            self._partial = None
+
+    def arrays(self):
+        '''The (lower bounds, data) received so far
+        '''
+        with self._lock:
+            if len(self._lower_bounds) == 0:
+                return np.empty(0), np.empty((0, len(DATA_COLUMNS)))
+            return np.concatenate(self._lower_bounds), np.concatenate(self._data)
+
+    def partial_level(self):
+        '''The buckets received so far as a `BucketLevel`, without interpolation.
+
+        The level covers no range and is marked 'partial' in its metadata, so it is never taken for a
+        completely explored level.
+        '''
+        partial = self._partial
+        if partial is None:
+            lower_bounds, data = self.arrays()
+            order = np.argsort(lower_bounds, kind='stable')
+            columns = {name: data[order, i] for (i, name) in enumerate(DATA_COLUMNS)}
+            columns['lower_bound'] = lower_bounds[order]
+            columns['synthetic'] = np.zeros(len(lower_bounds), dtype=bool)
+            partial = BucketLevel.from_columns(bucket_size=self.bucket_size, columns=columns,
+                                               metadata={'partial': True}, covered=[])
+            self._partial = partial
+        return partial
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(lower_bounds) for lower_bounds in self._lower_bounds)
+
+
+def roll_up(level, bucket_size):
+    '''Aggregate a complete level into buckets of a larger size that it divides into.
+
+    Counts are summed, min and max are taken over the measured buckets and avg is recomputed as the
+    count-weighted mean. count_noise is combined as for a sum of independent noise. A bucket is synthetic
+    if any of its buckets with values is synthetic.
+    '''
+    fine_size = level.bucket_size
+    assert bu.divides(fine_size, bucket_size), \
+        f'Bucket size {fine_size} does not divide into {bucket_size}'
+    metadata = {'derived_from': fine_size}
+    if len(level) == 0:
+        return BucketLevel(bucket_size=bucket_size, metadata=metadata, lower_bounds=[], data=[])
+
+    # Group on an integer grid, lower bounds may not be exact multiples of the bucket size
+    grid = np.rint(level.column('lower_bound') / fine_size).astype(np.int64)
+    parents = np.floor_divide(grid, int(round(bucket_size / fine_size)))
+    starts = np.flatnonzero(np.diff(parents, prepend=parents[0] - 1))
+
+    counts = np.nan_to_num(level.column('count'))
+    noise = level.column('count_noise')
+    avg = level.column('avg')
+    measured_avg = ~np.isnan(avg)
+    weights = np.add.reduceat(np.where(measured_avg, counts, 0.0), starts)
+    measured_noise = np.add.reduceat(~np.isnan(noise), starts) > 0
+
+    columns = {
+        'lower_bound': grid_values(parents[starts], bucket_size),
+        'count': np.add.reduceat(counts, starts),
+        'count_noise': np.where(measured_noise, np.sqrt(np.add.reduceat(np.nan_to_num(noise) ** 2, starts)),
+                                np.nan),
+        'min': np.fmin.reduceat(level.column('min'), starts),
+        'max': np.fmax.reduceat(level.column('max'), starts),
+        'avg': np.divide(np.add.reduceat(np.where(measured_avg, avg * counts, 0.0), starts), weights,
+                         out=np.full(len(starts), np.nan), where=weights > 0),
+        'synthetic': np.logical_or.reduceat(level.column('synthetic') & (counts > 0), starts),
+    }
+    return BucketLevel.from_columns(bucket_size=bucket_size, columns=columns, metadata=metadata)
+
+
+def calendar_align(bucket_size, lower_bounds):
+    '''Move the lower bounds of a calendar unit of varying length to the start of the unit they fall in.
+
+    Buckets of years, quarters and months that are computed rather than queried (synthetic or rolled up)
+    are spaced by the average length of the unit, so they may be a few days off the calendar. Each one is
+    moved to the start of the unit containing its middle. Lower bounds of other units are returned as they are.
+
+    :param lower_bounds: Lower bounds in seconds since the Unix epoch (UTC)
+    '''
+    lower_bounds = np.asarray(lower_bounds, dtype=np.float64)
+    months = bu.MONTHS_PER_UNIT.get(bu.calendar_unit(bucket_size))
+    if months is None:
+        return lower_bounds
+
+    middle = np.floor(lower_bounds + bucket_size / 2).astype(np.int64).astype('datetime64[s]')
+    month_index = middle.astype('datetime64[M]').astype(np.int64)
+    start = (month_index - month_index % months).astype('datetime64[M]')
+    return start.astype('datetime64[s]').astype(np.int64).astype(np.float64)
+
+
+def _nbytes(columns):
+    return sum(column.nbytes for column in columns.values())
+
+
+def _is_mapped(array):
+    '''Whether an array is a memory-map or a view of one
+    '''
+    while isinstance(array, np.ndarray):
+        if isinstance(array, np.memmap):
+            return True
+        array = array.base
+    return False
+
+
+def _share(part, total):
+    part, total = np.broadcast_arrays(np.asarray(part, dtype=np.float64), np.asarray(total, dtype=np.float64))
+    return np.divide(part, total, out=np.zeros(part.shape), where=total > 0)
+
+
+def _scalar(value):
+    return value.item() if np.ndim(value) == 0 else value
+
+
+def to_json(value):
+    '''Convert NumPy scalars, tuples and dates to plain Python values that can be serialised to JSON
+    '''
+    if isinstance(value, (tuple, list)):
+        return [to_json(v) for v in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return value
+
+
+def fake_parent(bucket_size, lower_bounds, data):
+    '''A single parent spanning all the buckets, with no counts missing from its children
+    '''
+    if len(lower_bounds) == 0:
+        return FakeLevel(bucket_size, np.empty(0), np.empty(0))
+    fake_lo = lower_bounds[0]
+    # Count the buckets on a grid, lower bounds of calendar units are not exact multiples of their size
+    num_buckets = int(np.rint((lower_bounds[-1] - fake_lo) / bucket_size)) + 1
+    fake_count = np.nansum(data[:, 0])
+    return FakeLevel(num_buckets * bucket_size, np.array([fake_lo]), np.array([fake_count]))
+
+
+FakeLevel = namedtuple('FakeLevel', 'bucket_size lower_bounds counts')
+
+
+def interpolate(bucket_size, lower_bounds, data, parent_level):
+    '''Fill the gaps between buckets using the counts of their parents.
+
+    Every parent bucket is split into its expected children. Children that were returned by the
+    query keep their data, the missing ones become synthetic buckets sharing the part of the
+    parent's count not accounted for by its returned children.
+
+    All buckets are placed by their position on the integer grid of bucket_size, so children are aligned
+    to their parents in one pass over the sorted lower bounds and the gaps are filled with array
+    arithmetic. Lower bounds are computed from the grid with `grid_values`, so they don't drift for sizes
+    like 0.01.
+
+    :param lower_bounds: Sorted lower bounds of the returned buckets.
+    :param data: The DATA_COLUMNS values of the returned buckets.
+    :param parent_level: A `BucketLevel` or `FakeLevel` of a larger bucket size.
+    :returns: A dict of columns for the interpolated level.
+    '''
+    if isinstance(parent_level, BucketLevel):
+        parent_size = parent_level.bucket_size
+        parent_lower_bounds = parent_level.column('lower_bound')
+        parent_counts = parent_level.column('count')
+    else:
+        parent_size, parent_lower_bounds, parent_counts = parent_level
+
+    assert bu.divides(bucket_size, parent_size) or bu.calendar_unit(parent_size) in bu.MONTHS_PER_UNIT, \
+        f'Bucket {parent_size} does not divide exactly into buckets of size {bucket_size}'
+    num_parents = len(parent_lower_bounds)
+    # Calendar units of varying length hold a varying number of children, eg. days in a month
+    parent_upper_bounds = calendar_align(parent_size, parent_lower_bounds + parent_size)
+    num_children = np.rint((parent_upper_bounds - parent_lower_bounds) / bucket_size).astype(np.int64)
+    first_child = np.concatenate([[0], np.cumsum(num_children)[:-1]]).astype(np.int64)
+
+    parent_position = np.rint(parent_lower_bounds / bucket_size).astype(np.int64)
+    position = np.rint(lower_bounds / bucket_size).astype(np.int64)
+
+    # Locate the slot of every returned bucket within its parent
+    parent_index = np.searchsorted(parent_position, position, side='right') - 1
+    slot = position - parent_position[np.maximum(parent_index, 0)]
+    contained = (parent_index >= 0) & (slot < num_children[np.maximum(parent_index, 0)])
+    parent_index, slot = parent_index[contained], slot[contained]
+
+    # Distribute the counts missing from each parent evenly over its missing children
+    child_counts = np.nan_to_num(data[contained, 0])
+    provided_counts = np.bincount(parent_index, weights=child_counts, minlength=num_parents)
+    provided_num = np.bincount(parent_index, minlength=num_parents)
+    missing_num = num_children - provided_num
+    missing_total = np.maximum(parent_counts - provided_counts, 0)
+    count_per_bucket = np.divide(missing_total, missing_num, out=np.zeros(num_parents),
+                                 where=missing_num > 0)
+
+    grid_parent = np.repeat(np.arange(num_parents), num_children)
+    grid_position = parent_position[grid_parent] + np.arange(len(grid_parent)) - first_child[grid_parent]
+    grid_index = first_child[parent_index] + slot
+
+    columns = {name: np.full(len(grid_parent), np.nan) for name in DATA_COLUMNS}
+    columns['count'] = count_per_bucket[grid_parent]
+    for (i, name) in enumerate(DATA_COLUMNS):
+        columns[name][grid_index] = data[contained, i]
+    synthetic = np.ones(len(grid_parent), dtype=bool)
+    synthetic[grid_index] = False
+
+    # Buckets outside of all parents are kept as they are, inserted at their place on the grid
+    if not np.all(contained):
+        outside = ~contained
+        at = np.searchsorted(grid_position, position[outside])
+        grid_position = np.insert(grid_position, at, position[outside])
+        synthetic = np.insert(synthetic, at, False)
+        for (i, name) in enumerate(DATA_COLUMNS):
+            columns[name] = np.insert(columns[name], at, data[outside, i])
+
+    return {'lower_bound': grid_values(grid_position, bucket_size), 'synthetic': synthetic, **columns}
+
+
+def grid_values(position, bucket_size):
+    '''The lower bounds of the buckets at integer positions on the grid of bucket_size
+
+    Bucket sizes below 1 are of the form 1 / n (see `bucket_util.BUCKETS`), so the lower bounds are computed
+    by dividing by n, which gives the float nearest to the exact value: 3 / 10 is 0.3, while 3 * 0.1 is
+    0.30000000000000004.
+    '''
+    divisor = 1 / bucket_size
+    if bucket_size < 1 and abs(divisor - round(divisor)) < 1e-9 * divisor:
+        return position / round(divisor)
+    return position * float(bucket_size)
 
 
 QueryData = namedtuple('QueryData', 'count count_noise min max avg')
@@ -151,12 +1174,16 @@ class Bucket:
         return self.lower_bound <= other.lower_bound and self.upper_bound() >= other.upper_bound()
 
     def parent_index(self, parent_size):
-        # TODO: add some assertions / restrictions regarding buckets sizes
-        return (parent_size, (self.lower_bound // parent_size) * parent_size)
+        assert bu.divides(self.size, parent_size), \
+            f'Bucket {parent_size} does not divide exactly into buckets of size {self.size}'
+        # round away floating point noise, eg. 0.3 // 0.1 = 2.0
+        return (parent_size, round(math.floor(round(self.lower_bound / parent_size, 9)) * parent_size, 9))
 
     def child_indices(self, child_size):
-        # TODO: add some assertions / restrictions regarding buckets sizes
-        return [(child_size, i) for i in range(self.lower_bound, self.lower_bound + self.size, child_size)]
+        assert bu.divides(child_size, self.size), \
+            f'Bucket {self.size} does not divide exactly into buckets of size {child_size}'
+        num_children = int(round(self.size / child_size))
+        return [(child_size, round(self.lower_bound + i * child_size, 9)) for i in range(num_children)]
 
     def flatten(self):
         return [self.size, self.lower_bound, *self.data]
@@ -168,37 +1195,40 @@ class Bucket:
             raise ValueError(
                 "Can't split a bucket into a larger bucket size")
 
-        if self.size % smaller_size != 0:
+        if not bu.divides(smaller_size, self.size):
             # return None to signal that the desired bucket size doesn't fit
             return None
 
-        return [Bucket(*index) for index in self.child_indices(smaller_size)]
+        return [Bucket(*index, None) for index in self.child_indices(smaller_size)]
 
     def interpolate_children(self, small_buckets):
-        '''Interpolate gaps in small buckets from a larger one.
+        '''Interpolate gaps in small buckets from a larger one, see `interpolate`
+
+        :returns: `BucketView`s of all the children of this bucket, sorted by lower bound
         '''
-        small_bucket_size = small_buckets[0].size
-        assert self.size % small_bucket_size == 0, f'Bucket {self.size} does not divide exactly into buckets of size {small_bucket_size}'
+        parent = FakeLevel(self.size, np.array([self.lower_bound]), np.array([self.data.count]))
+        return list(BucketLevel(bucket_size=small_buckets[0].size, buckets=small_buckets, parent_level=parent))
 
-        small_buckets_expected_num = int(self.size // small_bucket_size)
-        if small_buckets_expected_num == len(small_buckets):
-            return small_buckets
 
-        expected_lower_bounds = [self.lower_bound + i * small_bucket_size
-                                 for i in range(small_buckets_expected_num)]
-        provided_lower_bounds = [
-            bucket.lower_bound for bucket in small_buckets]
+class BucketView(Bucket):
+    '''Read-only view of a bucket stored in a `BucketLevel`
+    '''
 
-        missing_lower_bounds = set(expected_lower_bounds) - \
-            set(provided_lower_bounds)
+    def __init__(self, level, index):
+        self._level = level
+        self._index = index
 
-        missing_total = self.data.count - \
-            sum(bucket.data.count for bucket in small_buckets)
-        count_per_bucket = missing_total / len(missing_lower_bounds)
+    @property
+    def size(self):
+        return self._level.bucket_size
 
-        synthetic_buckets = [Bucket(small_bucket_size, lower_bound, [count_per_bucket], data_wrapper=SyntheticData)
-                             for lower_bound in missing_lower_bounds]
+    @property
+    def lower_bound(self):
+        return float(self._level.column('lower_bound')[self._index])
 
-        small_buckets += synthetic_buckets
-        small_buckets.sort(key=lambda bucket: bucket.lower_bound)
-        return small_buckets
+    @property
+    def data(self):
+        count = float(self._level.column('count')[self._index])
+        if self._level.column('synthetic')[self._index]:
+            return SyntheticData(count)
+        return QueryData(count, *(float(self._level.column(name)[self._index]) for name in DATA_COLUMNS[1:]))
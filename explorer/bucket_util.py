@@ -1,4 +1,6 @@
 import logging
+import math
+from collections import namedtuple
 
 # assume for now that we want at least 20 values per bucket (valid?)
 # also that the smallest useful bucket size is at 1/100 of the total range
@@ -19,6 +21,48 @@ Bucket number: 20
 BUCKETS = sorted([base * (10 ** exponent)
                   for base in [1, 2, 5] for exponent in range(-4, 20)])
 
+'''CALENDAR_UNITS are the units of date_trunc used to bucket date/time columns, with their length in
+seconds. Years, quarters and months vary in length: their length here is the average over the 400 year
+Gregorian cycle, and their buckets start at calendar boundaries rather than at multiples of it.
+MONTHS_PER_UNIT gives the number of months in each of those units.
+'''
+CALENDAR_UNITS = {
+    'year': 31_556_952,
+    'quarter': 7_889_238,
+    'month': 2_629_746,
+    'day': 86_400,
+    'hour': 3_600,
+    'minute': 60,
+    'second': 1,
+}
+MONTHS_PER_UNIT = {'year': 12, 'quarter': 3, 'month': 1}
+
+'''Cost model for planning bucketed queries:
+The cloak never reports buckets with fewer than MIN_VISIBLE_COUNT values. A round-trip costs QUERY_LATENCY
+seconds plus ROW_LATENCY seconds per returned row, and each row carries BYTES_PER_VALUE bytes per column:
+one per bucket size in the query plus STATS_COLUMNS.
+Buckets expected to hold at least MIN_EXACT_COUNT values are expected not to be suppressed.
+'''
+MIN_VISIBLE_COUNT = 2
+MIN_EXACT_COUNT = 20
+QUERY_LATENCY = 1.0
+ROW_LATENCY = 2e-5
+BYTES_PER_VALUE = 8
+STATS_COLUMNS = 5
+
+'''QueryBudget limits the estimated size of each bucketed query. Any of the limits can be None.
+max_rows: The maximum number of result rows
+max_bytes: The maximum size of the result
+latency_target: The maximum time in seconds a query should take according to the cost model
+'''
+QueryBudget = namedtuple('QueryBudget', 'max_rows max_bytes latency_target')
+DEFAULT_BUDGET = QueryBudget(max_rows=50_000, max_bytes=None, latency_target=None)
+
+'''PlannedQuery is one bucketed query of a plan: the bucket sizes to fetch, restricted to value_range
+(None for the whole column)
+'''
+PlannedQuery = namedtuple('PlannedQuery', 'bucket_sizes value_range')
+
 
 def estimate_bucket_size(value_range: float, value_count: int,
                          num_buckets=MAX_BUCKETS, min_bucket_count=MIN_BUCKET_COUNT) -> int:
@@ -45,20 +89,20 @@ def estimate_bucket_size(value_range: float, value_count: int,
         - The min_bucket_count takes priority.
     '''
     logging.debug(
-        f'''Estimating bucket size for:
-                range {value_range},
-                count {value_count},
-                num buckets {num_buckets},
-                min bucket count {min_bucket_count}''')
+        '''Estimating bucket size for:
+                range %s,
+                count %s,
+                num buckets %s,
+                min bucket count %s''', value_range, value_count, num_buckets, min_bucket_count)
     # Estimate lower and upper bounds for the bucket size
     precision_bound = value_range / num_buckets
     size_bound = value_range / (value_count / min_bucket_count)
 
-    logging.debug(
-        f'Precision bound: {precision_bound}, Size bound: {size_bound}')
+    logging.debug('Precision bound: %s, Size bound: %s',
+                  precision_bound, size_bound)
 
     bs_candidates = buckets_in_range(size_bound, precision_bound)
-    logging.debug(f'Options are: {bs_candidates}')
+    logging.debug('Options are: %s', bs_candidates)
 
     if len(bs_candidates) == 0:
         # No bucket sizes within the range, prioritise the size bound
@@ -67,7 +111,7 @@ def estimate_bucket_size(value_range: float, value_count: int,
         # Otherwise choose the largest bucket size within the range
         result = max(bs_candidates)
 
-    logging.debug(f'Returning bucket size {result}')
+    logging.debug('Returning bucket size %s', result)
 
     return result
     # bs_candidate_lower = self.next_after(lower)
@@ -92,6 +136,177 @@ def estimate_bucket_size(value_range: float, value_count: int,
     #         return 0
 
 
+def estimate_granularity(time_range: float, value_count: int,
+                         num_buckets=MAX_BUCKETS, min_bucket_count=MIN_BUCKET_COUNT) -> str:
+    '''Estimate a suitable calendar unit to bucket date/time values, the equivalent of `estimate_bucket_size`
+
+    :param time_range: The time between the first and last value, in seconds.
+    :returns: One of CALENDAR_UNITS
+
+    For example, 10_000 values over a year should be bucketed by day: between 500 buckets of 20 values
+    (0.73 days) and 100 buckets (3.65 days).
+    >>> estimate_granularity(CALENDAR_UNITS['year'], 10_000)
+    'day'
+    '''
+    precision_bound = time_range / num_buckets
+    size_bound = time_range / (value_count / min_bucket_count)
+
+    candidates = [unit for (unit, length) in CALENDAR_UNITS.items()
+                  if size_bound < length < precision_bound]
+    if len(candidates) > 0:
+        # CALENDAR_UNITS are ordered from the largest unit
+        return candidates[0]
+
+    # No unit within the range, prioritise the size bound
+    larger = [unit for (unit, length) in CALENDAR_UNITS.items() if length > size_bound]
+    return larger[-1] if len(larger) > 0 else 'year'
+
+
+def finest_granularity(time_range: float, value_count: int, finest_unit='second') -> str:
+    '''The smallest calendar unit worth exploring, not smaller than finest_unit. Levels of smaller units
+    would have more buckets than there are values, so most of their buckets would be empty or interpolated
+    from suppressed values, while their size grows with the time range rather than with the data.
+
+    For example, 100_000 values over 3 years have one value per 16 minutes on average:
+    >>> finest_granularity(3 * CALENDAR_UNITS['year'], 100_000)
+    'hour'
+    '''
+    units = [unit for (unit, length) in CALENDAR_UNITS.items()
+             if length >= CALENDAR_UNITS[finest_unit] and length * value_count >= time_range]
+    # CALENDAR_UNITS are ordered from the largest unit
+    return units[-1] if len(units) > 0 else 'year'
+
+
+def calendar_unit(bucket_size):
+    '''The name of the calendar unit with length bucket_size, None if there is none
+    '''
+    return next((unit for (unit, length) in CALENDAR_UNITS.items() if length == bucket_size), None)
+
+
+def calendar_divides(small_size, large_size):
+    '''`divides` for calendar units: units of varying length are only divided by other units of varying
+    length, eg. days do not divide into months
+
+    >>> calendar_divides(CALENDAR_UNITS['month'], CALENDAR_UNITS['year'])
+    True
+    >>> calendar_divides(CALENDAR_UNITS['day'], CALENDAR_UNITS['month'])
+    False
+    '''
+    if calendar_unit(large_size) in MONTHS_PER_UNIT:
+        return calendar_unit(small_size) in MONTHS_PER_UNIT and divides(small_size, large_size)
+    return divides(small_size, large_size)
+
+
+def estimate_level_rows(bucket_size, value_range, value_count, coarse_size=None, coarse_counts=None):
+    '''Estimate the number of rows a bucketed query returns for one bucket size.
+
+    The number of buckets is bounded both by the number of buckets spanning the value range and by
+    the number of visible buckets the values can fill. If the counts of a coarser level are known, the
+    bounds are applied to each coarser bucket, which gives a much tighter estimate for skewed data.
+
+    >>> estimate_level_rows(1, 1000, 100_000)
+    1002
+    >>> estimate_level_rows(1, 1000, 100_000, coarse_size=100, coarse_counts=[50_000, 50, 0])
+    126
+    '''
+    if coarse_counts is None:
+        buckets = min(value_range / bucket_size + 1,
+                      value_count / MIN_VISIBLE_COUNT)
+    else:
+        children_per_bucket = coarse_size / bucket_size
+        buckets = sum(min(children_per_bucket, count / MIN_VISIBLE_COUNT)
+                      for count in coarse_counts)
+    # One more row for the star row of suppressed values
+    return int(math.ceil(buckets)) + 1
+
+
+def query_cost(num_bucket_sizes, rows):
+    '''Estimated (bytes, seconds) of a bucketed query returning `rows` rows for num_bucket_sizes sizes
+    '''
+    size = rows * (num_bucket_sizes + STATS_COLUMNS) * BYTES_PER_VALUE
+    return size, QUERY_LATENCY + rows * ROW_LATENCY
+
+
+def within_budget(num_bucket_sizes, rows, budget):
+    size, latency = query_cost(num_bucket_sizes, rows)
+    return (budget.max_rows is None or rows <= budget.max_rows) and \
+        (budget.max_bytes is None or size <= budget.max_bytes) and \
+        (budget.latency_target is None or latency <= budget.latency_target)
+
+
+def plan_queries(estimates, budget=DEFAULT_BUDGET, value_span=None):
+    '''Group bucket levels into as few queries as the budget allows.
+
+    Levels are added to a query from the largest bucket size down for as long as the query stays within
+    the budget. A level that exceeds the budget on its own is split into queries over aligned parts of
+    the value span.
+
+    :param estimates: A list of (bucket size, estimated rows), from largest to smallest bucket size
+    :param budget: A `QueryBudget`
+    :param value_span: The (lo, hi) range of the column's values. If None, levels can't be split.
+    :returns: A list of `PlannedQuery`
+
+    >>> plan_queries([(100, 1_000), (50, 2_000), (10, 10_000), (5, 20_000)], QueryBudget(15_000, None, None))
+    [PlannedQuery(bucket_sizes=[100, 50, 10], value_range=None), PlannedQuery(bucket_sizes=[5], value_range=None)]
+    >>> plan_queries([(1, 20_000)], QueryBudget(15_000, None, None), (0, 1000))
+    [PlannedQuery(bucket_sizes=[1], value_range=(0, 500)), PlannedQuery(bucket_sizes=[1], value_range=(500, 1000))]
+    '''
+    plan = []
+    batch, batch_rows = [], 0
+    for (bucket_size, rows) in estimates:
+        if len(batch) > 0 and within_budget(len(batch) + 1, batch_rows + rows, budget):
+            batch.append(bucket_size)
+            batch_rows += rows
+            continue
+
+        if len(batch) > 0:
+            plan.append(PlannedQuery(batch, None))
+
+        if within_budget(1, rows, budget) or value_span is None:
+            batch, batch_rows = [bucket_size], rows
+            continue
+
+        parts = 2
+        while parts < rows and not within_budget(1, math.ceil(rows / parts), budget):
+            parts *= 2
+        plan += [PlannedQuery([bucket_size], part)
+                 for part in split_range(value_span, parts, bucket_size)]
+        batch, batch_rows = [], 0
+
+    if len(batch) > 0:
+        plan.append(PlannedQuery(batch, None))
+
+    return plan
+
+
+def split_range(value_range, parts, bucket_size):
+    '''Split lo -> hi into at least `parts` consecutive ranges that Aircloak accepts in range conditions
+    and that buckets of bucket_size divide into.
+
+    >>> split_range((0, 1000), 4, 10)
+    [(0, 200), (200, 400), (400, 600), (600, 800), (800, 1000)]
+    '''
+    lo, hi = value_range
+    widths = [size for size in BUCKETS
+              if size >= bucket_size and divides(bucket_size, size) and size <= (hi - lo) / parts]
+    width = max(widths) if len(widths) > 0 else bucket_size
+
+    start = math.floor(round(lo / width, 9))
+    ranges = []
+    while round(start * width, 9) < hi:
+        ranges.append((round(start * width, 9), round((start + 1) * width, 9)))
+        start += 1
+    return ranges
+
+
+def divides(small_size, large_size):
+    '''Check whether buckets of large_size divide exactly into buckets of small_size, allowing for
+    floating point imprecision in sizes like 0.01
+    '''
+    ratio = large_size / small_size
+    return abs(ratio - round(ratio)) < 1e-6
+
+
 def next_after(val):
     return next(v for v in BUCKETS if v > val)
 
@@ -118,6 +333,40 @@ def buckets_with_base(bases):
     return (v for v in BUCKETS if base(v) in bases)
 
 
+def aligned_range(lo, hi):
+    '''The smallest range containing lo -> hi that Aircloak accepts in a range condition.
+
+    The size of the range must be one of BUCKETS and its lower bound a multiple of that size.
+    >>> aligned_range(120, 180)
+    (100, 200)
+    >>> aligned_range(180, 240)
+    (0, 500)
+    '''
+    for size in buckets_larger_than(0):
+        if size < (hi - lo) * (1 - 1e-9):
+            continue
+        # round away floating point noise, eg. 0.3 / 0.1 = 2.9999999999999996
+        start = round(math.floor(round(lo / size, 9)) * size, 9)
+        end = round(start + size, 9)
+        if end >= hi:
+            return (start, end)
+
+
+def merge_ranges(ranges):
+    '''Merge overlapping or adjacent (lo, hi) ranges
+
+    >>> merge_ranges([(10, 20), (0, 5), (15, 30), (30, 40)])
+    [(0, 5), (10, 40)]
+    '''
+    merged = []
+    for (lo, hi) in sorted(ranges):
+        if len(merged) > 0 and lo <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(hi, merged[-1][1]))
+        else:
+            merged.append((lo, hi))
+    return merged
+
+
 def base(val):
     base = val
     while base >= 10:
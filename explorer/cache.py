@@ -0,0 +1,150 @@
+import hashlib
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+
+DEFAULT_PATH = os.path.join(os.path.expanduser(
+    '~'), '.cache', 'aircloak-explorer', 'queries.sqlite')
+
+
+class QueryCache:
+    '''On-disk cache for query results, keyed by the database name and the rendered query text.
+
+    Results are stored as compressed (labels, rows) pairs in a sqlite database, so a cache can be
+    shared between notebook sessions. Entries older than `ttl` seconds are treated as misses, and
+    the least recently used entries are evicted once the stored size exceeds `max_bytes`.
+    '''
+
+    def __init__(self, path=DEFAULT_PATH, *, ttl=None, max_bytes=None):
+        '''
+        :param path: Location of the cache database, created if it doesn't exist.
+        :param ttl: Maximum age of a cached result in seconds, or None to keep results forever.
+        :param max_bytes: Maximum total size of the (compressed) cached results, or None for no limit.
+        '''
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # Queries may be sent from the connection pool's worker threads
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute('''
+                CREATE TABLE IF NOT EXISTS results (
+                    key TEXT PRIMARY KEY,
+                    dbname TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    data BLOB NOT NULL
+                )''')
+
+    def get(self, dbname, query_text):
+        '''Look up a cached result.
+
+        :returns: A tuple of (labels, rows) or None if the query is not cached or has expired.
+        '''
+        key = cache_key(dbname, query_text)
+        now = time.time()
+        with self._lock:
+            entry = self._db.execute(
+                'SELECT created, data FROM results WHERE key = ?', (key,)).fetchone()
+
+            if entry is not None and self.ttl is not None and now - entry[0] > self.ttl:
+                with self._db:
+                    self._db.execute(
+                        'DELETE FROM results WHERE key = ?', (key,))
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            with self._db:
+                self._db.execute(
+                    'UPDATE results SET accessed = ? WHERE key = ?', (now, key))
+            self.hits += 1
+
+        return pickle.loads(zlib.decompress(entry[1]))
+
+    def put(self, dbname, query_text, labels, rows):
+        '''Store a query result, evicting old entries if the cache has grown too large.
+
+        :param rows: A list of tuples, one per result row.
+        '''
+        data = zlib.compress(pickle.dumps(
+            (list(labels), [tuple(row) for row in rows]), protocol=pickle.HIGHEST_PROTOCOL))
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                             (cache_key(dbname, query_text), dbname, now, now, len(data), data))
+            if self.max_bytes is not None:
+                self._evict(self.max_bytes)
+
+    def invalidate(self, dbname=None, query_text=None):
+        '''Remove cached results.
+
+        :param dbname: Only remove results for this database. If None, the whole cache is cleared.
+        :param query_text: Only remove the result of this query (requires `dbname`).
+        '''
+        with self._lock, self._db:
+            if dbname is None:
+                self._db.execute('DELETE FROM results')
+            elif query_text is None:
+                self._db.execute(
+                    'DELETE FROM results WHERE dbname = ?', (dbname,))
+            else:
+                self._db.execute('DELETE FROM results WHERE key = ?',
+                                 (cache_key(dbname, query_text),))
+
+    def results(self, dbname=None):
+        '''Iterate over the cached results, eg. to replay recorded queries without a cloak
+
+        :returns: A generator of (labels, rows)
+        '''
+        with self._lock:
+            if dbname is None:
+                entries = self._db.execute('SELECT data FROM results').fetchall()
+            else:
+                entries = self._db.execute(
+                    'SELECT data FROM results WHERE dbname = ?', (dbname,)).fetchall()
+        for (data,) in entries:
+            yield pickle.loads(zlib.decompress(data))
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._db.execute(
+                'SELECT count(*), coalesce(sum(size), 0) FROM results').fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': size}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _evict(self, max_bytes):
+        '''Delete the least recently used entries until the total size is below max_bytes
+        '''
+        total = 0
+        evicted = []
+        for key, size in self._db.execute('SELECT key, size FROM results ORDER BY accessed DESC'):
+            total += size
+            if total > max_bytes:
+                evicted.append((key,))
+
+        if len(evicted) > 0:
+            logging.debug('Evicting %d cached query results', len(evicted))
+            self._db.executemany('DELETE FROM results WHERE key = ?', evicted)
+
+
+def cache_key(dbname, query_text):
+    return hashlib.sha256(f'{dbname}\0{query_text}'.encode()).hexdigest()
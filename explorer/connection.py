@@ -1,57 +1,167 @@
-import psycopg2
-from psycopg2.extras import DictCursor, LoggingConnection
+from psycopg2.extras import DictCursor, DictRow
 import logging
-from collections import namedtuple
+import threading
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from . import queries as q
+from . import instrumentation
+from .backends import PostgresBackend
 
 ColumnInfo = namedtuple('ColumnInfo', 'type isolator id')
 TableInfo = namedtuple('TableInfo', 'type')
 
+'''POOL_SIZE is the default number of queries sent to the cloak at the same time. Independent queries
+(eg. top level stats and distinct values, or a prefetched bucket level) run concurrently,
+each one on its own connection.
+'''
+POOL_SIZE = 3
+
+'''CHUNK_SIZE is the default number of rows read at a time when streaming a query result'''
+CHUNK_SIZE = 10_000
+
 
 class AircloakConnection():
-    def __init__(self, *, dbname):
+    def __init__(self, *, dbname, pool_size=POOL_SIZE, cache=None, backend=None):
+        '''
+        :param pool_size: The maximum number of queries sent to the cloak at the same time.
+        :param cache: An optional `QueryCache`. Results of previously sent queries are then read
+            from the cache instead of being sent to the cloak again.
+        :param backend: The backend executing the queries, see `backends`. By default queries are
+            sent to the Aircloak server with a `PostgresBackend`.
+        '''
         self.user = 'daniel-613C7ADF4535BB56DBCD'
         self.port = 9432
         self.host = 'attack.aircloak.com'
         self.dbname = dbname
+        self.pool_size = pool_size
+        self.cache = cache
 
-        logging.debug(
-            f'Connecting to Aircloak: user={self.user}, host={self.host}, port={self.port}, dbname={self.dbname}')
-
-        self.conn = psycopg2.connect(
-            user=self.user, host=self.host, port=self.port, dbname=self.dbname,
-            connection_factory=LoggingConnection)
+        if backend is None:
+            backend = PostgresBackend(user=self.user, host=self.host, port=self.port,
+                                      dbname=self.dbname, pool_size=pool_size)
+        self.backend = backend
 
-        self.conn.initialize(logging.getLogger(self.__class__.__name__))
+        self._executor = ThreadPoolExecutor(
+            max_workers=pool_size, thread_name_prefix='aircloak')
 
-        self._table_info = index_and_wrap(TableInfo, self.fetch(
-            q.table_info(), cursor_factory=None)['rows'])
+        # Metadata is loaded on first use. The backend only connects once the first query is sent.
+        self._metadata_lock = threading.Lock()
+        self._table_info = None
         self._column_info = {}
 
     def column_info(self, table, column):
+        return self.columns(table)[column]
+
+    def columns(self, table):
+        '''A dict of column name -> `ColumnInfo` for all columns of a table
+        '''
         if table not in self._column_info:
-            self._column_info[table] = index_and_wrap(ColumnInfo, self.fetch(q.column_info(
+            column_info = index_and_wrap(ColumnInfo, self.fetch(q.column_info(
                 table=table), cursor_factory=None)['rows'])
-        return self._column_info[table][column]
+            with self._metadata_lock:
+                self._column_info.setdefault(table, column_info)
+        return self._column_info[table]
+
+    def prefetch_columns(self, tables):
+        '''Load the column metadata of several tables concurrently
+
+        :returns: A dict of table -> dict of column name -> `ColumnInfo`
+        '''
+        futures = {table: self.submit(self.columns, table)
+                   for table in tables if table not in self._column_info}
+        return {table: futures[table].result() if table in futures else self._column_info[table]
+                for table in tables}
+
+    def tables(self):
+        '''A dict of table name -> `TableInfo` for all tables of the data source
+        '''
+        if self._table_info is None:
+            table_info = index_and_wrap(TableInfo, self.fetch(
+                q.table_info(), cursor_factory=None)['rows'])
+            with self._metadata_lock:
+                if self._table_info is None:
+                    self._table_info = table_info
+        return self._table_info
 
     def table_info(self, table):
-        return self._table_info[table]
+        return self.tables()[table]
 
     def close(self):
-        self.conn.close()
+        self._executor.shutdown(wait=True)
+        self.backend.close()
 
     def fetch(self, query, cursor_factory=DictCursor):
-        logging.debug(f'Sending query: {query.as_string(self.conn)}')
-        with self.conn.cursor(cursor_factory=cursor_factory) as cur:
-            cur.execute(query)
-            result = {
-                'rows': cur.fetchall(),
-                'labels': [col.name for col in cur.description]
-            }
+        with instrumentation.timed('query') as timer:
+            query_text = q.as_text(query)
+
+            cached = None
+            if self.cache is not None:
+                cached = self.cache.get(self.dbname, query_text)
+
+            if cached is not None:
+                logging.debug('Using cached result for query: %s', query_text)
+                labels, rows = cached
+            else:
+                logging.debug('Sending query: %s', query_text)
+                labels, rows = self.backend.execute(query_text)
+
+                if self.cache is not None:
+                    self.cache.put(self.dbname, query_text, labels, rows)
+
+            with instrumentation.timed('query.decode'):
+                result = {
+                    'rows': wrap_rows(rows, labels, cursor_factory),
+                    'labels': labels
+                }
+
+            if instrumentation.enabled():
+                timer.add(rows=len(rows), bytes=instrumentation.approximate_bytes(rows),
+                          cached=cached is not None)
 
         return result
 
+    def fetch_async(self, query, cursor_factory=DictCursor):
+        '''Send a query on a pooled connection without waiting for the result
+
+        :returns: A `concurrent.futures.Future` that resolves to the same dict as `fetch`
+        '''
+        return self._executor.submit(self.fetch, query, cursor_factory)
+
+    def fetch_chunks(self, query, chunk_size=CHUNK_SIZE):
+        '''Stream the result of a query `chunk_size` rows at a time (through a server-side cursor
+        when talking to a cloak). Streamed results bypass the cache.
+
+        :returns: A generator of lists of row tuples
+        '''
+        query_text = q.as_text(query)
+        logging.debug('Streaming query: %s', query_text)
+        return self.backend.stream(query_text, chunk_size)
+
+    def submit(self, fn, *args, **kwargs):
+        '''Run a callable on one of the pool's worker threads
+
+        :returns: A `concurrent.futures.Future` for the callable's result
+        '''
+        return self._executor.submit(fn, *args, **kwargs)
+
 
 def index_and_wrap(Wrapper, rows):
     return dict([(row[0], Wrapper(*row[1:])) for row in rows])
+
+
+def wrap_rows(rows, labels, cursor_factory):
+    '''Turn plain tuples into the row type that `cursor_factory` would have returned
+    '''
+    if cursor_factory is None:
+        return rows
+
+    assert cursor_factory is DictCursor, f'Unsupported cursor factory {cursor_factory}'
+    # All rows share a single index, the same way they do when read from a DictCursor
+    index = OrderedDict((label, i) for (i, label) in enumerate(labels))
+    wrapped = []
+    for row in rows:
+        dict_row = DictRow.__new__(DictRow)
+        dict_row.__setstate__((list(row), index))
+        wrapped.append(dict_row)
+    return wrapped
@@ -0,0 +1,104 @@
+import numpy as np
+
+from . import queries
+from . import bucket_util
+from . import bucket_tree as bt
+from .numeric_explorer import NumericColumnExplorer, decode_rows
+
+DATETIME_TYPES = ['datetime', 'date']
+
+
+class DateTimeColumnExplorer(NumericColumnExplorer):
+    '''Explore a date or datetime column by calendar units, from years down to seconds.
+
+    Values are bucketed with date_trunc and stored in a calendar `BucketTree` as seconds since the Unix
+    epoch (UTC), with one level per unit of `bucket_util.CALENDAR_UNITS` and the length of the unit as
+    bucket size. The first unit is picked with `bucket_util.estimate_granularity`. As for numeric columns,
+    each call to `explore` fetches the next units in as few GROUPING SETS queries as the budget allows.
+    Larger units come along with the first call, so eg. years, months, days and hours usually arrive in a
+    single round-trip. Units with more buckets than the column has values are not explored, see
+    `bucket_util.finest_granularity`. Levels always cover the whole column, so `zoom` raises a ValueError.
+
+    Bucket lower bounds, min and max are in seconds, see `to_datetimes` to convert them back.
+    '''
+
+    COLUMN_TYPES = DATETIME_TYPES
+
+    def __init__(self, **kwargs):
+        '''See `NumericColumnExplorer`
+        '''
+        super().__init__(**kwargs)
+        # The query has no average, decoded rows have NaN in its place
+        self._column_labels = list(bt.DATA_COLUMNS)
+
+    def _top_level_query(self):
+        return queries.datetime_stats(table=self.table, column=self.column)
+
+    def _decode_top_level_stats(self, row):
+        '''Convert the min and max to seconds since the Unix epoch
+        '''
+        return {
+            'min': float(to_seconds([row['min']])[0]),
+            'max': float(to_seconds([row['max']])[0]),
+            'count': row['count'],
+            'count_noise': row['count_noise'],
+        }
+
+    def _create_tree(self, column_type):
+        return bt.BucketTree(
+            self._data_range, self._distincts, self._top_level_stats['count'], self._suppressed_count,
+            calendar=True, finest_unit='day' if column_type == 'date' else 'second')
+
+    def _bucket_query(self, bucket_sizes, value_range=None):
+        assert value_range is None, 'Levels of calendar units are never split into ranges'
+        return queries.multi_granularity_stats(table=self.table, column=self.column,
+                                               units=[bucket_util.calendar_unit(size) for size in bucket_sizes])
+
+    def _decode_rows(self, bucket_sizes, rows):
+        '''Convert the truncated dates, min and max to seconds and add a NULL average before decoding,
+        see `decode_rows`
+        '''
+        num_sizes = len(bucket_sizes)
+        if len(rows) == 0:
+            return decode_rows(bucket_sizes, rows)
+
+        columns = list(zip(*rows))
+        table = np.column_stack([
+            *(to_seconds(column) for column in columns[:num_sizes]),
+            np.array(columns[num_sizes], dtype=np.float64),
+            np.array(columns[num_sizes + 1], dtype=np.float64),
+            to_seconds(columns[num_sizes + 2]),
+            to_seconds(columns[num_sizes + 3]),
+            np.full(len(rows), np.nan),
+        ])
+        return decode_rows(bucket_sizes, table)
+
+
+def to_seconds(values):
+    '''Convert dates, datetimes or ISO strings to seconds since the Unix epoch, with NaN for NULL
+    '''
+    times = np.array(values, dtype='datetime64[us]')
+    seconds = times.astype(np.int64) / 1e6
+    return np.where(np.isnat(times), np.nan, seconds)
+
+
+def to_datetimes(seconds):
+    '''Convert seconds since the Unix epoch to a NumPy datetime64 array, with NaT for NaN
+    '''
+    seconds = np.asarray(seconds, dtype=np.float64)
+    valid = ~np.isnan(seconds)
+    micros = np.rint(np.where(valid, seconds, 0) * 1e6).astype(np.int64).astype('datetime64[us]')
+    return np.where(valid, micros, np.datetime64('NaT'))
+
+
+if __name__ == "__main__":
+    import sys
+    import logging
+    from .connection import AircloakConnection
+    logging.basicConfig(level=logging.DEBUG)
+
+    dbname, table, column = sys.argv[1:4]
+    e = DateTimeColumnExplorer(aircloak_connection=AircloakConnection(dbname=dbname),
+                               table=table, column=column)
+    e.explore(4)
+    print(e.extract_to_dataframe())
@@ -0,0 +1,122 @@
+import heapq
+import logging
+
+from . import queries
+
+'''DISTINCT_LIMIT is the default number of most frequent values kept by a DistinctProfile'''
+DISTINCT_LIMIT = 1000
+
+
+class DistinctProfile:
+    '''Summary of the distinct values of a column.
+
+    The profile holds the suppressed count (the star row), the number of distinct values, their total
+    count and the `limit` most frequent values. With a limit, these are fetched with bounded queries
+    (the top values with ORDER BY and LIMIT, the star row and the counts in queries of their own), which
+    go through the query cache, so neither the transfer nor the memory use depends on the cardinality of
+    the column. Without a limit, all distinct values are streamed from the cloak in chunks. The full
+    list of values can still be streamed on request with `values`.
+    '''
+
+    def __init__(self, *, aircloak_connection, table, column, limit=DISTINCT_LIMIT):
+        '''
+        :param limit: The number of most frequent values to keep, or None to keep all of them.
+        '''
+        self.aircloak = aircloak_connection
+        self.table = table
+        self.column = column
+        self.limit = limit
+
+        self.suppressed_count = 0
+        self.distinct_count = 0
+        self.total_count = 0
+        # min-heap of (count, value), so the least frequent value is dropped first
+        self._top = []
+
+        # Sent one after the other, as profiles are usually built on the connection's worker threads
+        value_count, distinct_count = self.aircloak.fetch(queries.distinct_stats(
+            table=table, column=column), cursor_factory=None)['rows'][0]
+
+        if limit is None:
+            for rows in self._stream():
+                self._add(rows)
+        else:
+            star = self.aircloak.fetch(queries.suppressed_distinct(
+                table=table, column=column), cursor_factory=None)['rows']
+            self._add([(value, count) for (value, count) in star if value is None])
+            # One more row than needed in case the star row is among them, it was counted above
+            top = self.aircloak.fetch(queries.top_distinct(
+                table=table, column=column, limit=limit + 1), cursor_factory=None)['rows']
+            self._add([(value, count) for (value, count) in top if value is not None])
+
+        # The distinct count includes the suppressed values, the total count excludes them as before
+        self.distinct_count = distinct_count or 0
+        self.total_count = max((value_count or 0) - self.suppressed_count, 0)
+
+        logging.debug('Distinct values of %s.%s: %d values, %d suppressed',
+                      table, column, self.distinct_count, self.suppressed_count)
+
+    @classmethod
+    def from_summary(cls, summary, *, aircloak_connection=None):
+        '''Restore a profile from the output of `summary` without querying the cloak
+
+        :param aircloak_connection: Needed to stream the values with `values`
+        '''
+        profile = cls.__new__(cls)
+        profile.aircloak = aircloak_connection
+        profile.table = summary['table']
+        profile.column = summary['column']
+        profile.limit = summary['limit']
+        profile.suppressed_count = summary['suppressed_count']
+        profile.distinct_count = summary['distinct_count']
+        profile.total_count = summary['total_count']
+        profile._top = [(count, value) for (value, count) in summary['top_values']]
+        heapq.heapify(profile._top)
+        return profile
+
+    def summary(self):
+        '''The profile as a dict of JSON-serialisable values
+        '''
+        return {
+            'table': self.table,
+            'column': self.column,
+            'limit': self.limit,
+            'suppressed_count': self.suppressed_count,
+            'distinct_count': self.distinct_count,
+            'total_count': self.total_count,
+            'top_values': [[value, count] for (value, count) in self.top_values()],
+        }
+
+    def top_values(self):
+        '''The most frequent values as a list of (value, count), most frequent first
+        '''
+        return [(value, count) for (count, value) in sorted(self._top, reverse=True)]
+
+    def values(self, chunk_size=None):
+        '''Stream all distinct values from the cloak
+
+        :returns: A generator of (value, count), excluding the suppressed values
+        '''
+        for rows in self._stream(chunk_size):
+            for (value, count) in rows:
+                if value is not None:
+                    yield (value, count)
+
+    def _stream(self, chunk_size=None):
+        query = queries.top_level_distinct(
+            table=self.table, column=self.column)
+        if chunk_size is None:
+            return self.aircloak.fetch_chunks(query)
+        return self.aircloak.fetch_chunks(query, chunk_size)
+
+    def _add(self, rows):
+        for (value, count) in rows:
+            if value is None:
+                # The query filters out NULL values, so a NULL row is the star row of suppressed values
+                self.suppressed_count += count
+                continue
+
+            if self.limit is None or len(self._top) < self.limit:
+                heapq.heappush(self._top, (count, value))
+            elif count > self._top[0][0]:
+                heapq.heapreplace(self._top, (count, value))
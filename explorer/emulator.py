@@ -0,0 +1,563 @@
+import csv
+import logging
+import re
+from collections import namedtuple
+
+import numpy as np
+
+from . import instrumentation
+
+'''LOW_COUNT_THRESHOLD is the number of rows below which the emulator suppresses a group. A cloak
+suppresses groups with too few distinct users, the emulator treats every row as a distinct user.
+'''
+LOW_COUNT_THRESHOLD = 5
+
+AGGREGATES = ['count', 'count_noise', 'min', 'max', 'avg', 'grouping_id']
+
+'''DATE_UNITS maps the units of date_trunc to NumPy datetime units, apart from quarters'''
+DATE_UNITS = {'year': 'Y', 'month': 'M', 'day': 'D', 'hour': 'h', 'minute': 'm', 'second': 's'}
+
+TOKEN_PATTERN = re.compile(r'''\s*(?:
+    (?P<number>-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)
+  | "(?P<identifier>(?:[^"]|"")*)"
+  | '(?P<string>(?:[^']|'')*)'
+  | (?P<word>[A-Za-z_][A-Za-z_0-9]*)
+  | (?P<symbol>>=|<=|<>|!=|[(),*<>=])
+)''', re.VERBOSE)
+
+Token = namedtuple('Token', 'kind value')
+
+# Parsed expressions
+Column = namedtuple('Column', 'name')
+Literal = namedtuple('Literal', 'value')
+Star = namedtuple('Star', '')
+Call = namedtuple('Call', 'name args')
+BucketExpr = namedtuple('BucketExpr', 'expr size')
+Distinct = namedtuple('Distinct', 'expr')
+
+Condition = namedtuple('Condition', 'expr op value')
+SelectItem = namedtuple('SelectItem', 'expr label')
+OrderItem = namedtuple('OrderItem', 'position descending nulls_first')
+Query = namedtuple('Query', 'items table conditions grouping_sets order_by limit')
+
+
+class EmulatorBackend:
+    '''A local, in-process stand-in for a cloak, for offline runs, regression tests and load tests.
+
+    Runs the queries produced by `queries` over tables held in memory as NumPy arrays. It understands
+    `SHOW TABLES`, `SHOW COLUMNS`, `bucket(x by n)`, the functions in FUNCTIONS (eg. `date_trunc`), the
+    aggregates used by the explorer (including `count(DISTINCT x)`), simple WHERE conditions, `GROUP BY` with
+    column positions or `GROUPING SETS`, and `ORDER BY` column positions with `LIMIT`. Groups with fewer than
+    `low_count_threshold` rows are suppressed and merged into a star row, like a cloak does.
+    It does not try to reproduce the cloak's anonymization beyond that.
+    '''
+
+    def __init__(self, tables, *, low_count_threshold=LOW_COUNT_THRESHOLD, noise_sd=0.0, seed=None):
+        '''
+        :param tables: A dict of table name -> table, where a table is a pandas DataFrame or a dict of
+            column name -> array. Missing numeric values are NaN, date/time columns are NumPy datetime64
+            arrays with NaT for missing values. Columns with a unit of a day or more are dates.
+        :param noise_sd: Standard deviation of the noise added to counts, also reported by count_noise.
+        :param seed: Seed for the noise.
+        '''
+        self.low_count_threshold = low_count_threshold
+        self.noise_sd = noise_sd
+        self._rng = np.random.default_rng(seed)
+
+        self._tables = {}
+        self._types = {}
+        for (name, table) in tables.items():
+            self.add_table(name, table)
+
+    @classmethod
+    def from_files(cls, files, **kwargs):
+        '''Create an emulator from CSV or Parquet files
+
+        :param files: A dict of table name -> file path. Parquet files require pandas.
+        '''
+        tables = {}
+        for (name, path) in files.items():
+            if path.endswith('.parquet'):
+                import pandas as pd
+                tables[name] = pd.read_parquet(path)
+            else:
+                tables[name] = read_csv(path)
+        return cls(tables, **kwargs)
+
+    def add_table(self, name, table):
+        columns = {}
+        types = {}
+        for column in table.keys():
+            values = np.asarray(table[column])
+            types[column] = column_type(values)
+            if types[column] in ['integer', 'real']:
+                values = values.astype(np.float64)
+            elif types[column] == 'datetime':
+                values = values.astype('datetime64[us]')
+            elif types[column] == 'date':
+                values = values.astype('datetime64[D]')
+            columns[column] = values
+
+        self._tables[name] = columns
+        self._types[name] = types
+
+    def execute(self, query_text):
+        show_tables = re.fullmatch(r'\s*SHOW\s+TABLES\s*', query_text, re.IGNORECASE)
+        if show_tables:
+            return ['name', 'type'], [(name, 'personal') for name in self._tables]
+
+        show_columns = re.fullmatch(
+            r'\s*SHOW\s+COLUMNS\s+FROM\s+"((?:[^"]|"")*)"\s*', query_text, re.IGNORECASE)
+        if show_columns:
+            table = show_columns.group(1).replace('""', '"')
+            return ['name', 'type', 'isolator', 'key_type'], \
+                [(column, column_type, 'false', None)
+                 for (column, column_type) in self._types[table].items()]
+
+        with instrumentation.timed('query.execute'):
+            return self._run(parse(query_text))
+
+    def stream(self, query_text, chunk_size):
+        _, rows = self.execute(query_text)
+        for start in range(0, len(rows), chunk_size):
+            yield rows[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+    def _run(self, query):
+        table = self._tables[query.table]
+        mask = np.ones(num_rows(table), dtype=bool)
+        for condition in query.conditions:
+            mask &= self._condition(table, condition)
+        table = {column: values[mask] for (column, values) in table.items()}
+
+        labels = [item.label for item in query.items]
+        if query.grouping_sets is None:
+            # Aggregates over the whole table, without low count filtering
+            groups = np.zeros(num_rows(table), dtype=np.int64)
+            columns = self._aggregate(
+                table, query.items, [], groups, 1, np.array([False]))
+            return labels, order_rows(list(zip(*columns)), query.order_by, query.limit)
+
+        rows = []
+        for grouping_set in query.grouping_sets:
+            rows += self._run_grouping_set(table, query.items, grouping_set)
+        return labels, order_rows(rows, query.order_by, query.limit)
+
+    def _run_grouping_set(self, table, items, grouping_set):
+        '''Group the rows by the items at the positions in grouping_set, suppressing low count groups
+        '''
+        key_columns = [self._evaluate(table, items[i].expr) for i in grouping_set]
+        groups, first_rows = group_by(key_columns, num_rows(table))
+
+        counts = np.bincount(groups, minlength=len(first_rows))
+        kept = counts >= self.low_count_threshold
+        num_kept = np.count_nonzero(kept)
+        suppressed_count = counts[~kept].sum()
+
+        # Renumber the kept groups and merge the suppressed ones into a star row, dropping it if it's
+        # too small itself
+        has_star = suppressed_count >= self.low_count_threshold
+        new_index = np.full(len(first_rows), num_kept if has_star else -1)
+        new_index[kept] = np.arange(num_kept)
+        groups = new_index[groups]
+        rows = groups >= 0
+        table = {column: values[rows] for (column, values) in table.items()}
+        groups = groups[rows]
+        num_groups = num_kept + int(has_star)
+        is_star = np.arange(num_groups) == num_kept
+
+        keys = {i: values[first_rows[kept]]
+                for (i, values) in zip(grouping_set, key_columns)}
+        columns = self._aggregate(table, items, grouping_set, groups, num_groups, is_star, keys)
+        return list(zip(*columns))
+
+    def _aggregate(self, table, items, grouping_set, groups, num_groups, is_star, keys={}):
+        '''Compute the output columns for each group
+
+        :returns: A list of output columns, each a list with one Python value per group
+        '''
+        grouped = [items[i].expr for i in grouping_set]
+        order = np.argsort(groups, kind='stable')
+        counts = np.bincount(groups, minlength=num_groups)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+        columns = []
+        for (i, item) in enumerate(items):
+            expr = item.expr
+            if i in keys:
+                values = np.full(num_groups, np.nan, dtype=keys[i].dtype)
+                values[~is_star] = keys[i]
+                columns.append(to_python(values))
+            elif isinstance(expr, Call) and expr.name in AGGREGATES:
+                columns.append(self._aggregate_call(
+                    table, expr, grouped, groups, num_groups, order, starts, counts))
+            else:
+                # Not grouped by in this grouping set
+                columns.append([None] * num_groups)
+        return columns
+
+    def _aggregate_call(self, table, call, grouped, groups, num_groups, order, starts, counts):
+        if call.name == 'grouping_id':
+            grouping_id = 0
+            for arg in call.args:
+                grouping_id = (grouping_id << 1) | int(arg not in grouped)
+            return [grouping_id] * num_groups
+
+        arg = call.args[0]
+        if call.name == 'count_noise':
+            return [float(self.noise_sd)] * num_groups
+
+        if call.name == 'count':
+            if isinstance(arg, Star):
+                result = counts.astype(np.float64)
+            elif isinstance(arg, Distinct):
+                values = self._evaluate(table, arg.expr)
+                valid = not_null(values)
+                # One group per distinct (group, value) pair, counted per group
+                _, first_rows = group_by([groups[valid], values[valid]], np.count_nonzero(valid))
+                result = np.bincount(groups[valid][first_rows], minlength=num_groups).astype(np.float64)
+            else:
+                result = np.bincount(groups, weights=not_null(
+                    self._evaluate(table, arg)), minlength=num_groups)
+            if self.noise_sd > 0:
+                result = np.maximum(np.rint(result + self._rng.normal(0, self.noise_sd, num_groups)), 0)
+            return [int(count) for count in result]
+
+        values = self._evaluate(table, arg)
+        if call.name == 'avg':
+            if values.dtype.kind == 'M':
+                raise ValueError('avg is not supported for date/time values')
+            valid = not_null(values)
+            sums = np.bincount(groups, weights=np.where(valid, values, 0), minlength=num_groups)
+            value_counts = np.bincount(groups, weights=valid, minlength=num_groups)
+            return to_python(np.divide(sums, value_counts, out=np.full(num_groups, np.nan),
+                                       where=value_counts > 0))
+
+        reduce = np.fmin if call.name == 'min' else np.fmax
+        # NaN, or NaT for date/time values
+        result = np.full(num_groups, np.nan, dtype=values.dtype)
+        non_empty = counts > 0
+        if np.any(non_empty):
+            result[non_empty] = reduce.reduceat(values[order], starts[non_empty])
+        return to_python(result)
+
+    def _evaluate(self, table, expr):
+        if isinstance(expr, Column):
+            return table[expr.name]
+        if isinstance(expr, Literal):
+            return np.full(num_rows(table), expr.value)
+        if isinstance(expr, BucketExpr):
+            values = self._evaluate(table, expr.expr)
+            # Round away floating point noise, eg. 0.3 / 0.1 = 2.9999999999999996
+            return np.round(np.floor(np.round(values / expr.size, 9)) * expr.size, 9)
+        if isinstance(expr, Call) and expr.name in FUNCTIONS:
+            # Literal arguments, like the unit of date_trunc, are passed as plain values
+            args = [arg.value if isinstance(arg, Literal) else self._evaluate(table, arg)
+                    for arg in expr.args]
+            return FUNCTIONS[expr.name](*args)
+
+        raise ValueError(f'Unsupported expression {expr}')
+
+    def _condition(self, table, condition):
+        values = self._evaluate(table, condition.expr)
+        if condition.op == 'IS NOT NULL':
+            return not_null(values)
+        if condition.op == 'IS NULL':
+            return ~not_null(values)
+
+        with np.errstate(invalid='ignore'):
+            return {
+                '>=': np.greater_equal,
+                '>': np.greater,
+                '<=': np.less_equal,
+                '<': np.less,
+                '=': np.equal,
+            }[condition.op](values, condition.value)
+
+
+def parse(query_text):
+    '''Parse the SELECT statements produced by `queries`
+    '''
+    parser = Parser(tokenize(query_text))
+    return parser.query()
+
+
+def tokenize(query_text):
+    tokens = []
+    position = 0
+    query_text = query_text.rstrip()
+    while position < len(query_text):
+        match = TOKEN_PATTERN.match(query_text, position)
+        if match is None or match.end() == position:
+            raise ValueError(
+                f'Unexpected input at {position}: {query_text[position:position + 20]!r}')
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'number':
+            value = float(value)
+        elif kind == 'identifier':
+            value = value.replace('""', '"')
+        elif kind == 'string':
+            value = value.replace("''", "'")
+        elif kind == 'word':
+            value = value.lower()
+        tokens.append(Token(kind, value))
+    return tokens
+
+
+class Parser:
+    def __init__(self, tokens):
+        self._tokens = tokens
+        self._position = 0
+
+    def query(self):
+        self._expect('word', 'select')
+        items = [self._select_item()]
+        while self._accept('symbol', ','):
+            items.append(self._select_item())
+
+        self._expect('word', 'from')
+        table = self._name()
+
+        conditions = []
+        if self._accept('word', 'where'):
+            conditions.append(self._condition())
+            while self._accept('word', 'and'):
+                conditions.append(self._condition())
+
+        grouping_sets = None
+        if self._accept('word', 'group'):
+            self._expect('word', 'by')
+            if self._accept('word', 'grouping'):
+                self._expect('word', 'sets')
+                self._expect('symbol', '(')
+                grouping_sets = [self._grouping_set()]
+                while self._accept('symbol', ','):
+                    grouping_sets.append(self._grouping_set())
+                self._expect('symbol', ')')
+            else:
+                grouping_sets = [self._positions()]
+
+        order_by = []
+        if self._accept('word', 'order'):
+            self._expect('word', 'by')
+            order_by.append(self._order_item())
+            while self._accept('symbol', ','):
+                order_by.append(self._order_item())
+
+        limit = None
+        if self._accept('word', 'limit'):
+            limit = int(self._expect('number').value)
+
+        if self._position != len(self._tokens):
+            raise ValueError(f'Unsupported query syntax at {self._peek()}')
+
+        return Query(items, table, conditions, grouping_sets, order_by, limit)
+
+    def _select_item(self):
+        expr = self._expression()
+        if self._accept('word', 'as'):
+            label = self._name()
+        elif isinstance(expr, Column):
+            label = expr.name
+        elif isinstance(expr, Call):
+            label = expr.name
+        else:
+            label = 'bucket'
+        return SelectItem(expr, label)
+
+    def _expression(self):
+        token = self._next()
+        if token.kind == 'number' or token.kind == 'string':
+            return Literal(token.value)
+        if token.kind == 'identifier':
+            return Column(token.value)
+        if token.kind == 'symbol' and token.value == '*':
+            return Star()
+        if token.kind == 'word':
+            if not self._accept('symbol', '('):
+                return Column(token.value)
+            if token.value == 'bucket':
+                expr = self._expression()
+                self._expect('word', 'by')
+                size = self._expect('number').value
+                self._expect('symbol', ')')
+                return BucketExpr(expr, size)
+
+            args = [self._argument()]
+            while self._accept('symbol', ','):
+                args.append(self._argument())
+            self._expect('symbol', ')')
+            return Call(token.value, tuple(args))
+
+        raise ValueError(f'Unexpected token {token}')
+
+    def _argument(self):
+        if self._accept('word', 'distinct'):
+            return Distinct(self._expression())
+        return self._expression()
+
+    def _condition(self):
+        expr = self._expression()
+        if self._accept('word', 'is'):
+            negated = self._accept('word', 'not')
+            self._expect('word', 'null')
+            return Condition(expr, 'IS NOT NULL' if negated else 'IS NULL', None)
+
+        op = self._expect('symbol').value
+        return Condition(expr, op, self._expression().value)
+
+    def _grouping_set(self):
+        if self._accept('symbol', '('):
+            positions = self._positions()
+            self._expect('symbol', ')')
+            return positions
+        return [self._position_number()]
+
+    def _order_item(self):
+        position = self._position_number()
+        descending = self._accept('word', 'desc')
+        if not descending:
+            self._accept('word', 'asc')
+        # Like PostgreSQL, NULLs sort as if larger than any value by default
+        nulls_first = descending
+        if self._accept('word', 'nulls'):
+            nulls_first = self._accept('word', 'first')
+            if not nulls_first:
+                self._expect('word', 'last')
+        return OrderItem(position, descending, nulls_first)
+
+    def _positions(self):
+        positions = [self._position_number()]
+        while self._accept('symbol', ','):
+            positions.append(self._position_number())
+        return positions
+
+    def _position_number(self):
+        # GROUP BY positions are 1-based
+        return int(self._expect('number').value) - 1
+
+    def _name(self):
+        token = self._next()
+        if token.kind not in ['identifier', 'word']:
+            raise ValueError(f'Expected a name, got {token}')
+        return token.value
+
+    def _peek(self):
+        return self._tokens[self._position] if self._position < len(self._tokens) else None
+
+    def _next(self):
+        token = self._peek()
+        if token is None:
+            raise ValueError('Unexpected end of query')
+        self._position += 1
+        return token
+
+    def _accept(self, kind, value=None):
+        token = self._peek()
+        if token is not None and token.kind == kind and (value is None or token.value == value):
+            self._position += 1
+            return True
+        return False
+
+    def _expect(self, kind, value=None):
+        token = self._next()
+        if token.kind != kind or (value is not None and token.value != value):
+            raise ValueError(f'Expected {value or kind}, got {token}')
+        return token
+
+
+def group_by(key_columns, num_rows):
+    '''Number the distinct combinations of key values, NULLs forming their own group
+
+    :returns: A tuple of (group index per row, index of the first row of each group)
+    '''
+    combined = np.zeros(num_rows, dtype=np.int64)
+    for values in key_columns:
+        _, inverse = np.unique(values, return_inverse=True)
+        combined = combined * (inverse.max(initial=0) + 1) + inverse.ravel()
+
+    _, first_rows, groups = np.unique(
+        combined, return_index=True, return_inverse=True)
+    return groups.ravel(), first_rows
+
+
+def order_rows(rows, order_by, limit):
+    '''Sort result rows by the items of an ORDER BY clause and keep the first `limit` of them
+    '''
+    # Sorting is stable, so sorting by the last item first leaves the rows sorted by all of them
+    for item in reversed(order_by):
+        nulls = [row for row in rows if row[item.position] is None]
+        values = sorted((row for row in rows if row[item.position] is not None),
+                        key=lambda row: row[item.position], reverse=item.descending)
+        rows = nulls + values if item.nulls_first else values + nulls
+    return rows if limit is None else rows[:limit]
+
+
+def date_trunc(unit, values):
+    '''Truncate date/time values to the start of their year, quarter, month, day, hour, minute or second
+    '''
+    if unit == 'quarter':
+        months = values.astype('datetime64[M]').astype(np.int64)
+        truncated = (months - months % 3).astype('datetime64[M]')
+    elif unit in DATE_UNITS:
+        truncated = values.astype(f'datetime64[{DATE_UNITS[unit]}]')
+    else:
+        raise ValueError(f'Unsupported date_trunc unit {unit}')
+    return np.where(np.isnat(values), values, truncated.astype(values.dtype))
+
+
+'''FUNCTIONS are the scalar functions the emulator can evaluate, by name'''
+FUNCTIONS = {
+    'date_trunc': date_trunc,
+}
+
+
+def column_type(values):
+    if values.dtype.kind == 'M':
+        # Dates are datetime64 values with a unit of a day or more
+        return 'date' if np.datetime_data(values.dtype)[0] in ['Y', 'M', 'W', 'D'] else 'datetime'
+    if values.dtype.kind in 'iub':
+        return 'integer'
+    if values.dtype.kind == 'f':
+        finite = values[np.isfinite(values)]
+        return 'integer' if np.all(finite == np.round(finite)) else 'real'
+    return 'text'
+
+
+def read_csv(path):
+    '''Read a CSV file with a header row, with empty fields as missing values
+    '''
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        values = list(zip(*reader))
+
+    table = {}
+    for (column, column_values) in zip(header, values):
+        try:
+            table[column] = np.array([float(value) if value != '' else np.nan
+                                      for value in column_values])
+        except ValueError:
+            table[column] = np.array(column_values, dtype=object)
+    logging.debug('Read %d rows from %s', len(values[0]) if values else 0, path)
+    return table
+
+
+def num_rows(table):
+    return len(next(iter(table.values()))) if len(table) > 0 else 0
+
+
+def not_null(values):
+    if values.dtype.kind == 'f':
+        return ~np.isnan(values)
+    if values.dtype.kind == 'M':
+        return ~np.isnat(values)
+    return values != None
+
+
+def to_python(values):
+    return [None if value != value else value for value in values.tolist()]
@@ -0,0 +1,179 @@
+import json
+import threading
+import time
+
+'''Timing hooks for the explorer's hot paths.
+
+Queries and client-side processing steps report how long they took to the active collector, together
+with details such as row counts. No collector is active by default, in which case `timed` returns a
+shared no-op timer and nothing is measured.
+
+Stages reported:
+    query            A whole `AircloakConnection.fetch`, with `rows`, `bytes` (approximate payload)
+                     and `cached`
+    query.execute    Sending the query and waiting for the cloak to execute it and return the result
+    query.fetch      Reading the result rows into Python objects
+    query.decode     Wrapping the rows into the requested row type
+    explorer.process Turning a query result into bucket levels, with `rows`
+    level.interpolate Building a bucket level and interpolating its gaps, with `buckets`
+    tree.export      Exporting bucket levels to column arrays, with `buckets`
+
+Example:
+    >>> collector = SummaryCollector()
+    >>> set_collector(collector)
+    >>> ... explore ...
+    >>> collector.summary()['query']['total']
+'''
+
+_collector = None
+
+
+def set_collector(collector):
+    '''Activate a collector, or disable instrumentation with None
+
+    :returns: The previously active collector
+    '''
+    global _collector
+    previous = _collector
+    _collector = collector
+    return previous
+
+
+def get_collector():
+    return _collector
+
+
+def enabled():
+    return _collector is not None
+
+
+def timed(stage, **fields):
+    '''Time the enclosed block and report it to the active collector as `stage`
+
+    Additional fields can be attached inside the block with `timer.add(...)`.
+    '''
+    if _collector is None:
+        return _NULL_TIMER
+    return _Timer(_collector, stage, fields)
+
+
+class _Timer:
+    __slots__ = ['_collector', '_stage', '_fields', '_start']
+
+    def __init__(self, collector, stage, fields):
+        self._collector = collector
+        self._stage = stage
+        self._fields = fields
+
+    def add(self, **fields):
+        self._fields.update(fields)
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._collector.record(
+            self._stage, time.perf_counter() - self._start, **self._fields)
+        return False
+
+
+class _NullTimer:
+    __slots__ = []
+
+    def add(self, **fields):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Collector:
+    '''Base class for collectors. `record` may be called from several threads at once.
+    '''
+
+    def record(self, stage, duration, **fields):
+        '''
+        :param stage: The name of the measured stage, eg. 'query.execute'
+        :param duration: Wall clock duration in seconds
+        :param fields: Numeric or descriptive details of the measurement
+        '''
+        raise NotImplementedError
+
+
+class SummaryCollector(Collector):
+    '''Keeps count, total, min and max durations per stage, and totals of numeric fields
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def record(self, stage, duration, **fields):
+        with self._lock:
+            summary = self._stages.get(stage)
+            if summary is None:
+                summary = {'count': 0, 'total': 0.0,
+                           'min': duration, 'max': duration}
+                self._stages[stage] = summary
+
+            summary['count'] += 1
+            summary['total'] += duration
+            summary['min'] = min(summary['min'], duration)
+            summary['max'] = max(summary['max'], duration)
+            for (name, value) in fields.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    summary[name] = summary.get(name, 0) + value
+
+    def summary(self):
+        '''A dict of stage -> dict of count, total, min, max, mean and the totals of numeric fields
+        '''
+        with self._lock:
+            return {stage: dict(summary, mean=summary['total'] / summary['count'])
+                    for (stage, summary) in self._stages.items()}
+
+    def reset(self):
+        with self._lock:
+            self._stages = {}
+
+
+class JsonLinesCollector(Collector):
+    '''Writes every measurement as a JSON object on its own line
+    '''
+
+    def __init__(self, output):
+        '''
+        :param output: A file path to append to, or a writable text stream
+        '''
+        self._lock = threading.Lock()
+        self._owned = isinstance(output, str)
+        self._output = open(output, 'a') if self._owned else output
+
+    def record(self, stage, duration, **fields):
+        line = json.dumps(dict(fields, stage=stage, duration=duration, timestamp=time.time()),
+                          default=str)
+        with self._lock:
+            self._output.write(line + '\n')
+
+    def close(self):
+        with self._lock:
+            if self._owned:
+                self._output.close()
+            else:
+                self._output.flush()
+
+
+def approximate_bytes(rows):
+    '''Rough size of a query result on the wire: 8 bytes per number, the length of strings
+    '''
+    size = 0
+    for row in rows:
+        for value in row:
+            size += len(value) if isinstance(value, str) else 8
+    return size
@@ -0,0 +1,112 @@
+import itertools
+import os
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+
+'''Memory budget for the bucket levels of all trees in the process.
+
+Once a budget is set, every new `BucketLevel` registers the size of its columns with the store. When
+the levels held in memory exceed the budget, the least recently used levels are spilled: their columns
+are written to a file in the spill directory (once, as levels never change) and dropped from memory.
+A spilled level reloads its columns transparently the next time they are used.
+
+No budget is set by default, in which case levels always stay in memory.
+
+Example:
+    >>> store = set_memory_budget(512 * 2 ** 20)
+    >>> ... explore many columns ...
+    >>> store.stats()
+'''
+
+_store = None
+
+
+def set_memory_budget(max_bytes, spill_dir=None):
+    '''Limit the memory held by the columns of bucket levels created from now on
+
+    :param max_bytes: The budget in bytes, or None to keep new levels in memory
+    :param spill_dir: Directory for spilled levels, a new temporary directory by default
+    :returns: The new `LevelStore`, or None
+    '''
+    global _store
+    _store = None if max_bytes is None else LevelStore(max_bytes, spill_dir)
+    return _store
+
+
+def get_store():
+    return _store
+
+
+class LevelStore:
+    '''Tracks the memory of registered levels in least recently used order and spills them to disk
+    '''
+
+    def __init__(self, max_bytes, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir if spill_dir is not None else tempfile.mkdtemp(
+            prefix='aircloak-levels-')
+        os.makedirs(self.spill_dir, exist_ok=True)
+
+        self.resident_bytes = 0
+        self.spills = 0
+        self.reloads = 0
+
+        # Levels are tracked by weak reference, so the store never keeps a level alive. Reentrant, as a
+        # level may be garbage collected (and forgotten) while the lock is held.
+        self._lock = threading.RLock()
+        self._resident = OrderedDict()
+        self._file_names = itertools.count()
+
+    def add(self, level, nbytes, reloaded=False):
+        '''Register the columns of a level that have just been loaded into memory, spilling other levels
+        if the budget is exceeded
+        '''
+        key = id(level)
+        with self._lock:
+            if reloaded:
+                self.reloads += 1
+            self._forget(key)
+            self._resident[key] = (weakref.ref(
+                level, lambda _: self._forget(key)), nbytes)
+            self.resident_bytes += nbytes
+            self._evict()
+
+    def touch(self, level):
+        '''Mark a level as recently used
+        '''
+        with self._lock:
+            if id(level) in self._resident:
+                self._resident.move_to_end(id(level))
+
+    def spill_path(self):
+        return os.path.join(self.spill_dir, f'level-{next(self._file_names)}.npz')
+
+    def stats(self):
+        with self._lock:
+            return {'resident_levels': len(self._resident), 'resident_bytes': self.resident_bytes,
+                    'max_bytes': self.max_bytes, 'spills': self.spills, 'reloads': self.reloads}
+
+    def _evict(self):
+        # The most recently added level is never evicted, so it can be used right away
+        while self.resident_bytes > self.max_bytes and len(self._resident) > 1:
+            key, (ref, nbytes) = self._resident.popitem(last=False)
+            self.resident_bytes -= nbytes
+            level = ref()
+            if level is not None:
+                level._spill(self)
+                self.spills += 1
+
+    def _forget(self, key):
+        with self._lock:
+            entry = self._resident.pop(key, None)
+            if entry is not None:
+                self.resident_bytes -= entry[1]
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
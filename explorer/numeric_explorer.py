@@ -1,30 +1,56 @@
-from itertools import count
 from collections import namedtuple, defaultdict
+from contextlib import closing
 import logging
+import numpy as np
 
 from . import queries
 from . import bucket_util
 from . import bucket_tree as bt
+from . import instrumentation
+from . import snapshot
+from .distinct_profile import DistinctProfile, DISTINCT_LIMIT
+from .connection import CHUNK_SIZE
 
 
 class NumericColumnExplorer:
-    def __init__(self, *, aircloak_connection, table, column):
+    '''COLUMN_TYPES are the column types the explorer can deal with'''
+    COLUMN_TYPES = ['integer', 'real']
+
+    def __init__(self, *, aircloak_connection, table, column, prefetch=True, distinct_limit=DISTINCT_LIMIT,
+                 budget=bucket_util.DEFAULT_BUDGET, max_synthetic_share=0.0):
+        '''
+        :param prefetch: After each call to `explore`, query the next bucket levels in the background
+            so that the following call to `explore` does not have to wait for the cloak.
+        :param distinct_limit: The number of most frequent distinct values to keep in memory,
+            or None to keep all of them.
+        :param budget: A `bucket_util.QueryBudget` limiting the estimated size of each query. Levels are
+            batched into as few queries as fit the budget, and levels too large on their own are split
+            into range-restricted queries.
+        :param max_synthetic_share: Levels that can be rolled up from a finer level are derived locally
+            instead of being queried, if at most this share of their count is interpolated where a query
+            would have measured it, see `BucketTree.derive_levels`. The default of 0 only derives levels
+            that are as good as queried ones; a larger share saves more queries at the cost of interpolated
+            counts in buckets a query would have measured. None to query every level.
+        '''
         self.table = table
         self.column = column
         self.aircloak = aircloak_connection
+        self.budget = budget
+        self.max_synthetic_share = max_synthetic_share
 
         column_type = self.aircloak.column_info(table, column).type
-        assert column_type in [
-            'integer', 'real'], f'NumericColumnExplorer can only deal with numeric columns but {self.column} is of type {column_type}'
+        assert column_type in self.COLUMN_TYPES, \
+            f'{type(self).__name__} can only deal with {self.COLUMN_TYPES} columns but {self.column} is of type {column_type}'
 
-        self._top_level_stats = self.aircloak.fetch(
-            queries.top_level_stats(table=self.table, column=self.column))['rows'][0]
+        # The top level queries are independent of each other, so send them both before waiting
+        top_level_stats = self.aircloak.fetch_async(self._top_level_query())
+        distincts = self.aircloak.submit(DistinctProfile, aircloak_connection=self.aircloak,
+                                         table=self.table, column=self.column, limit=distinct_limit)
 
-        self._distincts = self.aircloak.fetch(
-            queries.top_level_distinct(table=self.table, column=self.column))
+        self._top_level_stats = self._decode_top_level_stats(top_level_stats.result()['rows'][0])
+        self._distincts = distincts.result()
 
-        self._suppressed_count = next(
-            r['count'] for r in self._distincts['rows'] if r[self.column] == None)
+        self._suppressed_count = self._distincts.suppressed_count
 
         self._suppressed_ratio = self._suppressed_count / \
             self._top_level_stats['count']
@@ -32,60 +58,380 @@ class NumericColumnExplorer:
         self._data_range = self._top_level_stats['max'] - \
             self._top_level_stats['min']
 
-        self._bucket_tree = bt.BucketTree(
-            self._data_range, self._distincts, self._top_level_stats['count'], self._suppressed_count)
+        self._bucket_tree = self._create_tree(column_type)
 
         self._column_labels = []
 
-    def explore(self, depth=3):
-        to_explore = self._bucket_tree.next_levels(depth)
+        self._prefetch = prefetch
+        # Tuple of (query plan, future query results) for the levels queried in the background
+        self._prefetched = None
+
+    def _top_level_query(self):
+        '''The query for the min, max, count and count_noise of the column
+        '''
+        return queries.top_level_stats(table=self.table, column=self.column)
+
+    def _decode_top_level_stats(self, row):
+        '''The result row of `_top_level_query` as a mapping of stats that the bucket tree can use
+        '''
+        return row
+
+    def _create_tree(self, column_type):
+        '''The bucket tree for a column of column_type, once the top level stats are known
+        '''
+        return bt.BucketTree(
+            self._data_range, self._distincts, self._top_level_stats['count'], self._suppressed_count)
+
+    @classmethod
+    def from_snapshot(cls, path, *, aircloak_connection=None, mmap=True, prefetch=True,
+                      budget=bucket_util.DEFAULT_BUDGET, max_synthetic_share=0.0):
+        '''Reopen an explorer saved with `save`, without querying the cloak.
+
+        :param aircloak_connection: The connection used to continue exploring. Without a connection,
+            only the saved buckets can be used.
+        :param mmap: Memory-map the bucket data instead of reading the whole snapshot, see `snapshot.load`
+        '''
+        explorer = cls.__new__(cls)
+        tree, extra = snapshot.load(path, mmap=mmap)
+
+        explorer.table = extra['table']
+        explorer.column = extra['column']
+        explorer.aircloak = aircloak_connection
+        explorer.budget = budget
+        explorer.max_synthetic_share = max_synthetic_share
+        explorer._top_level_stats = extra['top_level_stats']
+        explorer._distincts = DistinctProfile.from_summary(
+            extra['distincts'], aircloak_connection=aircloak_connection)
+        explorer._suppressed_count = explorer._distincts.suppressed_count
+        explorer._suppressed_ratio = explorer._suppressed_count / \
+            explorer._top_level_stats['count']
+        explorer._data_range = explorer._top_level_stats['max'] - \
+            explorer._top_level_stats['min']
+
+        tree._unbucketed['data'] = explorer._distincts
+        explorer._bucket_tree = tree
+        explorer._column_labels = extra['column_labels']
+        explorer._prefetch = prefetch
+        explorer._prefetched = None
+        return explorer
+
+    def save(self, path):
+        '''Save the explored buckets and everything needed to continue exploring to a snapshot file
+        '''
+        snapshot.save(self._bucket_tree, path, extra={
+            'table': self.table,
+            'column': self.column,
+            'top_level_stats': dict(self._top_level_stats.items()),
+            'distincts': self._distincts.summary(),
+            'column_labels': list(self._column_labels),
+        })
+
+    def explore(self, depth=3, *, stream=False, chunk_size=CHUNK_SIZE, on_chunk=None):
+        '''Explore the next `depth` bucket levels
+
+        :param stream: Stream the query results in chunks of `chunk_size` rows (through a server-side
+            cursor when talking to a cloak) and build the levels incrementally, so memory use is bounded
+            by the chunk size instead of the result size. Streamed results bypass the query cache.
+        :param on_chunk: When streaming, called with the explorer after each chunk. The buckets received
+            so far can be inspected with `partial_level`.
+        '''
+        plan = self._plan_queries(depth)
+        if len(plan) == 0:
+            logging.debug('All bucket levels have been explored.')
+            return
+
+        pending = self._take_prefetched(plan)
+        if pending is None and stream:
+            self._stream_plan(plan, chunk_size, on_chunk)
+            return
 
-        query_result = self.aircloak.fetch(queries.multi_bucket_stats(
-            table=self.table, column=self.column, buckets=to_explore))
+        if pending is None:
+            pending = self._send_plan(plan)
+        query_results = [future.result() for future in pending]
 
         logging.debug("Received query results, processing...")
 
-        self._process_query_result(to_explore, query_result)
+        with instrumentation.timed('explorer.process', rows=sum(len(result['rows']) for result in query_results)):
+            self._process_planned_results(plan, query_results)
 
         logging.debug("... finished processing query results.")
 
-    def _process_query_result(self, bucket_sizes, query_result):
-        '''Add the bucket size and bucket lower bound columns to each row
+        if self._prefetch:
+            self._prefetch_levels(depth)
+
+    def partial_level(self, bucket_size):
+        '''The buckets received so far of a level that is being streamed by `explore(stream=True)`
+        '''
+        return self._bucket_tree.partial_level(bucket_size)
+
+    def _stream_plan(self, plan, chunk_size, on_chunk):
+        '''Run the queries of a plan one after the other, adding their rows to the levels chunk by chunk
         '''
         if len(self._column_labels) == 0:
-            self._column_labels = query_result['labels'][len(bucket_sizes):]
+            self._column_labels = list(bt.DATA_COLUMNS)
+
+        builders = self._bucket_tree.stream_levels(
+            [bs for planned in plan for bs in planned.bucket_sizes])
+        try:
+            suppressed = defaultdict(int)
+            for planned in plan:
+                star_counts = []
+                query = self._bucket_query(planned.bucket_sizes, planned.value_range)
+                # Closing the chunks returns the connection to the pool, also when a chunk fails
+                with closing(self.aircloak.fetch_chunks(query, chunk_size)) as chunks:
+                    for rows in chunks:
+                        with instrumentation.timed('explorer.process', rows=len(rows)):
+                            bucket_data, chunk_star_counts = self._decode_rows(planned.bucket_sizes, rows)
+                            for (bs, (lower_bounds, data)) in bucket_data.items():
+                                builders[bs].add(lower_bounds, data)
+                            star_counts += chunk_star_counts
+                        if on_chunk is not None:
+                            on_chunk(self)
+
+                for (bs, star_count) in assign_suppressed(planned.bucket_sizes, star_counts).items():
+                    suppressed[bs] += star_count
+
+            with instrumentation.timed('explorer.process', rows=0):
+                self._bucket_tree.finish_streaming(suppressed)
+                if self.max_synthetic_share is not None:
+                    self._bucket_tree.derive_levels(self.max_synthetic_share)
+        finally:
+            # If a query or chunk failed, the levels received so far are incomplete and must not be inserted.
+            # They stay left to explore.
+            self._bucket_tree.cancel_streaming()
+
+    def _plan_queries(self, depth):
+        '''Plan the queries for the next `depth` bucket levels, see `BucketTree.plan_queries`
+        '''
+        return self._bucket_tree.plan_queries(
+            depth, self.budget, self.max_synthetic_share,
+            value_range=(self._top_level_stats['min'], self._top_level_stats['max']))
+
+    def _send_plan(self, plan):
+        '''Send the queries of a plan concurrently
+
+        :returns: A list of futures, one per `bucket_util.PlannedQuery`
+        '''
+        logging.debug('Querying %s', plan)
+        return [self.aircloak.fetch_async(self._bucket_query(planned.bucket_sizes, planned.value_range),
+                                          cursor_factory=None) for planned in plan]
+
+    def _bucket_query(self, bucket_sizes, value_range=None):
+        '''The query for the buckets of several sizes, restricted to value_range if given
+        '''
+        return queries.multi_bucket_stats(table=self.table, column=self.column, buckets=bucket_sizes,
+                                          value_range=value_range)
+
+    def _prefetch_levels(self, depth):
+        '''Start querying the levels that the next call to `explore(depth)` will need.
+        '''
+        plan = self._plan_queries(depth)
+        if len(plan) == 0:
+            return
+
+        logging.debug('Prefetching bucket levels %s', plan)
+        self._prefetched = (plan, self._send_plan(plan))
+
+    def _take_prefetched(self, plan):
+        '''Return the prefetched query results if they match the requested plan, otherwise
+        discard them and return None.
+        '''
+        if self._prefetched is None:
+            return None
+
+        prefetched_plan, futures = self._prefetched
+        self._prefetched = None
+        if prefetched_plan != plan:
+            logging.debug('Discarding prefetched queries %s, requested %s',
+                          prefetched_plan, plan)
+            for future in futures:
+                future.cancel()
+            return None
+
+        return futures
 
-        suppressed = []
+    def zoom(self, value_range=None, *, by='count', top=3, depth=2):
+        '''Explore finer bucket levels, but only within some ranges of values.
+
+        The queries are restricted to the ranges, so their size depends on the ranges rather than on the
+        whole column. The results are merged into the bucket tree as partially explored levels.
+
+        :param value_range: A (lo, hi) range to explore. Aircloak only accepts aligned ranges, so the
+            range is widened to the nearest one it accepts.
+        :param by: If no range is given, how to pick regions from the explored buckets, see
+            `BucketTree.select_regions`.
+        :param top: If no range is given, the number of buckets to pick.
+        :param depth: The number of finer bucket levels to explore in each range.
+        '''
+        if self._bucket_tree.calendar:
+            raise ValueError(f'Levels of calendar units are not split into ranges, {self.column} can not be zoomed into')
+
+        if value_range is not None:
+            regions = [value_range]
+        else:
+            regions = self._bucket_tree.select_regions(by, top)
+
+        pending = []
+        for region in aligned_regions(regions):
+            to_explore = self._bucket_tree.levels_to_zoom(region, depth)
+            if len(to_explore) == 0:
+                logging.debug('Range %s has already been explored', region)
+                continue
+
+            logging.debug('Zooming into range %s, bucket levels %s', region, to_explore)
+            pending.append((region, to_explore, self.aircloak.fetch_async(
+                self._bucket_query(to_explore, region), cursor_factory=None)))
+
+        for (region, to_explore, query_result) in pending:
+            query_result = query_result.result()
+            with instrumentation.timed('explorer.process', rows=len(query_result['rows'])):
+                self._process_query_result(
+                    to_explore, query_result, value_range=region)
+
+    def _process_planned_results(self, plan, query_results):
+        '''Insert the results of a query plan into the bucket tree
+
+        The buckets and suppressed counts of a level split over several ranges are added up, so every
+        level is inserted as if it had been queried over the whole column. The only difference is that each
+        range has its own star row, which the cloak suppresses too if it holds too few values.
+        '''
         bucket_data = defaultdict(list)
-        for row in query_result['rows']:
-            for (bs_label, bs) in [('bucket_' + str(bs), bs) for bs in bucket_sizes]:
-                if row[bs_label] is not None:
-                    # Note: row[bs_label] is the lower bound of the bucket, bs is the bucket size
-                    bucket_data[bs].append(
-                        bt.Bucket(bs, row[bs_label], row[len(bucket_sizes):]))
-                    break
-            else:
-                # HACK ALERT: No bucket_XXX column was filled. This can mean one of two things:
-                # Either 1. The data was suppressed ("star rows')
-                #     OR 2. All three columns are NULL (ie. no data to be bucketed)
-                # The query has been filtered using 'WHERE {column} IS NOT NULL' so assume
-                # that any NULL rows are in fact STAR (suppressed) columns
-                suppressed.append(row['count'])
-
-        # Bigger buckets mean fewer suppressed rows, so we can assume that the smallest
-        # number of suppressed rows match the largest bucket sizes.
-        for bs, sup in zip(sorted(bucket_sizes, reverse=True), sorted(suppressed)):
+        suppressed = defaultdict(int)
+        for (planned, query_result) in zip(plan, query_results):
+            query_buckets, query_suppressed = self._decode_query_result(
+                planned.bucket_sizes, query_result)
+            for bs in planned.bucket_sizes:
+                bucket_data[bs].append(query_buckets[bs])
+                suppressed[bs] += query_suppressed[bs]
+
+        for bs in sorted(bucket_data.keys(), reverse=True):
+            parts = bucket_data[bs]
+            lower_bounds = np.concatenate([lower_bounds for (lower_bounds, _) in parts])
+            data = np.concatenate([data for (_, data) in parts])
             self._bucket_tree.insert_query_result(
-                bs, bucket_data[bs], suppressed=sup)
+                bs, lower_bounds=lower_bounds, data=data, suppressed=suppressed[bs])
+
+        if self.max_synthetic_share is not None:
+            derived = self._bucket_tree.derive_levels(self.max_synthetic_share)
+            if len(derived) > 0:
+                logging.debug('Derived bucket levels %s', derived)
+
+    def _process_query_result(self, bucket_sizes, query_result, value_range=None):
+        '''Insert the result of a bucketed query into the bucket tree
+
+        :param value_range: The range the query was restricted to, or None if it covered the whole column
+        '''
+        bucket_data, suppressed = self._decode_query_result(
+            bucket_sizes, query_result)
+        for bs in sorted(bucket_sizes, reverse=True):
+            lower_bounds, data = bucket_data[bs]
+            if value_range is None:
+                self._bucket_tree.insert_query_result(
+                    bs, lower_bounds=lower_bounds, data=data, suppressed=suppressed[bs])
+            else:
+                self._bucket_tree.insert_range_result(
+                    bs, None, value_range, suppressed=suppressed[bs], lower_bounds=lower_bounds, data=data)
+
+    def _decode_query_result(self, bucket_sizes, query_result):
+        '''Split the rows of a bucketed query into bucket arrays per bucket size
+
+        :returns: A tuple of (dict of bucket size -> (lower bounds, data), dict of bucket size -> suppressed count)
+        '''
+        labels = query_result['labels']
+        if len(self._column_labels) == 0:
+            self._column_labels = labels[len(bucket_sizes):]
+
+        bucket_data, star_counts = self._decode_rows(bucket_sizes, query_result['rows'])
+        return bucket_data, assign_suppressed(bucket_sizes, star_counts)
+
+    def _decode_rows(self, bucket_sizes, rows):
+        '''Split rows of the query from `_bucket_query` into bucket arrays, see `decode_rows`
+        '''
+        return decode_rows(bucket_sizes, rows)
 
     def extract_to_dataframe(self, bucket_sizes=[]):
         # reshape the data and return args for pandas dataframe contructor
 
         return {
-            'data': self._bucket_tree.get_buckets(bucket_sizes),
+            'data': self.extract_arrays(bucket_sizes),
             'columns': ['bucket_size', 'lower_bound', *self._column_labels],
         }
 
+    def extract_arrays(self, bucket_sizes=[]):
+        '''Export the explored buckets as typed arrays, one per column.
+
+        :param bucket_sizes: A list of bucket sizes or a slice over the explored levels, see
+            `BucketTree.get_columns`. All levels are exported by default.
+        :returns: A dict of NumPy arrays keyed by 'bucket_size', 'lower_bound', the value columns
+            and 'synthetic'. The arrays are read-only.
+        '''
+        return self._bucket_tree.get_columns(bucket_sizes)
+
+    def extract_to_arrow(self, bucket_sizes=[]):
+        '''Export the explored buckets as a `pyarrow.Table`, see `extract_arrays`
+        '''
+        try:
+            import pyarrow as pa
+        except ImportError as e:
+            raise ImportError(
+                'extract_to_arrow requires pyarrow to be installed') from e
+
+        columns = self.extract_arrays(bucket_sizes)
+        # broadcast columns are not contiguous and can't be shared with arrow
+        return pa.table({name: np.ascontiguousarray(array) for (name, array) in columns.items()})
+
+
+def decode_rows(bucket_sizes, rows):
+    '''Split rows of a bucketed query into bucket arrays per bucket size
+
+    The rows are plain tuples of the bucket columns (one per bucket size, in order) followed by the
+    stats columns. They are converted into a single float array in one go, NULLs becoming NaN, and
+    split into levels with a mask per bucket column.
+
+    :returns: A tuple of (dict of bucket size -> (lower bounds, data), list of star row counts)
+    '''
+    num_sizes = len(bucket_sizes)
+    table = np.array(rows, dtype=np.float64).reshape(-1, num_sizes + len(bt.DATA_COLUMNS))
+
+    bucket_data = {}
+    unassigned = np.ones(len(table), dtype=bool)
+    for (i, bs) in enumerate(bucket_sizes):
+        # Each row belongs to the first bucket column that is not NULL
+        in_level = unassigned & ~np.isnan(table[:, i])
+        unassigned &= ~in_level
+        bucket_data[bs] = (table[in_level, i], table[in_level, num_sizes:])
+
+    # HACK ALERT: Rows without any bucket_XXX column filled can mean one of two things:
+    # Either 1. The data was suppressed ("star rows')
+    #     OR 2. All three columns are NULL (ie. no data to be bucketed)
+    # The query has been filtered using 'WHERE {column} IS NOT NULL' so assume
+    # that any NULL rows are in fact STAR (suppressed) columns
+    return bucket_data, [int(count) for count in table[unassigned, num_sizes]]
+
+
+def assign_suppressed(bucket_sizes, star_counts):
+    '''Match the star rows of a bucketed query to its bucket sizes
+
+    :returns: A dict of bucket size -> suppressed count
+    '''
+    # Bigger buckets mean fewer suppressed rows, so we can assume that the smallest
+    # number of suppressed rows match the largest bucket sizes. Levels without a star row
+    # had nothing suppressed.
+    suppressed = [0] * (len(bucket_sizes) - len(star_counts)) + sorted(star_counts)
+    return dict(zip(sorted(bucket_sizes, reverse=True), suppressed))
+
+
+def aligned_regions(ranges):
+    '''Widen ranges to ranges that Aircloak accepts, merging them where they overlap after widening
+    '''
+    regions = bucket_util.merge_ranges(ranges)
+    while True:
+        aligned = bucket_util.merge_ranges(
+            bucket_util.aligned_range(lo, hi) for (lo, hi) in regions)
+        if aligned == regions:
+            return aligned
+        regions = aligned
+
 
 if __name__ == "__main__":
     from .connection import AircloakConnection
@@ -0,0 +1,171 @@
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import psycopg2
+
+from . import bucket_util
+from .numeric_explorer import NumericColumnExplorer
+from .datetime_explorer import DateTimeColumnExplorer, DATETIME_TYPES
+from .table_explorer import NUMERIC_TYPES
+
+'''CLOAK_LIMIT is the default number of columns explored at the same time against one cloak, shared by
+all profilers in the process. Each profiler is further capped by the pool size of its connection.
+'''
+CLOAK_LIMIT = 4
+
+'''A column is explored up to RETRIES more times if it fails with one of RETRY_ERRORS, waiting BACKOFF
+seconds before the first retry and twice as long before each following one. Only lost or refused
+connections are retried, errors reported by the cloak for a query (eg. an unsupported query) are not.
+'''
+RETRIES = 2
+BACKOFF = 1.0
+RETRY_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, OSError)
+
+'''ColumnResult is reported for every profiled column
+path: The snapshot file of the column, None if it failed
+error: The exception that made the column fail, None if it succeeded
+attempts: The number of times the column was explored
+duration: Wall clock time in seconds, including retries
+'''
+ColumnResult = namedtuple(
+    'ColumnResult', 'table column path error attempts duration')
+
+_cloak_slots = {}
+_cloak_slots_lock = threading.Lock()
+
+
+class Profiler:
+    '''Explore all numeric and date/time columns of a data source and save each one as a snapshot file.
+
+    Columns are explored concurrently on a bounded pool of workers, and each column's snapshot is written
+    as soon as it is done, so a partial run still leaves usable results. The snapshots can be reopened
+    with `NumericColumnExplorer.from_snapshot`.
+    '''
+
+    def __init__(self, *, aircloak_connection, output_dir, tables=None, depth=3, rounds=2, workers=None,
+                 cloak_limit=CLOAK_LIMIT, retries=RETRIES, backoff=BACKOFF, progress=None,
+                 budget=bucket_util.DEFAULT_BUDGET):
+        '''
+        :param tables: The tables to profile, all tables of the data source by default.
+        :param depth: The number of bucket levels explored per round, see `NumericColumnExplorer.explore`
+        :param rounds: The number of calls to `explore` per column
+        :param workers: The number of columns explored at the same time, by default the `pool_size` of the
+            connection. The connection sends at most `pool_size` queries at the same time, so it can not
+            be exceeded: further workers would only wait for a free connection.
+        :param cloak_limit: The number of columns explored at the same time against this cloak, across all
+            profilers. The limit is fixed by the first profiler that uses the cloak. Within one profiler,
+            at most `workers` columns are explored at the same time whatever the limit.
+        :param progress: Called as progress(done, total, `ColumnResult`) whenever a column finishes.
+        '''
+        self.aircloak = aircloak_connection
+        self.output_dir = output_dir
+        self.tables = tables
+        self.depth = depth
+        self.rounds = rounds
+        self.workers = workers if workers is not None else aircloak_connection.pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self.progress = progress
+        self.budget = budget
+
+        if self.workers > aircloak_connection.pool_size:
+            raise ValueError(f'{self.workers} workers need a connection with a pool_size of at least '
+                             f'{self.workers}, not {aircloak_connection.pool_size}')
+
+        self._cloak_slots = cloak_slots(aircloak_connection, cloak_limit)
+
+    def columns(self):
+        '''The (table, column) pairs to profile
+        '''
+        tables = self.tables if self.tables is not None else list(
+            self.aircloak.tables().keys())
+        column_info = self.aircloak.prefetch_columns(tables)
+        return [(table, column) for table in tables
+                for (column, info) in column_info[table].items() if info.type in NUMERIC_TYPES + DATETIME_TYPES]
+
+    def run(self):
+        '''Profile all columns
+
+        :returns: A list of `ColumnResult`, in the order the columns finished
+        '''
+        os.makedirs(self.output_dir, exist_ok=True)
+        columns = self.columns()
+        logging.debug('Profiling %d columns with %d workers',
+                      len(columns), self.workers)
+
+        results = []
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='profiler') as executor:
+            futures = [executor.submit(self._profile_column, table, column)
+                       for (table, column) in columns]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                self._report(len(results), len(columns), result)
+
+        return results
+
+    def _profile_column(self, table, column):
+        start = time.perf_counter()
+        path = os.path.join(self.output_dir, snapshot_name(table, column))
+        explorer_class = DateTimeColumnExplorer \
+            if self.aircloak.column_info(table, column).type in DATETIME_TYPES else NumericColumnExplorer
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                with self._cloak_slots:
+                    explorer = explorer_class(aircloak_connection=self.aircloak, table=table, column=column,
+                                              prefetch=False, budget=self.budget)
+                    for _ in range(self.rounds):
+                        explorer.explore(self.depth)
+                explorer.save(path)
+                return ColumnResult(table, column, path, None, attempts, time.perf_counter() - start)
+            except RETRY_ERRORS as e:
+                if attempts > self.retries:
+                    return ColumnResult(table, column, None, e, attempts, time.perf_counter() - start)
+                delay = self.backoff * 2 ** (attempts - 1)
+                logging.debug('Exploring %s.%s failed with %s, retrying in %.1fs',
+                              table, column, e, delay)
+                time.sleep(delay)
+            except Exception as e:
+                return ColumnResult(table, column, None, e, attempts, time.perf_counter() - start)
+
+    def _report(self, done, total, result):
+        if self.progress is not None:
+            self.progress(done, total, result)
+        elif result.error is None:
+            logging.debug('[%d/%d] Profiled %s.%s in %.1fs',
+                          done, total, result.table, result.column, result.duration)
+        else:
+            logging.debug('[%d/%d] Failed to profile %s.%s: %s',
+                          done, total, result.table, result.column, result.error)
+
+
+def cloak_slots(aircloak_connection, limit):
+    '''The semaphore limiting the columns explored at the same time against the connection's cloak
+    '''
+    key = (aircloak_connection.host, aircloak_connection.port)
+    with _cloak_slots_lock:
+        if key not in _cloak_slots:
+            _cloak_slots[key] = threading.BoundedSemaphore(limit)
+        return _cloak_slots[key]
+
+
+def snapshot_name(table, column):
+    return f'{table}.{column}.snapshot'.replace(os.sep, '_')
+
+
+if __name__ == "__main__":
+    import sys
+    from .connection import AircloakConnection
+    logging.basicConfig(level=logging.DEBUG)
+
+    dbname, output_dir = sys.argv[1:3]
+    profiler = Profiler(aircloak_connection=AircloakConnection(dbname=dbname),
+                        output_dir=output_dir)
+    for result in profiler.run():
+        print(result.table, result.column, result.path or result.error)
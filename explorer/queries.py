@@ -1,5 +1,22 @@
 import logging
 from psycopg2 import sql
+from psycopg2.extensions import adapt
+
+
+def as_text(query: sql.Composable) -> str:
+    '''Render a query to a string without a database connection, for use as a cache key or by a
+    backend that doesn't speak the PostgreSQL protocol. Supports the composables used in this module.
+    '''
+    if isinstance(query, sql.Composed):
+        return ''.join(as_text(part) for part in query.seq)
+    if isinstance(query, sql.SQL):
+        return query.string
+    if isinstance(query, sql.Identifier):
+        return '.'.join('"' + s.replace('"', '""') + '"' for s in query.strings)
+    if isinstance(query, sql.Literal):
+        return adapt(query.wrapped).getquoted().decode()
+
+    raise TypeError(f'Can not render {query!r} without a connection')
 
 
 def column_info(*, table: str):
@@ -25,6 +42,51 @@ def top_level_distinct(*, table: str, column: str):
     ''').format(table=sql.Identifier(table), column=sql.Identifier(column))
 
 
+def top_distinct(*, table: str, column: str, limit: int):
+    '''The `limit` most frequent values of a column with their counts, most frequent first. The star row
+    of suppressed values is only included if it is among them.
+    '''
+    return sql.SQL('''
+        SELECT
+            {column}
+        ,   count(*)
+        FROM {table}
+        WHERE {column} IS NOT NULL
+        GROUP BY 1
+        ORDER BY 2 DESC
+        LIMIT {limit}
+    ''').format(table=sql.Identifier(table), column=sql.Identifier(column), limit=sql.Literal(limit))
+
+
+def suppressed_distinct(*, table: str, column: str):
+    '''The star row of the distinct values of a column. As NULL values are filtered out, the only row
+    with a NULL value is the star row, which sorts first. If there is no star row, the smallest value
+    is returned instead.
+    '''
+    return sql.SQL('''
+        SELECT
+            {column}
+        ,   count(*)
+        FROM {table}
+        WHERE {column} IS NOT NULL
+        GROUP BY 1
+        ORDER BY 1 NULLS FIRST
+        LIMIT 1
+    ''').format(table=sql.Identifier(table), column=sql.Identifier(column))
+
+
+def distinct_stats(*, table: str, column: str):
+    '''The count and the number of distinct values of the non-NULL values of a column
+    '''
+    return sql.SQL('''
+        SELECT
+            count(*)
+        ,   count(DISTINCT {column})
+        FROM {table}
+        WHERE {column} IS NOT NULL
+    ''').format(table=sql.Identifier(table), column=sql.Identifier(column))
+
+
 def top_level_stats(*, table: str, column: str):
     return sql.SQL('''
         SELECT
@@ -52,7 +114,12 @@ def bucketed_stats(*, table: str, column: str, bucket_size: int):
     ''').format(table=sql.Identifier(table), column=sql.Identifier(column), bucket_size=sql.Literal(bucket_size))
 
 
-def multi_bucket_stats(*, table: str, column: str, buckets: list):
+def multi_bucket_stats(*, table: str, column: str, buckets: list, value_range: tuple = None):
+    '''Bucketed stats for several bucket sizes in one query, one grouping set per bucket size.
+
+    :param value_range: Optional (lo, hi) to restrict the query to values lo <= value < hi. Aircloak
+        only accepts aligned ranges, see `bucket_util.aligned_range`.
+    '''
     buckets_sql = sql.Composed(
         sql.SQL('bucket({column} by {bucket_size}) as {label}').format(
             bucket_size=sql.Literal(bucket_size),
@@ -69,11 +136,122 @@ def multi_bucket_stats(*, table: str, column: str, buckets: list):
     ,   max({column})
     ,   avg({column})
     FROM {table}
+    WHERE {column} IS NOT NULL{range}
+    GROUP BY GROUPING SETS ({sets})
+    ''').format(
+        buckets=buckets_sql,
+        column=sql.Identifier(column),
+        table=sql.Identifier(table),
+        range=range_condition(column, value_range),
+        sets=sql.SQL(', ').join(sql.Literal(i+1) for i in range(len(buckets)))
+    )
+
+
+def datetime_stats(*, table: str, column: str):
+    '''Top level stats of a date/time column: min, max, count and count_noise of its non-NULL values
+    '''
+    return sql.SQL('''
+        SELECT
+            min({column})
+        ,   max({column})
+        ,   count({column})
+        ,   count_noise({column})
+        FROM {table}
+    ''').format(table=sql.Identifier(table), column=sql.Identifier(column))
+
+
+def multi_granularity_stats(*, table: str, column: str, units: list):
+    '''Stats of a date/time column truncated to several calendar units in one query, one grouping set per
+    unit, see `bucket_util.CALENDAR_UNITS`.
+
+    The result has one bucket column per unit, then count, count_noise, min and max. There is no average
+    of date/time values.
+    '''
+    buckets_sql = sql.Composed(
+        sql.SQL('date_trunc({unit}, {column}) as {label}').format(
+            unit=sql.Literal(unit),
+            label=sql.Identifier(f'bucket_{unit}'),
+            column=sql.Identifier(column))
+        for unit in units).join('\n, ')
+
+    return sql.SQL('''
+    SELECT
+        {buckets}
+    ,   count(*)
+    ,   count_noise(*)
+    ,   min({column})
+    ,   max({column})
+    FROM {table}
     WHERE {column} IS NOT NULL
     GROUP BY GROUPING SETS ({sets})
     ''').format(
         buckets=buckets_sql,
         column=sql.Identifier(column),
         table=sql.Identifier(table),
+        sets=sql.SQL(', ').join(sql.Literal(i+1) for i in range(len(units)))
+    )
+
+
+def range_condition(column: str, value_range: tuple):
+    if value_range is None:
+        return sql.SQL('')
+
+    lo, hi = value_range
+    return sql.SQL(' AND {column} >= {lo} AND {column} < {hi}').format(
+        column=sql.Identifier(column), lo=sql.Literal(lo), hi=sql.Literal(hi))
+
+
+def multi_column_stats(*, table: str, columns: list):
+    '''Top level stats for several columns in one query: min, max, avg, count and count_noise of the
+    non-NULL values of each column, in that order.
+    '''
+    column_stats = sql.SQL('\n    ,   ').join(
+        sql.SQL('min({column}), max({column}), avg({column}), count({column}), count_noise({column})').format(
+            column=sql.Identifier(column))
+        for column in columns)
+
+    return sql.SQL('''
+    SELECT
+        {column_stats}
+    FROM {table}
+    ''').format(column_stats=column_stats, table=sql.Identifier(table))
+
+
+def multi_column_bucket_stats(*, table: str, buckets: list):
+    '''Bucketed stats for several columns and bucket sizes in one query, one grouping set per
+    (column, bucket size) pair.
+
+    The result has one bucket column per pair, then a `grouping_id` column identifying the grouping
+    set of each row, then count, count_noise, min, max and avg of each column.
+
+    :param buckets: A list of (column, bucket size) pairs
+    '''
+    bucket_exprs = [sql.SQL('bucket({column} by {bucket_size})').format(
+        column=sql.Identifier(column), bucket_size=sql.Literal(bucket_size))
+        for (column, bucket_size) in buckets]
+
+    buckets_sql = sql.SQL('\n    ,   ').join(
+        sql.SQL('{expr} as {label}').format(
+            expr=expr, label=sql.Identifier(f'bucket_{i}'))
+        for (i, expr) in enumerate(bucket_exprs))
+
+    columns = list(dict.fromkeys(column for (column, _) in buckets))
+    column_stats = sql.SQL('\n    ,   ').join(
+        sql.SQL('count({column}), count_noise({column}), min({column}), max({column}), avg({column})').format(
+            column=sql.Identifier(column))
+        for column in columns)
+
+    return sql.SQL('''
+    SELECT
+        {buckets}
+    ,   grouping_id({bucket_exprs})
+    ,   {column_stats}
+    FROM {table}
+    GROUP BY GROUPING SETS ({sets})
+    ''').format(
+        buckets=buckets_sql,
+        bucket_exprs=sql.SQL(', ').join(bucket_exprs),
+        column_stats=column_stats,
+        table=sql.Identifier(table),
         sets=sql.SQL(', ').join(sql.Literal(i+1) for i in range(len(buckets)))
     )
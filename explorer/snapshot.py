@@ -0,0 +1,180 @@
+import json
+import logging
+import os
+import struct
+import tempfile
+from collections import namedtuple
+
+import numpy as np
+
+from . import bucket_tree as bt
+
+'''Snapshots store a `BucketTree` in a single binary file, so an explored column can be reopened,
+compared or shared without querying the cloak again.
+
+Layout:
+    MAGIC                8 bytes
+    header length        unsigned 64 bit little endian integer
+    header               UTF-8 JSON: the tree state, the levels with their metadata, covered ranges and
+                         the offset, dtype and length of each column, and any extra data (eg. explorer labels)
+    column data          raw little endian arrays, each starting at a multiple of ALIGNMENT bytes
+
+Because the columns are stored raw and aligned, they can be memory-mapped on load: opening a snapshot
+only reads the header, and bucket data is paged in when it is used.
+'''
+MAGIC = b'AXSNAP\x00\x01'
+VERSION = 1
+ALIGNMENT = 64
+
+LEVEL_COLUMNS = ['lower_bound', *bt.DATA_COLUMNS, 'synthetic']
+COLUMN_DTYPES = {name: np.dtype('<f8') for name in ['lower_bound', *bt.DATA_COLUMNS]}
+COLUMN_DTYPES['synthetic'] = np.dtype('|b1')
+
+'''LevelDiff summarises the differences of a bucket level between two trees
+only_a, only_b: The number of buckets that exist in only one of the trees
+changed: The number of buckets in both trees with different counts
+max_count_change: The largest absolute count difference of a bucket in both trees
+'''
+LevelDiff = namedtuple(
+    'LevelDiff', 'bucket_size only_a only_b changed max_count_change')
+
+
+def save(tree, path, extra=None):
+    '''Write a `BucketTree` to a snapshot file
+
+    The file is written next to `path` and then moved over it, so a tree memory-mapped from `path` (eg. an
+    explorer reopened from it) can be saved back to it.
+
+    :param extra: A dict of JSON-serialisable values stored alongside the tree, returned by `load`
+    '''
+    levels = []
+    arrays = []
+    offset = 0
+    for bucket_size in sorted(tree.bucket_levels(), reverse=True):
+        level = tree.level(bucket_size)
+        columns = {}
+        for name in LEVEL_COLUMNS:
+            array = np.ascontiguousarray(
+                level.column(name), dtype=COLUMN_DTYPES[name])
+            columns[name] = {'offset': offset,
+                             'dtype': array.dtype.str, 'length': len(array)}
+            arrays.append((offset, array))
+            offset = _align(offset + array.nbytes)
+
+        levels.append({
+            'bucket_size': bt.to_json(bucket_size),
+            'metadata': level.metadata,
+            'covered': bt.to_json(level.covered),
+            'columns': columns,
+        })
+
+    header = json.dumps({
+        'version': VERSION,
+        'tree': tree.state(),
+        'levels': levels,
+        'extra': extra if extra is not None else {},
+    }, default=bt.to_json).encode()
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                     prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            f.write(b'\0' * (data_start - f.tell()))
+            for (array_offset, array) in arrays:
+                f.write(b'\0' * (data_start + array_offset - f.tell()))
+                f.write(array.tobytes())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+    logging.debug('Saved %d bucket levels to %s', len(levels), path)
+
+
+def load(path, mmap=True, unbucketed_data=None):
+    '''Read a snapshot file written by `save`
+
+    :param mmap: Memory-map the column data instead of reading it into memory. The snapshot file must
+        then not be modified while the tree is in use.
+    :param unbucketed_data: Passed on to the restored `BucketTree`
+    :returns: A tuple of (`BucketTree`, extra data)
+    '''
+    with open(path, 'rb') as f:
+        magic = f.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a bucket tree snapshot')
+        (header_length,) = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_length).decode())
+        data_start = _align(len(MAGIC) + 8 + header_length)
+
+        if header['version'] != VERSION:
+            raise ValueError(
+                f'Unsupported snapshot version {header["version"]} in {path}')
+
+        if mmap:
+            data = np.memmap(f, dtype=np.uint8, mode='r', offset=data_start) \
+                if _has_data(header) else np.empty(0, dtype=np.uint8)
+        else:
+            f.seek(data_start)
+            data = np.frombuffer(f.read(), dtype=np.uint8)
+
+    levels = []
+    for level in header['levels']:
+        columns = {name: _column(data, column)
+                   for (name, column) in level['columns'].items()}
+        levels.append(bt.BucketLevel.from_columns(
+            bucket_size=level['bucket_size'], columns=columns,
+            metadata=level['metadata'], covered=level['covered']))
+
+    tree = bt.BucketTree.from_state(header['tree'], levels, unbucketed_data)
+    return tree, header['extra']
+
+
+def diff(a, b):
+    '''Compare the levels of two trees, eg. a snapshot and a fresh exploration of the same column
+
+    :returns: A dict of bucket size -> `LevelDiff` for every level explored in either tree
+    '''
+    result = {}
+    for bucket_size in sorted(set(a.bucket_levels()) | set(b.bucket_levels()), reverse=True):
+        level_a, level_b = a.level(bucket_size), b.level(bucket_size)
+        if level_a is None or level_b is None:
+            level = level_a if level_a is not None else level_b
+            result[bucket_size] = LevelDiff(bucket_size, len(level) if level_a is not None else 0,
+                                            len(level) if level_b is not None else 0, 0, 0.0)
+            continue
+
+        # Lower bounds are multiples of the bucket size, compare them on an integer grid
+        index_a = np.rint(level_a.column('lower_bound') / bucket_size).astype(np.int64)
+        index_b = np.rint(level_b.column('lower_bound') / bucket_size).astype(np.int64)
+        _, in_a, in_b = np.intersect1d(
+            index_a, index_b, assume_unique=True, return_indices=True)
+
+        count_change = np.abs(np.nan_to_num(level_a.column('count')[in_a]) -
+                              np.nan_to_num(level_b.column('count')[in_b]))
+        result[bucket_size] = LevelDiff(
+            bucket_size,
+            len(index_a) - len(in_a),
+            len(index_b) - len(in_b),
+            int(np.count_nonzero(count_change)),
+            float(count_change.max()) if len(count_change) > 0 else 0.0)
+
+    return result
+
+
+def _column(data, column):
+    dtype = np.dtype(column['dtype'])
+    start = column['offset']
+    return data[start:start + column['length'] * dtype.itemsize].view(dtype)
+
+
+def _has_data(header):
+    return any(column['length'] > 0 for level in header['levels'] for column in level['columns'].values())
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
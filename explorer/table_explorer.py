@@ -0,0 +1,122 @@
+import logging
+from collections import defaultdict
+
+from . import queries
+from . import bucket_tree as bt
+from . import instrumentation
+
+NUMERIC_TYPES = ['integer', 'real']
+
+
+class TableExplorer:
+    '''Explore the numeric columns of a table together.
+
+    Each call to `explore` sends a single query for the next bucket levels of all columns, and splits
+    the result into one `BucketTree` per column.
+    '''
+
+    def __init__(self, *, aircloak_connection, table, columns=None):
+        '''
+        :param columns: The columns to explore, all numeric columns of the table by default.
+        '''
+        self.table = table
+        self.aircloak = aircloak_connection
+
+        column_info = self.aircloak.columns(table)
+        if columns is None:
+            columns = [column for (column, info) in column_info.items()
+                       if info.type in NUMERIC_TYPES]
+
+        for column in columns:
+            column_type = column_info[column].type
+            assert column_type in NUMERIC_TYPES, f'TableExplorer can only deal with numeric columns but {column} is of type {column_type}'
+
+        stats = self.aircloak.fetch(queries.multi_column_stats(
+            table=self.table, columns=columns), cursor_factory=None)['rows'][0]
+
+        self._top_level_stats = {}
+        self._bucket_trees = {}
+        for (i, column) in enumerate(columns):
+            column_stats = dict(
+                zip(['min', 'max', 'avg', 'count', 'count_noise'], stats[i * 5:(i + 1) * 5]))
+            self._top_level_stats[column] = column_stats
+            if column_stats['min'] is None or not column_stats['count']:
+                logging.debug(
+                    'Skipping %s.%s, it has no values to explore', table, column)
+                continue
+
+            self._bucket_trees[column] = bt.BucketTree(
+                column_stats['max'] - column_stats['min'], None, column_stats['count'], None)
+
+        self.columns = list(self._bucket_trees.keys())
+
+    def explore(self, depth=3):
+        '''Explore the next `depth` bucket levels of every column in one query
+        '''
+        to_explore = [(column, bucket_size) for column in self.columns
+                      for bucket_size in self._bucket_trees[column].next_levels(depth)]
+        if len(to_explore) == 0:
+            logging.debug('All bucket levels have been explored.')
+            return
+
+        query_result = self.aircloak.fetch(queries.multi_column_bucket_stats(
+            table=self.table, buckets=to_explore), cursor_factory=None)
+
+        logging.debug("Received query results, processing...")
+
+        with instrumentation.timed('explorer.process', rows=len(query_result['rows'])):
+            self._process_query_result(to_explore, query_result['rows'])
+
+        logging.debug("... finished processing query results.")
+
+    def bucket_tree(self, column):
+        return self._bucket_trees[column]
+
+    def extract_arrays(self, column, bucket_sizes=[]):
+        '''Export the explored buckets of a column as typed arrays, see `NumericColumnExplorer.extract_arrays`
+        '''
+        return self._bucket_trees[column].get_columns(bucket_sizes)
+
+    def extract_to_dataframe(self, column, bucket_sizes=[]):
+        # return args for pandas dataframe contructor
+        return {
+            'data': self.extract_arrays(column, bucket_sizes),
+            'columns': ['bucket_size', 'lower_bound', *bt.DATA_COLUMNS],
+        }
+
+    def _process_query_result(self, to_explore, rows):
+        '''Split the rows by grouping set into buckets per (column, bucket size)
+
+        Unlike a single column query, the grouping_id of each row identifies its grouping set, so star rows
+        can be attributed to their bucket level exactly.
+        '''
+        num_sets = len(to_explore)
+        all_sets = (1 << num_sets) - 1
+        stats_offset = {column: num_sets + 1 + i * len(bt.DATA_COLUMNS)
+                        for (i, column) in enumerate(dict.fromkeys(column for (column, _) in to_explore))}
+
+        suppressed = defaultdict(int)
+        bucket_data = defaultdict(list)
+        for row in rows:
+            # grouping_id has a bit set for every bucket expression that is not grouped by,
+            # with the first expression as the most significant bit
+            set_index = num_sets - (all_sets - row[num_sets]).bit_length()
+            column, bucket_size = to_explore[set_index]
+            offset = stats_offset[column]
+            data = row[offset:offset + len(bt.DATA_COLUMNS)]
+
+            if row[set_index] is not None:
+                bucket_data[(column, bucket_size)].append(
+                    bt.Bucket(bucket_size, row[set_index], data))
+            elif data[0]:
+                # Without a bucket but with a count of non-NULL values, this is the star row
+                suppressed[(column, bucket_size)] += data[0]
+            # Otherwise the row groups the NULL values of the column
+
+        for column in self.columns:
+            levels = sorted((bucket_size for (c, bucket_size) in to_explore if c == column),
+                            reverse=True)
+            for bucket_size in levels:
+                self._bucket_trees[column].insert_query_result(
+                    bucket_size, bucket_data[(column, bucket_size)],
+                    suppressed=suppressed[(column, bucket_size)])
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from explorer.connection import AircloakConnection
+from explorer.emulator import EmulatorBackend
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(0)
+
+
+@pytest.fixture
+def incomes(rng):
+    '''Skewed integer values, with a sparse tail that gets suppressed at small bucket sizes'''
+    values = np.round(rng.lognormal(8, 0.6, 20_000))
+    values[:100] = np.nan
+    return values
+
+
+@pytest.fixture
+def connect():
+    '''Create AircloakConnections to emulated cloaks, closed after the test'''
+    connections = []
+
+    def connect(tables=None, *, backend=None, cache=None, **kwargs):
+        if backend is None:
+            backend = EmulatorBackend(tables, **kwargs)
+        connection = AircloakConnection(dbname='emulator', backend=backend, cache=cache)
+        connections.append(connection)
+        return connection
+
+    yield connect
+
+    for connection in connections:
+        connection.close()
+
+
+@pytest.fixture
+def assert_same_levels():
+    return same_levels
+
+
+def same_levels(a, b):
+    '''Assert that two explorers hold the same buckets at every level'''
+    columns_a, columns_b = a.extract_arrays(), b.extract_arrays()
+    order_a = np.lexsort((columns_a['lower_bound'], columns_a['bucket_size']))
+    order_b = np.lexsort((columns_b['lower_bound'], columns_b['bucket_size']))
+    assert columns_a.keys() == columns_b.keys()
+    for name in columns_a:
+        np.testing.assert_allclose(columns_a[name][order_a], columns_b[name][order_b], rtol=1e-9,
+                                   err_msg=f'Column {name} differs')
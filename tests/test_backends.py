@@ -0,0 +1,100 @@
+import psycopg2
+import pytest
+
+from explorer.backends import PostgresBackend
+
+
+class FakeConnection:
+    '''Stands in for a psycopg2 connection. A query fails the transaction until it is rolled back.'''
+
+    def __init__(self, fail_rollback=False, dropped=False):
+        self.closed = 0
+        self.aborted = False
+        self.rollbacks = 0
+        self.fail_rollback = fail_rollback
+        self.dropped = dropped
+
+    def cursor(self, name=None):
+        return FakeCursor(self)
+
+    def rollback(self):
+        self.rollbacks += 1
+        if self.fail_rollback:
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+        self.aborted = False
+
+    def close(self):
+        self.closed = 1
+
+
+class FakeCursor:
+    description = [type('Column', (), {'name': 'x'})]
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, query_text):
+        if self.conn.dropped:
+            self.conn.closed = 2
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+        if self.conn.aborted:
+            raise psycopg2.errors.InFailedSqlTransaction('current transaction is aborted')
+        if query_text == 'bad':
+            self.conn.aborted = True
+            raise psycopg2.ProgrammingError('unsupported query')
+
+    def fetchall(self):
+        return [(1,)]
+
+
+def backend(monkeypatch, connections):
+    backend = PostgresBackend(user='user', host='localhost', port=9432, dbname='db', pool_size=1)
+    monkeypatch.setattr(backend, '_connect', lambda: connections.pop(0))
+    return backend
+
+
+def test_failed_queries_dont_break_the_pooled_connection(monkeypatch):
+    conn = FakeConnection()
+    pool = backend(monkeypatch, [conn])
+
+    with pytest.raises(psycopg2.ProgrammingError):
+        pool.execute('bad')
+    assert conn.rollbacks == 1
+
+    assert pool.execute('good') == (['x'], [(1,)])
+    assert pool._idle == [conn]
+
+
+def test_connections_that_fail_to_roll_back_are_dropped(monkeypatch):
+    broken, fresh = FakeConnection(fail_rollback=True), FakeConnection()
+    pool = backend(monkeypatch, [broken, fresh])
+
+    with pytest.raises(psycopg2.ProgrammingError):
+        pool.execute('bad')
+    assert broken.closed
+    assert pool._idle == []
+
+    assert pool.execute('good') == (['x'], [(1,)])
+    assert pool._idle == [fresh]
+
+
+def test_dropped_connections_are_replaced(monkeypatch):
+    dropped, fresh = FakeConnection(dropped=True), FakeConnection()
+    pool = backend(monkeypatch, [dropped, fresh])
+
+    assert pool.execute('good') == (['x'], [(1,)])
+    assert pool._idle == [fresh]
+
+
+def test_queries_are_retried_once(monkeypatch):
+    pool = backend(monkeypatch, [FakeConnection(dropped=True), FakeConnection(dropped=True), FakeConnection()])
+
+    with pytest.raises(psycopg2.OperationalError):
+        pool.execute('good')
+    assert pool._idle == []
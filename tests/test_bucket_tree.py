@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from explorer import bucket_tree as bt
+from explorer.numeric_explorer import NumericColumnExplorer
+
+
+@pytest.fixture
+def tree(connect, rng):
+    values = rng.integers(0, 1000, 20_000).astype(np.float64)
+    e = NumericColumnExplorer(aircloak_connection=connect({'t': {'x': values}}), table='t', column='x',
+                              prefetch=False, max_synthetic_share=None)
+    e.explore(3)
+    return e._bucket_tree
+
+
+def test_parent_and_children(tree):
+    sizes = sorted(tree.bucket_levels())
+    assert len(sizes) == 3
+    fine, coarse = sizes[0], sizes[1]
+
+    for bucket in tree.level(fine):
+        parent = tree.parent(bucket)
+        assert parent.size == coarse
+        assert parent.contains(bucket)
+        assert tree.parent(bucket, sizes[2]).contains(bucket)
+
+    for bucket in tree.level(coarse):
+        children = list(tree.children(bucket))
+        assert len(children) == round(coarse / fine)
+        assert all(bucket.contains(child) for child in children)
+        assert sum(child.data.count for child in children) == pytest.approx(bucket.data.count)
+        assert [child.lower_bound for child in tree.children(bucket, fine)] == \
+            [child.lower_bound for child in children]
+
+    top = tree.level(sizes[2])
+    assert tree.parent(next(iter(top))) is None
+    assert list(tree.children(next(iter(tree.level(fine))))) == []
+
+
+def test_buckets_in_range(tree):
+    size = min(tree.bucket_levels())
+    lower_bounds = [bucket.lower_bound for bucket in tree.buckets_in_range(size, 100, 200)]
+    assert lower_bounds == list(np.arange(100, 200, size))
+    assert list(tree.buckets_in_range(size, 2000, 3000)) == []
+    assert list(tree.buckets_in_range(size / 2, 100, 200)) == []
+
+    assert tree.get_bucket(bt.Bucket(size, 100.0, None)).lower_bound == 100.0
+    assert tree.get_bucket(bt.Bucket(size, 5000.0, None)) is None
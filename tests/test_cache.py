@@ -0,0 +1,93 @@
+import types
+
+import pytest
+
+from explorer import cache as cache_module
+from explorer import queries
+from explorer.cache import QueryCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    '''A fake clock for the cache, advanced by setting clock.now'''
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(cache_module, 'time', types.SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = QueryCache(str(tmp_path / 'queries.sqlite'))
+    yield cache
+    cache.close()
+
+
+def test_put_and_get(cache):
+    assert cache.get('db', 'SELECT 1') is None
+    cache.put('db', 'SELECT 1', ['x'], [[1], (2,)])
+
+    assert cache.get('db', 'SELECT 1') == (['x'], [(1,), (2,)])
+    assert cache.get('other', 'SELECT 1') is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 2, 1)
+
+
+def test_results_expire_after_ttl(tmp_path, clock):
+    cache = QueryCache(str(tmp_path / 'queries.sqlite'), ttl=60)
+    cache.put('db', 'SELECT 1', ['x'], [(1,)])
+
+    clock.now += 60
+    assert cache.get('db', 'SELECT 1') is not None
+    clock.now += 1
+    assert cache.get('db', 'SELECT 1') is None
+    assert cache.stats()['entries'] == 0
+    cache.close()
+
+
+def test_least_recently_used_results_are_evicted(tmp_path, clock):
+    cache = QueryCache(str(tmp_path / 'queries.sqlite'))
+    rows = [(i,) for i in range(100)]
+    for query in ['a', 'b', 'c']:
+        clock.now += 1
+        cache.put('db', query, ['x'], rows)
+    entry_bytes = cache.stats()['bytes'] // 3
+
+    # Reading 'a' makes 'b' the least recently used result
+    clock.now += 1
+    cache.get('db', 'a')
+    cache.max_bytes = 3 * entry_bytes
+    clock.now += 1
+    cache.put('db', 'd', ['x'], rows)
+
+    assert cache.get('db', 'b') is None
+    assert all(cache.get('db', query) is not None for query in ['a', 'c', 'd'])
+    assert cache.stats()['bytes'] <= cache.max_bytes
+    cache.close()
+
+
+def test_invalidate(cache):
+    for (dbname, query) in [('db', 'a'), ('db', 'b'), ('other', 'a')]:
+        cache.put(dbname, query, ['x'], [(1,)])
+
+    cache.invalidate('db', 'a')
+    assert cache.get('db', 'a') is None
+    assert cache.get('db', 'b') is not None
+
+    cache.invalidate('db')
+    assert cache.get('db', 'b') is None
+    assert cache.get('other', 'a') is not None
+
+    cache.invalidate()
+    assert cache.stats()['entries'] == 0
+
+
+def test_connection_reads_cached_results(connect, cache, monkeypatch):
+    connection = connect({'t': {'x': [1.0, 2.0]}}, cache=cache)
+    query = queries.top_level_stats(table='t', column='x')
+    result = connection.fetch(query, cursor_factory=None)
+
+    sent = []
+    monkeypatch.setattr(connection.backend, 'execute', sent.append)
+    assert connection.fetch(query, cursor_factory=None) == result
+    assert sent == []
+    assert (cache.hits, cache.misses) == (1, 1)
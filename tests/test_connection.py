@@ -0,0 +1,38 @@
+import pytest
+
+from explorer.connection import ColumnInfo
+
+
+@pytest.fixture
+def sent():
+    '''The queries sent by the connection'''
+    return []
+
+
+@pytest.fixture
+def connection(connect, sent, monkeypatch):
+    connection = connect({'loans': {'income': [1.5, 2.0], 'name': ['a', 'b']}, 'other': {'x': [1]}})
+    execute = connection.backend.execute
+    monkeypatch.setattr(connection.backend, 'execute', lambda query_text: sent.append(query_text) or
+                        execute(query_text))
+    return connection
+
+
+def test_metadata_is_loaded_on_first_use(connection, sent):
+    assert sent == []
+
+    assert connection.column_info('loans', 'income').type == 'real'
+    assert connection.columns('loans')['name'] == ColumnInfo('text', 'false', None)
+    assert len(sent) == 1
+
+    assert set(connection.tables().keys()) == {'loans', 'other'}
+    connection.table_info('other')
+    assert len(sent) == 2
+
+
+def test_prefetch_columns(connection, sent):
+    connection.columns('loans')
+    columns = connection.prefetch_columns(['loans', 'other'])
+    assert set(columns['loans'].keys()) == {'income', 'name'}
+    assert set(columns['other'].keys()) == {'x'}
+    assert len(sent) == 2
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+from explorer import bucket_util
+from explorer.datetime_explorer import DateTimeColumnExplorer, to_datetimes, to_seconds
+
+UNITS = bucket_util.CALENDAR_UNITS
+
+
+def explorer(connection, column, **kwargs):
+    return DateTimeColumnExplorer(aircloak_connection=connection, table='events', column=column, **kwargs)
+
+
+@pytest.fixture
+def days(rng):
+    '''Dates over almost three years, enough to start at days'''
+    values = np.datetime64('2010-01-01') + rng.integers(0, 1000, 50_000).astype('timedelta64[D]')
+    values[:50] = np.datetime64('NaT')
+    return values
+
+
+def test_date_columns_are_explored_down_to_days(connect, days):
+    connection = connect({'events': {'day': days}})
+    assert connection.column_info('events', 'day').type == 'date'
+
+    e = explorer(connection, 'day', prefetch=False)
+    tree = e._bucket_tree
+    assert min(tree.next_levels(10)) == UNITS['day']
+
+    # The units above the estimated one come along with the first call
+    e.explore(1)
+    assert sorted(tree.bucket_levels()) == [UNITS[unit] for unit in ['day', 'month', 'quarter', 'year']]
+    assert len(tree.next_levels(1)) == 0
+
+    # Months start on the first of the month and measured months hold the values of the month
+    months = tree.level(UNITS['month'])
+    starts = to_datetimes(months.column('lower_bound'))
+    assert np.all(starts.astype('datetime64[M]') == starts)
+    valid = days[~np.isnat(days)]
+    truth = dict(zip(*np.unique(valid.astype('datetime64[M]'), return_counts=True)))
+    measured = ~months.column('synthetic')
+    for (start, count) in zip(starts[measured], months.column('count')[measured]):
+        assert count == truth[start.astype('datetime64[M]')]
+
+    # Months nest in their calendar year
+    for month in tree.level(UNITS['month']):
+        year = tree.parent(month, UNITS['year'])
+        assert to_datetimes([year.lower_bound])[0].astype('datetime64[Y]') == \
+            to_datetimes([month.lower_bound])[0].astype('datetime64[Y]')
+
+    median = tree.quantile(0.5)
+    assert abs(median.value - to_seconds([np.sort(valid)[len(valid) // 2]])[0]) <= median.error + UNITS['day']
+
+
+def test_units_are_capped_by_the_number_of_values(connect, rng):
+    start = np.datetime64('2019-01-01T00:00:00', 's')
+    times = start + rng.integers(0, 3 * 365 * 86400, 100_000).astype('timedelta64[s]')
+    connection = connect({'events': {'time': times}})
+    assert connection.column_info('events', 'time').type == 'datetime'
+
+    e = explorer(connection, 'time', prefetch=False)
+    for _ in range(3):
+        e.explore(3)
+
+    tree = e._bucket_tree
+    assert min(tree.bucket_levels()) == UNITS['hour']
+    assert all(len(tree.level(size)) <= 100_000 for size in tree.bucket_levels())
+
+
+def test_zoom_is_rejected(connect, days):
+    e = explorer(connect({'events': {'day': days}}), 'day', prefetch=False)
+    e.explore(1)
+    with pytest.raises(ValueError):
+        e.zoom()
+
+
+def test_snapshot_keeps_calendar_levels(connect, days, tmp_path, assert_same_levels):
+    e = explorer(connect({'events': {'day': days}}), 'day', prefetch=False)
+    e.explore(1)
+    path = str(tmp_path / 'day.snapshot')
+    e.save(path)
+
+    loaded = DateTimeColumnExplorer.from_snapshot(path)
+    assert loaded._bucket_tree.calendar
+    assert_same_levels(e, loaded)
+
+
+def test_seconds_conversion():
+    values = np.array(['1969-12-31T23:59:59', '2020-02-29T12:00:00.5', 'NaT'], dtype='datetime64[us]')
+    seconds = to_seconds(values)
+    assert seconds[0] == -1
+    assert np.isnan(seconds[2])
+    np.testing.assert_array_equal(to_datetimes(seconds), values)
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from explorer import queries
+from explorer.cache import QueryCache
+from explorer.distinct_profile import DistinctProfile
+from explorer.emulator import EmulatorBackend
+
+
+def run(backend, query):
+    return backend.execute(queries.as_text(query))
+
+
+@pytest.fixture
+def backend():
+    values = np.concatenate([np.repeat([1.0, 2.0, 3.0], [30, 20, 10]), np.arange(100, 110), [np.nan] * 5])
+    return EmulatorBackend({'t': {'x': values}})
+
+
+def test_bounded_queries(backend):
+    _, rows = run(backend, queries.top_distinct(table='t', column='x', limit=2))
+    assert rows == [(1.0, 30), (2.0, 20)]
+
+    # The ten values >= 100 occur once each and are suppressed
+    _, rows = run(backend, queries.suppressed_distinct(table='t', column='x'))
+    assert rows == [(None, 10)]
+
+    _, rows = run(backend, queries.distinct_stats(table='t', column='x'))
+    assert rows == [(70, 13)]
+
+
+@pytest.mark.parametrize('limit', [2, None])
+def test_distinct_profile(connect, backend, limit):
+    connection = connect(backend=backend)
+    profile = DistinctProfile(aircloak_connection=connection, table='t', column='x', limit=limit)
+
+    assert profile.suppressed_count == 10
+    assert profile.distinct_count == 13
+    assert profile.total_count == 60
+    expected = [(1.0, 30), (2.0, 20), (3.0, 10)]
+    assert profile.top_values() == (expected if limit is None else expected[:limit])
+    assert sorted(profile.values()) == expected
+
+    restored = DistinctProfile.from_summary(profile.summary())
+    assert restored.summary() == profile.summary()
+
+
+def test_bounded_profile_uses_the_cache(connect, backend, tmp_path, monkeypatch):
+    connection = connect(backend=backend, cache=QueryCache(str(tmp_path / 'cache')))
+    DistinctProfile(aircloak_connection=connection, table='t', column='x')
+
+    sent = []
+    monkeypatch.setattr(backend, 'execute', sent.append)
+    profile = DistinctProfile(aircloak_connection=connection, table='t', column='x')
+    assert sent == []
+    assert profile.suppressed_count == 10
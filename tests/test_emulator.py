@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from explorer import queries
+from explorer.emulator import EmulatorBackend, column_type
+
+
+def run(backend, query):
+    return backend.execute(queries.as_text(query))
+
+
+@pytest.fixture
+def backend():
+    values = np.concatenate([np.repeat([1.0, 2.0, 3.0], [30, 20, 10]), np.arange(100, 110), [np.nan] * 5])
+    return EmulatorBackend({'t': {'x': values}})
+
+
+@pytest.mark.parametrize('values, expected', [
+    (np.array([1, 2]), 'integer'),
+    (np.array([1.0, np.nan]), 'integer'),
+    (np.array([1.5, np.nan]), 'real'),
+    (np.array(['a', None], dtype=object), 'text'),
+    (np.array(['2020-01-01', 'NaT'], dtype='datetime64[D]'), 'date'),
+    (np.array(['2020-01-01T10:00'], dtype='datetime64[m]'), 'datetime'),
+    (np.array(['2020-01-01T10:00'], dtype='datetime64[ns]'), 'datetime'),
+])
+def test_column_type(values, expected):
+    assert column_type(values) == expected
+
+
+def test_low_counts_are_suppressed_into_a_star_row(backend):
+    labels, rows = run(backend, queries.top_level_distinct(table='t', column='x'))
+    assert labels == ['x', 'count']
+    # The ten values >= 100 occur once each
+    assert sorted(rows, key=lambda row: (row[0] is None, row[0])) == [(1.0, 30), (2.0, 20), (3.0, 10), (None, 10)]
+
+
+def test_date_columns(connect):
+    days = np.array(['2020-01-01', '2020-03-15', 'NaT'], dtype='datetime64[D]')
+    connection = connect({'t': {'day': days, 'time': days.astype('datetime64[s]')}})
+    assert connection.column_info('t', 'day').type == 'date'
+    assert connection.column_info('t', 'time').type == 'datetime'
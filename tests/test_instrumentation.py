@@ -0,0 +1,67 @@
+import io
+import json
+
+import pytest
+
+from explorer import instrumentation
+from explorer.numeric_explorer import NumericColumnExplorer
+
+
+@pytest.fixture
+def collect():
+    '''Activate a collector for the duration of the test'''
+    previous = instrumentation.get_collector()
+    yield instrumentation.set_collector
+    instrumentation.set_collector(previous)
+
+
+def test_no_collector_measures_nothing():
+    assert not instrumentation.enabled()
+    with instrumentation.timed('stage') as timer:
+        timer.add(rows=1)
+
+
+def test_summary_collector(collect):
+    collector = instrumentation.SummaryCollector()
+    collect(collector)
+    for rows in [10, 20]:
+        with instrumentation.timed('stage', cached=False) as timer:
+            timer.add(rows=rows)
+
+    summary = collector.summary()['stage']
+    assert summary['count'] == 2
+    assert summary['rows'] == 30
+    assert 'cached' not in summary
+    assert summary['min'] <= summary['mean'] <= summary['max']
+    assert summary['total'] == pytest.approx(2 * summary['mean'])
+
+    collector.reset()
+    assert collector.summary() == {}
+
+
+def test_json_lines_collector(collect):
+    output = io.StringIO()
+    collector = instrumentation.JsonLinesCollector(output)
+    collect(collector)
+    with instrumentation.timed('stage', rows=3):
+        pass
+    collector.close()
+
+    (record,) = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert record['stage'] == 'stage'
+    assert record['rows'] == 3
+    assert record['duration'] >= 0
+
+
+def test_exploring_reports_its_stages(collect, connect, incomes):
+    collector = instrumentation.SummaryCollector()
+    collect(collector)
+    e = NumericColumnExplorer(aircloak_connection=connect({'loans': {'income': incomes}}), table='loans',
+                              column='income', prefetch=False)
+    e.explore(2)
+    e.extract_arrays()
+
+    summary = collector.summary()
+    assert {'query', 'query.decode', 'explorer.process', 'level.interpolate', 'tree.export'} <= summary.keys()
+    assert summary['query']['rows'] > 0
+    assert summary['explorer.process']['rows'] > 0
@@ -0,0 +1,91 @@
+import gc
+import os
+
+import numpy as np
+import pytest
+
+from explorer import bucket_tree as bt
+from explorer import level_store
+from explorer.numeric_explorer import NumericColumnExplorer
+
+# The columns of a level from `level`: lower bounds and DATA_COLUMNS as floats, synthetic as bools
+LEVEL_BYTES = 10 * (1 + len(bt.DATA_COLUMNS)) * 8 + 10
+
+
+@pytest.fixture
+def set_budget(tmp_path):
+    '''Set a memory budget for the levels created in the test, spilling to a temporary directory'''
+    previous = level_store.get_store()
+    yield lambda max_bytes: level_store.set_memory_budget(max_bytes, str(tmp_path / 'spill'))
+    level_store._store = previous
+
+
+def level(lower_bound):
+    return bt.BucketLevel(bucket_size=1, lower_bounds=np.arange(lower_bound, lower_bound + 10.0),
+                          data=np.ones((10, len(bt.DATA_COLUMNS))))
+
+
+def test_least_recently_used_levels_are_spilled(set_budget):
+    store = set_budget(2 * LEVEL_BYTES)
+    a, b = level(0), level(10)
+    assert store.stats()['resident_bytes'] == 2 * LEVEL_BYTES
+
+    # Using a makes b the least recently used level
+    a.column('count')
+    c = level(20)
+    assert store.stats()['spills'] == 1
+    assert b._resident_columns is None
+    assert a._resident_columns is not None and c._resident_columns is not None
+
+    # b is reloaded from its spill file, and a spilled in turn
+    np.testing.assert_array_equal(b.column('lower_bound'), np.arange(10.0, 20.0))
+    assert store.stats() == {'resident_levels': 2, 'resident_bytes': 2 * LEVEL_BYTES, 'max_bytes': 2 * LEVEL_BYTES,
+                             'spills': 2, 'reloads': 1}
+    with pytest.raises(ValueError):
+        b.column('count')[0] = 0
+
+
+def test_spill_files_are_removed_with_their_levels(set_budget):
+    store = set_budget(LEVEL_BYTES)
+    levels = [level(i * 10) for i in range(3)]
+    assert len(os.listdir(store.spill_dir)) == 2
+
+    del levels
+    gc.collect()
+    assert os.listdir(store.spill_dir) == []
+    assert store.stats()['resident_levels'] == 0
+
+
+def test_spilled_levels_answer_like_resident_ones(set_budget, connect, incomes, assert_same_levels):
+    resident = NumericColumnExplorer(aircloak_connection=connect({'loans': {'income': incomes}}), table='loans',
+                                     column='income', prefetch=False)
+    store = set_budget(1)
+    spilled = NumericColumnExplorer(aircloak_connection=connect({'loans': {'income': incomes}}), table='loans',
+                                    column='income', prefetch=False)
+    for _ in range(2):
+        resident.explore(3)
+        spilled.explore(3)
+
+    assert store.stats()['spills'] > 0
+    assert_same_levels(resident, spilled)
+    for q in [0.1, 0.5, 0.9]:
+        assert spilled._bucket_tree.quantile(q) == resident._bucket_tree.quantile(q)
+    assert store.stats()['reloads'] > 0
+
+
+def test_memory_mapped_levels_are_not_stored(set_budget, connect, incomes, tmp_path):
+    e = NumericColumnExplorer(aircloak_connection=connect({'loans': {'income': incomes}}), table='loans',
+                              column='income', prefetch=False)
+    e.explore(3)
+    path = str(tmp_path / 'income.snapshot')
+    e.save(path)
+
+    store = set_budget(1)
+    loaded = NumericColumnExplorer.from_snapshot(path, mmap=True)
+    loaded.extract_arrays()
+    assert store.stats()['resident_levels'] == 0
+    assert store.stats()['spills'] == 0
+
+    read = NumericColumnExplorer.from_snapshot(path, mmap=False)
+    assert store.stats()['resident_levels'] == 1
+    assert store.stats()['spills'] == len(read._bucket_tree.bucket_levels()) - 1
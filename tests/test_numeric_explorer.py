@@ -0,0 +1,224 @@
+import sys
+
+import numpy as np
+import psycopg2
+import pytest
+
+from explorer import bucket_util
+from explorer.emulator import LOW_COUNT_THRESHOLD
+from explorer.numeric_explorer import NumericColumnExplorer
+
+
+def explorer(connection, **kwargs):
+    return NumericColumnExplorer(aircloak_connection=connection, table='loans', column='income', **kwargs)
+
+
+def test_explore_builds_complete_levels(connect, incomes):
+    e = explorer(connect({'loans': {'income': incomes}}))
+    e.explore(3)
+
+    tree = e._bucket_tree
+    levels = [tree.level(size) for size in sorted(tree.bucket_levels(), reverse=True)]
+    assert len(levels) == 3
+    assert all(level.is_complete() for level in levels)
+
+    # The star row of the coarsest level is in no bucket, finer levels interpolate theirs
+    coarsest = levels[0]
+    assert coarsest.total_count() + coarsest.metadata['suppressed'] == np.count_nonzero(~np.isnan(incomes))
+    for level in levels[1:]:
+        assert level.total_count() == pytest.approx(coarsest.total_count())
+
+
+def test_prefetched_levels_match_fresh_queries(connect, incomes, assert_same_levels):
+    prefetching = explorer(connect({'loans': {'income': incomes}}), prefetch=True)
+    fresh = explorer(connect({'loans': {'income': incomes}}), prefetch=False)
+    for _ in range(2):
+        prefetching.explore(2)
+        fresh.explore(2)
+
+    assert_same_levels(prefetching, fresh)
+
+
+def test_extract_arrays(connect, incomes):
+    e = explorer(connect({'loans': {'income': incomes}}), prefetch=False)
+    e.explore(3)
+    tree = e._bucket_tree
+    sizes = sorted(tree.bucket_levels(), reverse=True)
+
+    # A single level is exported without copying
+    columns = e.extract_arrays([sizes[0]])
+    assert np.shares_memory(columns['count'], tree.level(sizes[0]).column('count'))
+    with pytest.raises(ValueError):
+        columns['count'][0] = 0
+
+    columns = e.extract_arrays(slice(-2, None))
+    assert set(np.unique(columns['bucket_size'])) == set(sizes[-2:])
+    assert len(columns['lower_bound']) == sum(len(tree.level(size)) for size in sizes[-2:])
+
+    pd = pytest.importorskip('pandas')
+    args = e.extract_to_dataframe()
+    df = pd.DataFrame(**args)
+    assert list(df.columns) == ['bucket_size', 'lower_bound', 'count', 'count_noise', 'min', 'max', 'avg']
+    for name in args['columns']:
+        np.testing.assert_array_equal(df[name].to_numpy(), args['data'][name])
+
+
+def test_extract_to_arrow(connect, incomes):
+    pa = pytest.importorskip('pyarrow')
+    e = explorer(connect({'loans': {'income': incomes}}), prefetch=False)
+    e.explore(3)
+
+    table = e.extract_to_arrow()
+    assert isinstance(table, pa.Table)
+    for (name, array) in e.extract_arrays().items():
+        np.testing.assert_array_equal(table.column(name).to_numpy(), array)
+
+
+def test_extract_to_arrow_requires_pyarrow(connect, incomes, monkeypatch):
+    e = explorer(connect({'loans': {'income': incomes}}), prefetch=False)
+    e.explore(1)
+
+    monkeypatch.setitem(sys.modules, 'pyarrow', None)
+    with pytest.raises(ImportError, match='pyarrow'):
+        e.extract_to_arrow()
+
+
+def test_zoom_merges_ranges_into_partial_levels(connect, incomes):
+    e = explorer(connect({'loans': {'income': incomes}}), prefetch=False)
+    e.explore(2)
+    tree = e._bucket_tree
+    finest = min(tree.bucket_levels())
+
+    e.zoom((3000, 3500), depth=1)
+    zoomed = [size for size in tree.bucket_levels() if size < finest]
+    assert len(zoomed) == 1
+    size = zoomed[0]
+    level = tree.level(size)
+    assert not level.is_complete()
+    assert level.covers(3000, 3500)
+    assert not level.covers(3000, 4000)
+
+    # An adjacent range is merged into the same level
+    e.zoom((3500, 4000), depth=1)
+    level = tree.level(size)
+    assert level.covers(3000, 4000)
+    assert len(level.covered) == 1
+    lower_bounds = level.column('lower_bound')
+    assert np.all(np.diff(lower_bounds) > 0)
+
+    # Measured buckets hold the values of their range
+    valid = incomes[~np.isnan(incomes)]
+    for (lower_bound, count, synthetic) in zip(lower_bounds, level.column('count'), level.column('synthetic')):
+        if not synthetic:
+            assert count == np.count_nonzero((valid >= lower_bound) & (valid < lower_bound + size))
+
+    # Ranges that are already explored are not queried again
+    e.zoom((3000, 4000), depth=1)
+    assert tree.level(size) is level
+
+
+def test_split_plan_matches_single_queries(connect, incomes, assert_same_levels):
+    budget = bucket_util.QueryBudget(max_rows=2_000, max_bytes=None, latency_target=None)
+    single = explorer(connect({'loans': {'income': incomes}}), prefetch=False, max_synthetic_share=None,
+                      budget=bucket_util.QueryBudget(max_rows=None, max_bytes=None, latency_target=None))
+    split = explorer(connect({'loans': {'income': incomes}}), prefetch=False, max_synthetic_share=None,
+                     budget=budget)
+
+    single.explore(3)
+    split.explore(3)
+    plan = split._plan_queries(3)
+    ranges = bucket_util.merge_ranges(planned.value_range for planned in plan if planned.value_range is not None)
+    assert len(ranges) == 1
+    assert ranges[0][0] <= np.nanmin(incomes) and np.nanmax(incomes) < ranges[0][1]
+
+    single.explore(3)
+    split.explore(3)
+    assert_same_levels(single, split)
+    # Each part has its own star row, which is suppressed itself if it holds too few values
+    for size in single._bucket_tree.bucket_levels():
+        parts = sum(1 for planned in plan if size in planned.bucket_sizes)
+        missing = single._bucket_tree.level(size).metadata['suppressed'] - \
+            split._bucket_tree.level(size).metadata['suppressed']
+        if parts > 1:
+            assert 0 <= missing < parts * LOW_COUNT_THRESHOLD
+        else:
+            assert missing == 0
+
+
+def test_estimates_bound_the_true_values(connect, incomes):
+    e = explorer(connect({'loans': {'income': incomes}}), prefetch=False)
+    e.explore(3)
+    e.explore(3)
+    tree = e._bucket_tree
+    valid = incomes[~np.isnan(incomes)]
+
+    for q in [0.1, 0.5, 0.9, 0.99]:
+        estimate = tree.quantile(q)
+        assert abs(estimate.value - np.quantile(valid, q)) <= estimate.error + 1
+
+    for (lo, hi) in [(0, 3000), (3000, 5000), (10_000, 20_000)]:
+        estimate = tree.range_count(lo, hi)
+        assert abs(estimate.value - np.count_nonzero((valid >= lo) & (valid < hi))) <= estimate.error
+
+    estimate = tree.cdf(5000)
+    assert abs(estimate.value - np.mean(valid < 5000)) <= estimate.error
+
+
+def test_derived_levels_match_queried_levels(connect, rng):
+    values = rng.uniform(0, 1000, 50_000).round(2)
+    derived = explorer(connect({'loans': {'income': values}}), prefetch=False)
+    queried = explorer(connect({'loans': {'income': values}}), prefetch=False, max_synthetic_share=None)
+    for _ in range(3):
+        derived.explore(3)
+        queried.explore(3)
+
+    derived_sizes = [size for size in derived._bucket_tree.bucket_levels()
+                     if 'derived_from' in derived._bucket_tree.level(size).metadata]
+    assert len(derived_sizes) > 0
+    for size in derived_sizes:
+        a, b = derived._bucket_tree.level(size), queried._bucket_tree.level(size)
+        np.testing.assert_array_equal(a.column('lower_bound'), b.column('lower_bound'))
+        measured = b.column('count') >= bucket_util.MIN_EXACT_COUNT
+        np.testing.assert_array_equal(a.column('count')[measured], b.column('count')[measured])
+
+
+def test_streamed_plan_matches_buffered_plan(connect, incomes, assert_same_levels):
+    buffered = explorer(connect({'loans': {'income': incomes}}), prefetch=False)
+    streamed = explorer(connect({'loans': {'income': incomes}}), prefetch=False)
+    chunks = []
+    for _ in range(2):
+        buffered.explore(3)
+        streamed.explore(3, stream=True, chunk_size=100, on_chunk=lambda e: chunks.append(e))
+
+    assert len(chunks) > 2
+    assert_same_levels(buffered, streamed)
+
+
+def test_failed_stream_leaves_its_levels_to_explore(connect, incomes, assert_same_levels, monkeypatch):
+    buffered = explorer(connect({'loans': {'income': incomes}}), prefetch=False)
+    connection = connect({'loans': {'income': incomes}})
+    streamed = explorer(connection, prefetch=False)
+    stream = connection.backend.stream
+    closed = []
+
+    def failing_stream(query_text, chunk_size):
+        try:
+            chunks = stream(query_text, chunk_size)
+            yield next(chunks)
+            raise psycopg2.OperationalError('connection lost')
+        finally:
+            closed.append(True)
+
+    monkeypatch.setattr(connection.backend, 'stream', failing_stream)
+    to_explore = streamed._bucket_tree.next_levels(2)
+    with pytest.raises(psycopg2.OperationalError):
+        streamed.explore(2, stream=True, chunk_size=5)
+    assert closed == [True]
+    assert streamed._bucket_tree.bucket_levels() == []
+    assert streamed._bucket_tree.next_levels(2) == to_explore
+    assert all(streamed.partial_level(size) is None for size in to_explore)
+
+    monkeypatch.setattr(connection.backend, 'stream', stream)
+    buffered.explore(1)
+    streamed.explore(1, stream=True, chunk_size=5)
+    assert_same_levels(buffered, streamed)
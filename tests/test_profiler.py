@@ -0,0 +1,91 @@
+import os
+
+import numpy as np
+import psycopg2
+import pytest
+
+from explorer import profiler
+from explorer.datetime_explorer import DateTimeColumnExplorer
+from explorer.numeric_explorer import NumericColumnExplorer
+from explorer.profiler import Profiler
+
+
+@pytest.fixture
+def connection(connect, rng, incomes):
+    days = np.datetime64('2010-01-01') + rng.integers(0, 1000, len(incomes)).astype('timedelta64[D]')
+    return connect({
+        'loans': {'income': incomes, 'age': np.round(rng.normal(40, 12, len(incomes))), 'name': ['x'] * len(incomes)},
+        'events': {'day': days},
+    })
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    '''The backoff delays waited for, without waiting'''
+    sleeps = []
+    monkeypatch.setattr(profiler.time, 'sleep', sleeps.append)
+    return sleeps
+
+
+def fail_explore(monkeypatch, column, errors):
+    '''Make exploring `column` raise the given errors, one per attempt, before it succeeds'''
+    explore = NumericColumnExplorer.explore
+    errors = list(errors)
+
+    def failing_explore(self, *args, **kwargs):
+        if self.column == column and len(errors) > 0:
+            raise errors.pop(0)
+        return explore(self, *args, **kwargs)
+
+    monkeypatch.setattr(NumericColumnExplorer, 'explore', failing_explore)
+
+
+def test_profiles_numeric_and_date_columns(connection, tmp_path):
+    progress = []
+    results = Profiler(aircloak_connection=connection, output_dir=str(tmp_path), rounds=1,
+                       progress=lambda *args: progress.append(args)).run()
+
+    assert sorted((result.table, result.column) for result in results) == \
+        [('events', 'day'), ('loans', 'age'), ('loans', 'income')]
+    assert all(result.error is None and result.attempts == 1 for result in results)
+    assert [(done, total) for (done, total, _) in progress] == [(1, 3), (2, 3), (3, 3)]
+
+    for result in results:
+        explorer_class = DateTimeColumnExplorer if result.column == 'day' else NumericColumnExplorer
+        loaded = explorer_class.from_snapshot(result.path)
+        assert (loaded.table, loaded.column) == (result.table, result.column)
+        assert len(loaded._bucket_tree.bucket_levels()) > 0
+
+
+def test_connection_errors_are_retried_with_backoff(connection, tmp_path, monkeypatch, sleeps):
+    fail_explore(monkeypatch, 'income', [psycopg2.OperationalError('connection lost'), OSError('reset')])
+    results = Profiler(aircloak_connection=connection, output_dir=str(tmp_path), tables=['loans'], rounds=1,
+                       backoff=0.5).run()
+
+    income = next(result for result in results if result.column == 'income')
+    assert income.error is None
+    assert income.attempts == 3
+    assert os.path.exists(income.path)
+    assert sleeps == [0.5, 1.0]
+
+
+def test_failures_are_reported(connection, tmp_path, monkeypatch, sleeps):
+    fail_explore(monkeypatch, 'income', [psycopg2.OperationalError('connection lost')] * 3)
+    fail_explore(monkeypatch, 'age', [psycopg2.ProgrammingError('unsupported query')])
+    results = {result.column: result for result in Profiler(
+        aircloak_connection=connection, output_dir=str(tmp_path), tables=['loans'], rounds=1, retries=2).run()}
+
+    # Errors reported by the cloak for a query are not retried
+    assert isinstance(results['age'].error, psycopg2.ProgrammingError)
+    assert results['age'].attempts == 1
+    assert isinstance(results['income'].error, psycopg2.OperationalError)
+    assert results['income'].attempts == 3
+    assert results['age'].path is None and results['income'].path is None
+    assert os.listdir(tmp_path) == []
+    assert len(sleeps) == 2
+
+
+def test_workers_are_capped_by_the_pool(connection, tmp_path):
+    assert Profiler(aircloak_connection=connection, output_dir=str(tmp_path)).workers == connection.pool_size
+    with pytest.raises(ValueError):
+        Profiler(aircloak_connection=connection, output_dir=str(tmp_path), workers=connection.pool_size + 1)
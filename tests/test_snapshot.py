@@ -0,0 +1,93 @@
+import os
+
+import numpy as np
+import pytest
+
+from explorer import snapshot
+from explorer.numeric_explorer import NumericColumnExplorer
+
+
+@pytest.fixture
+def explored(connect, incomes):
+    e = NumericColumnExplorer(aircloak_connection=connect({'loans': {'income': incomes}}),
+                              table='loans', column='income', prefetch=False)
+    e.explore(3)
+    e.zoom((3000, 3400), depth=1)
+    return e
+
+
+@pytest.mark.parametrize('mmap', [True, False])
+def test_save_and_load(explored, tmp_path, mmap, assert_same_levels):
+    path = str(tmp_path / 'income.snapshot')
+    explored.save(path)
+
+    loaded = NumericColumnExplorer.from_snapshot(path, mmap=mmap)
+    assert_same_levels(explored, loaded)
+
+    tree, tree_loaded = explored._bucket_tree, loaded._bucket_tree
+    assert sorted(tree_loaded.bucket_levels()) == sorted(tree.bucket_levels())
+    for size in tree.bucket_levels():
+        assert tree_loaded.level(size).covered == tree.level(size).covered
+        assert tree_loaded.level(size).metadata == tree.level(size).metadata
+    assert tree_loaded.state() == tree.state()
+    assert loaded._distincts.summary() == explored._distincts.summary()
+    assert loaded.extract_to_dataframe()['columns'] == explored.extract_to_dataframe()['columns']
+
+
+def test_loaded_explorer_continues_exploring(explored, connect, incomes, tmp_path, assert_same_levels):
+    path = str(tmp_path / 'income.snapshot')
+    explored.save(path)
+    loaded = NumericColumnExplorer.from_snapshot(
+        path, aircloak_connection=connect({'loans': {'income': incomes}}), prefetch=False)
+
+    explored.explore(2)
+    loaded.explore(2)
+    assert_same_levels(explored, loaded)
+
+
+def test_diff(explored, connect, incomes, tmp_path):
+    path = str(tmp_path / 'income.snapshot')
+    explored.save(path)
+    loaded = NumericColumnExplorer.from_snapshot(path)
+
+    diff = snapshot.diff(explored._bucket_tree, loaded._bucket_tree)
+    assert set(diff.keys()) == set(explored._bucket_tree.bucket_levels())
+    assert all(d.only_a == 0 and d.only_b == 0 and d.changed == 0 for d in diff.values())
+
+    # Noisy counts change some buckets, levels explored on one side only are reported as such
+    noisy = NumericColumnExplorer(aircloak_connection=connect({'loans': {'income': incomes}}, noise_sd=2, seed=1),
+                                  table='loans', column='income', prefetch=False)
+    noisy.explore(3)
+    diff = snapshot.diff(explored._bucket_tree, noisy._bucket_tree)
+    zoomed = min(explored._bucket_tree.bucket_levels())
+    assert zoomed not in noisy._bucket_tree.bucket_levels()
+    assert diff[zoomed].only_a == len(explored._bucket_tree.level(zoomed))
+    assert diff[zoomed].only_b == 0
+    coarsest = max(explored._bucket_tree.bucket_levels())
+    assert diff[coarsest].changed > 0
+    assert diff[coarsest].max_count_change > 0
+
+
+def test_loaded_levels_are_read_only(explored, tmp_path):
+    path = str(tmp_path / 'income.snapshot')
+    explored.save(path)
+    loaded = NumericColumnExplorer.from_snapshot(path)
+
+    counts = loaded._bucket_tree.level(max(loaded._bucket_tree.bucket_levels())).column('count')
+    with pytest.raises(ValueError):
+        counts[0] = np.nan
+
+
+def test_save_over_the_mapped_snapshot(explored, connect, incomes, tmp_path, assert_same_levels):
+    path = str(tmp_path / 'income.snapshot')
+    explored.save(path)
+    loaded = NumericColumnExplorer.from_snapshot(
+        path, aircloak_connection=connect({'loans': {'income': incomes}}), prefetch=False, mmap=True)
+
+    loaded.explore(1)
+    loaded.save(path)
+    assert os.listdir(tmp_path) == ['income.snapshot']
+
+    explored.explore(1)
+    assert_same_levels(explored, loaded)
+    assert_same_levels(explored, NumericColumnExplorer.from_snapshot(path))
@@ -0,0 +1,36 @@
+import numpy as np
+
+from explorer import snapshot
+from explorer.numeric_explorer import NumericColumnExplorer
+from explorer.table_explorer import TableExplorer
+
+
+def test_matches_column_explorers(connect, rng, incomes):
+    ages = np.round(rng.normal(40, 12, len(incomes)))
+    table = {
+        'income': incomes,
+        'age': ages,
+        'name': np.array(['x'] * len(incomes), dtype=object),
+        'empty': np.full(len(incomes), np.nan),
+    }
+    connection = connect({'loans': table})
+
+    table_explorer = TableExplorer(aircloak_connection=connection, table='loans')
+    assert table_explorer.columns == ['income', 'age']
+    for _ in range(2):
+        table_explorer.explore(3)
+
+    for column in table_explorer.columns:
+        column_explorer = NumericColumnExplorer(aircloak_connection=connection, table='loans', column=column,
+                                                prefetch=False, max_synthetic_share=None)
+        for _ in range(2):
+            column_explorer.explore(3)
+
+        tree, column_tree = table_explorer.bucket_tree(column), column_explorer._bucket_tree
+        assert sorted(tree.bucket_levels()) == sorted(column_tree.bucket_levels())
+        diff = snapshot.diff(tree, column_tree)
+        assert all(d.only_a == 0 and d.only_b == 0 and d.changed == 0 for d in diff.values()), diff
+
+        a, b = table_explorer.extract_arrays(column), column_explorer.extract_arrays()
+        for name in ['bucket_size', 'lower_bound', 'count', 'min', 'max', 'avg', 'synthetic']:
+            np.testing.assert_allclose(a[name], b[name], rtol=1e-9, err_msg=f'{column}.{name} differs')